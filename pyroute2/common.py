@@ -4,9 +4,11 @@ Common utilities
 import re
 import os
 import sys
+import heapq
 import struct
 import platform
 import threading
+import collections
 
 from socket import inet_aton
 
@@ -143,6 +145,13 @@ def dqn2int(mask):
     return bin(struct.unpack('>L', inet_aton(mask))[0]).count('1')
 
 
+def transform_handle(handle):
+    if isinstance(handle, basestring):
+        (major, minor) = [int(x if x else '0', 16) for x in handle.split(':')]
+        handle = (major << 8 * 2) | minor
+    return handle
+
+
 def hexdump(payload, length=0):
     '''
     Represent byte string as hex -- for debug purposes
@@ -165,7 +174,9 @@ class AddrPool(object):
         self.cell_size = 0  # in bits
         mx = self.cell
         self.reverse = reverse
+        # banned addresses, heap of (release round, addr)
         self.ban = []
+        self.rounds = 0
         while mx:
             mx >>= 8
             self.cell_size += 1
@@ -180,52 +191,51 @@ class AddrPool(object):
 
     def alloc(self):
         with self.lock:
-            # gc self.ban:
-            for item in tuple(self.ban):
-                if item['counter'] == 0:
-                    self.free(item['addr'])
-                    self.ban.remove(item)
+            # gc self.ban: the heap top is the first address to
+            # release, so there is no need to walk the whole list
+            self.rounds += 1
+            while self.ban and self.ban[0][0] <= self.rounds:
+                self.free(heapq.heappop(self.ban)[1])
+
+            while True:
+                # iterate through addr_map
+                base = 0
+                for cell in self.addr_map:
+                    if cell:
+                        # not allocated addr
+                        bit = 0
+                        while True:
+                            if (1 << bit) & self.addr_map[base]:
+                                self.addr_map[base] ^= 1 << bit
+                                break
+                            bit += 1
+                        ret = (base * self.cell_size + bit)
+
+                        if self.reverse:
+                            ret = self.maxaddr - ret
+                        else:
+                            ret = ret + self.minaddr
+
+                        if self.minaddr <= ret <= self.maxaddr:
+                            return ret
+                        else:
+                            self.free(ret)
+                            raise KeyError('no free address available')
+
+                    base += 1
+                # no free address available
+                if len(self.addr_map) < self.cells:
+                    # create new cell to allocate address from
+                    self.addr_map.append(self.cell)
                 else:
-                    item['counter'] -= 1
-
-            # iterate through addr_map
-            base = 0
-            for cell in self.addr_map:
-                if cell:
-                    # not allocated addr
-                    bit = 0
-                    while True:
-                        if (1 << bit) & self.addr_map[base]:
-                            self.addr_map[base] ^= 1 << bit
-                            break
-                        bit += 1
-                    ret = (base * self.cell_size + bit)
-
-                    if self.reverse:
-                        ret = self.maxaddr - ret
-                    else:
-                        ret = ret + self.minaddr
-
-                    if self.minaddr <= ret <= self.maxaddr:
-                        return ret
-                    else:
-                        self.free(ret)
-                        raise KeyError('no free address available')
-
-                base += 1
-            # no free address available
-            if len(self.addr_map) < self.cells:
-                # create new cell to allocate address from
-                self.addr_map.append(self.cell)
-                return self.alloc()
-            else:
-                raise KeyError('no free address available')
+                    raise KeyError('no free address available')
 
     def free(self, addr, ban=0):
         with self.lock:
             if ban != 0:
-                self.ban.append({'addr': addr,
-                                 'counter': ban})
+                # the address will be released on the ban + 1
+                # alloc() round from now
+                heapq.heappush(self.ban, (self.rounds + ban + 1, addr))
             else:
                 if self.reverse:
                     addr = self.maxaddr - addr
@@ -238,3 +248,45 @@ class AddrPool(object):
                 if self.addr_map[base] & (1 << bit):
                     raise KeyError('address is not allocated')
                 self.addr_map[base] ^= 1 << bit
+
+
+class LRUCache(object):
+    '''
+    Thread-safe dictionary-like cache, that keeps no more than
+    `maxsize` items, dropping least recently used ones.
+    '''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
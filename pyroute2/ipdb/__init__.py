@@ -225,6 +225,25 @@ context managers::
 On exit, the context manager will authomatically `commit()` the
 transaction.
 
+batch commit
+------------
+
+Every `commit()` waits for the kernel response, so it takes a
+while to reconfigure hundreds of interfaces one by one. IPDB can
+commit transactions of many interfaces and routes at once: the
+requests are sent as one pipelined batch, and the state is
+checked for all the objects together::
+
+    for name in vlans:
+        ip.interfaces[name].begin()
+        ip.interfaces[name].mtu = 1400
+        ip.interfaces[name].add_ip('10.0.%i.1/24' % (vlans[name]))
+    ip.commit()
+
+If any request fails, all the involved objects are rolled back.
+Interface creation and removal are not batched, commit such
+interfaces one by one.
+
 interface creation
 ------------------
 
@@ -281,6 +300,16 @@ To access and change the routes, one can use notations as follows::
     # list automatic routes keys
     print(ip.routes.tables[255].keys())
 
+Routes can be looked up by an address or a network with
+the longest prefix match, without netlink requests::
+
+    # the route to be used for 10.1.2.3 in the table 254
+    print(ip.routes.lookup('10.1.2.3'))
+
+    # routes, that cover the network, and routes within it
+    print(ip.routes.covering('10.1.2.0/24', table=100))
+    print(ip.routes.covered('10.0.0.0/8'))
+
 
 performance issues
 ------------------
@@ -297,23 +326,71 @@ classes
 -------
 '''
 import sys
+import time
 import atexit
 import logging
 import traceback
 import threading
+try:
+    from Queue import Queue
+    from Queue import Empty
+    from Queue import Full
+except ImportError:
+    from queue import Queue
+    from queue import Empty
+    from queue import Full
 
 from socket import AF_INET
 from socket import AF_INET6
 from pyroute2.common import Dotkeys
 from pyroute2.iproute import IPRoute
+from pyroute2.netlink import NetlinkError
+from pyroute2.netlink import NLM_F_ECHO
+from pyroute2.netlink import NLM_F_REQUEST
 from pyroute2.netlink.rtnl import RTM_GETLINK
+from pyroute2.netlink.rtnl import RTM_NEWLINK
+from pyroute2.netlink.rtnl import RTM_NEWROUTE
+from pyroute2.netlink.rtnl import RTM_DELROUTE
+from pyroute2.netlink.rtnl import RTNL_GROUPS
+from pyroute2.netlink.rtnl import RTNLGRP_LINK
+from pyroute2.netlink.rtnl import RTNLGRP_NEIGH
+from pyroute2.netlink.rtnl import RTNLGRP_IPV4_IFADDR
+from pyroute2.netlink.rtnl import RTNLGRP_IPV6_IFADDR
+from pyroute2.netlink.rtnl import RTNLGRP_IPV4_ROUTE
+from pyroute2.netlink.rtnl import RTNLGRP_IPV6_ROUTE
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+from pyroute2.netlink.rtnl.ifinfmsg import ifinflean
+from pyroute2.ipdb.common import BATCH_PORTS
+from pyroute2.ipdb.common import BATCH_LINKS
+from pyroute2.ipdb.common import BATCH_ROUTES
 from pyroute2.ipdb.common import CreateException
+from pyroute2.ipdb.interface import _BARRIER
 from pyroute2.ipdb.interface import Interface
 from pyroute2.ipdb.linkedset import LinkedSet
 from pyroute2.ipdb.linkedset import IPaddrSet
 from pyroute2.ipdb.common import compat
 from pyroute2.ipdb.common import SYNC_TIMEOUT
+from pyroute2.ipdb.route import Route
 from pyroute2.ipdb.route import RoutingTables
+from pyroute2.ipdb.route import proxy_route_filter
+
+# objects, that IPDB can maintain, and their multicast groups
+OBJECTS = ('links', 'ipaddr', 'neighbors', 'routes')
+OBJECT_GROUPS = {'links': RTNLGRP_LINK,
+                 'ipaddr': RTNLGRP_IPV4_IFADDR | RTNLGRP_IPV6_IFADDR,
+                 'neighbors': RTNLGRP_NEIGH,
+                 'routes': RTNLGRP_IPV4_ROUTE | RTNLGRP_IPV6_ROUTE}
+
+# events of objects; neighbors and routes events are
+# deferred while the table is being loaded, see initdb()
+EVENT_OBJECTS = {'RTM_NEWLINK': 'links',
+                 'RTM_DELLINK': 'links',
+                 'RTM_NEWADDR': 'ipaddr',
+                 'RTM_DELADDR': 'ipaddr',
+                 'RTM_NEWNEIGH': 'neighbors',
+                 'RTM_DELNEIGH': 'neighbors',
+                 'RTM_NEWROUTE': 'routes',
+                 'RTM_DELROUTE': 'routes'}
 
 
 def get_addr_nla(msg):
@@ -358,14 +435,242 @@ class Watchdog(object):
             self.event.set()
         self.cb = cb
         # register callback prior to other things
-        self.ipdb.register_callback(self.cb)
+        self.ipdb.register_callback(self.cb, mode='sync')
 
     def wait(self, timeout=SYNC_TIMEOUT):
         self.event.wait(timeout=timeout)
         self.cancel()
 
     def cancel(self):
-        self.ipdb.unregister_callback(self.cb)
+        self.ipdb.unregister_callback(self.cb, mode='sync')
+
+
+class Dump(threading.Thread):
+    '''
+    Run a dump in a separate thread and stream messages by
+    chunks through a bounded queue, see `IPDB.initdb()`::
+
+        dump = Dump(IPRoute(), 'iter_routes', close=True)
+        dump.start()
+        for chunk in dump:
+            ...
+
+    The iteration raises the dump exception, if any. With
+    `close=True` the socket is closed, when the dump ends.
+
+    The kernel runs only one dump at a time per socket, so
+    dumps on a shared socket must not overlap: with `after`
+    the dump starts only when the `after` dump thread exits.
+    '''
+
+    def __init__(self, nl, method, kwarg=None, close=False,
+                 chunk=1024, depth=16, after=None):
+        threading.Thread.__init__(self, name='IPDB dump %s' % (method))
+        self.setDaemon(True)
+        self.nl = nl
+        self.method = method
+        self.kwarg = kwarg or {}
+        self.close = close
+        self.chunk = chunk
+        self.after = after
+        self.queue = Queue(maxsize=depth)
+        self.stopped = threading.Event()
+
+    def put(self, item):
+        # do not block forever, if the consumer has gone
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def run(self):
+        if self.after is not None:
+            while self.after.is_alive():
+                if self.stopped.is_set():
+                    return
+                self.after.join(0.1)
+            if self.stopped.is_set():
+                return
+        msgs = getattr(self.nl, self.method)(**self.kwarg)
+        chunk = []
+        try:
+            for msg in msgs:
+                chunk.append(msg)
+                if len(chunk) >= self.chunk:
+                    if not self.put(chunk):
+                        return
+                    chunk = []
+            if not chunk or self.put(chunk):
+                self.put(None)
+        except Exception as e:
+            self.put(e)
+        finally:
+            # close the socket first, so the generator
+            # will not drain the rest of the dump
+            if self.close:
+                self.nl.close()
+            msgs.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def __iter__(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except Empty:
+                if self.stopped.is_set():
+                    return
+                continue
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def object_key(msg):
+    '''
+    Get the key of the object, described by a message: the
+    interface index for links, addresses and neighbors, and
+    the table and the destination for routes
+    '''
+    if msg.get('event', None) in ('RTM_NEWROUTE', 'RTM_DELROUTE'):
+        return (msg.get('table', None),
+                msg.get_attr('RTA_DST', None),
+                msg.get('dst_len', None))
+    return msg.get('index', msg.get('ifindex', None))
+
+
+class CallbackPool(object):
+    '''
+    A bounded pool of threads to run IPDB post-callbacks,
+    see `IPDB.register_callback()`.
+
+    Each worker has its own bounded queue. A callback and a
+    message are dispatched to a worker by the callback and
+    the message object key, so one callback gets messages
+    of one object in the order they arrive. When the queue
+    is full, `submit()` blocks.
+
+    `stats()` returns the pool metrics: current and max
+    queue depth, counters and the callback latency -- the
+    time spent in the queue (wait) and in the callback (run),
+    in seconds.
+    '''
+
+    def __init__(self, workers=4, depth=1024):
+        if workers < 1 or depth < 1:
+            raise ValueError('workers and depth must be positive')
+        self.queues = [Queue(maxsize=depth) for _ in range(workers)]
+        self.threads = []
+        self.stopped = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {'max_depth': 0,
+                       'submitted': 0,
+                       'processed': 0,
+                       'dropped': 0,
+                       'errors': 0,
+                       'blocked': 0,
+                       'wait_total': 0.0,
+                       'wait_max': 0.0,
+                       'run_total': 0.0,
+                       'run_max': 0.0}
+        for queue in self.queues:
+            t = threading.Thread(target=self.worker,
+                                 args=(queue, ),
+                                 name='IPDB callback worker')
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, callback, ipdb, msg):
+        queue = self.queues[hash((id(callback), object_key(msg))) %
+                            len(self.queues)]
+        item = (callback, ipdb, msg, time.time())
+        try:
+            queue.put_nowait(item)
+        except Full:
+            # backpressure: block the caller until there is
+            # a slot in the queue
+            with self._stats_lock:
+                self._stats['blocked'] += 1
+            while not self.stopped.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    break
+                except Full:
+                    pass
+            else:
+                return False
+        with self._stats_lock:
+            self._stats['submitted'] += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'],
+                                           queue.qsize())
+        return True
+
+    def worker(self, queue):
+        while True:
+            # a full queue gets no sentinel, see stop()
+            if self.stopped.is_set() and queue.empty():
+                return
+            item = queue.get()
+            if item is None:
+                return
+            (callback, ipdb, msg, stamp) = item
+            if not getattr(callback, 'active', True):
+                # the callback is unregistered
+                with self._stats_lock:
+                    self._stats['dropped'] += 1
+                continue
+            start = time.time()
+            error = False
+            try:
+                callback(ipdb, msg, msg['event'])
+            except Exception:
+                error = True
+                logging.error('IPDB callback error:\n%s',
+                              traceback.format_exc())
+            end = time.time()
+            with self._stats_lock:
+                self._stats['processed'] += 1
+                self._stats['errors'] += error
+                self._stats['wait_total'] += start - stamp
+                self._stats['wait_max'] = max(self._stats['wait_max'],
+                                              start - stamp)
+                self._stats['run_total'] += end - start
+                self._stats['run_max'] = max(self._stats['run_max'],
+                                             end - start)
+
+    def is_worker(self):
+        return threading.current_thread() in self.threads
+
+    def stats(self):
+        with self._stats_lock:
+            ret = dict(self._stats)
+        ret['workers'] = len(self.queues)
+        ret['depth'] = sum([x.qsize() for x in self.queues])
+        return ret
+
+    def stop(self):
+        '''
+        Stop workers, when they process queued callbacks
+        '''
+        self.stopped.set()
+        for queue in self.queues:
+            # do not block: stop() can be called from a callback,
+            # and then the worker of a full queue is the caller;
+            # workers of full queues stop, when the queue is empty
+            try:
+                queue.put_nowait(None)
+            except Full:
+                pass
+        for t in self.threads:
+            if t is not threading.current_thread():
+                t.join()
 
 
 class IPDB(object):
@@ -376,28 +681,79 @@ class IPDB(object):
     '''
 
     def __init__(self, nl=None, mode='implicit',
-                 restart_on_error=None):
+                 restart_on_error=None, lean=False,
+                 objects=OBJECTS, route_tables=None,
+                 cb_workers=4, cb_queue=1024):
         '''
         Parameters:
             * nl -- IPRoute() reference
             * mode -- (implicit, explicit, direct)
             * iclass -- the interface class type
+            * lean -- use lean link decoding
+            * objects -- objects to maintain, see below
+            * route_tables -- route tables to maintain, see below
+            * cb_workers -- post-callback threads
+            * cb_queue -- post-callback queue size per thread
 
         If you do not provide iproute instance, ipdb will
         start it automatically.
+
+        Interfaces do not keep statistics and IFLA_AF_SPEC
+        data anyway, so with `lean=True` links are dumped
+        without statistics, and IFLA_AF_SPEC is not decoded
+        both in dumps and in RTM_NEWLINK events; callbacks get
+        it as raw bytes. See `IPRoute.get_links()`.
+
+        By default IPDB maintains all the objects: 'links',
+        'ipaddr', 'neighbors' and 'routes'. With `objects` one
+        can select only required ones; the rest are not loaded,
+        and the socket is not subscribed to their multicast
+        groups, so their events do not reach IPDB at all::
+
+            # interfaces and addresses only
+            ipdb = IPDB(objects=('links', 'ipaddr'))
+
+        Addresses and neighbors require links. The routes can be
+        limited to some tables with `route_tables`; events and
+        dumps of other tables are dropped before they are
+        decoded::
+
+            ipdb = IPDB(route_tables=(254, 100))
+
+        Responses to requests on `ipdb.nl` are not filtered, so
+        e.g. `ipdb.nl.get_routes()` returns all the routes. A
+        socket passed in `nl` is never changed: there routes of
+        other tables are decoded, and then ignored.
+
+        Post-callbacks run in a pool of `cb_workers` threads,
+        see `register_callback()`.
         '''
+        objects = tuple(objects)
+        for name in objects:
+            if name not in OBJECTS:
+                raise ValueError('unknown object %s' % (name))
+        if 'links' not in objects and \
+                ('ipaddr' in objects or 'neighbors' in objects):
+            raise ValueError('ipaddr and neighbors require links')
+        self.objects = objects
+        self.route_tables = None if route_tables is None else \
+            set(route_tables)
         self.mode = mode
+        self.lean = lean
         self.iclass = Interface
         self._stop = False
         # see also 'register_callback'
         self._post_callbacks = []
         self._pre_callbacks = []
-        self._cb_threads = set()
+        self._sync_callbacks = []
+        self.workers = CallbackPool(cb_workers, cb_queue)
 
         # locks and events
         self._links_event = threading.Event()
         self.exclusive = threading.RLock()
         self._shutdown_lock = threading.Lock()
+        self._dumps = {}
+        self._loaders = []
 
         # load information
         self.restart_on_error = restart_on_error if \
@@ -422,10 +778,46 @@ class IPDB(object):
         '''
         Restart IPRoute channel, and create all the DB
         from scratch. Can be used when sync is lost.
+
+        All the dumps run concurrently, each on a separate
+        socket, if `nl` is an IPRoute instance. Other sockets,
+        like NetNS, are shared by the dumps, and the kernel
+        allows only one dump at a time per socket, so there
+        the dumps run one by one. Messages are streamed by
+        chunks and loaded as they arrive.
+
+        Links and addresses are loaded before the call
+        returns, neighbors and routes -- in the background.
+        Events for them are deferred until the corresponding
+        dump is loaded. Readiness events are in `ipdb.ready`::
+
+            ipdb = IPDB()
+            ipdb.ready.routes.wait()
+
+        Route lookups in `ipdb.routes` wait for the routes
+        dump implicitly.
         '''
+        # stop loaders of the previous run, if any
+        self._stop_loaders()
         self.nl = nl or IPRoute()
         self.nl.monitor = True
-        self.nl.bind(async=True)
+        if set(self.objects) == set(OBJECTS):
+            groups = RTNL_GROUPS
+        else:
+            groups = 0
+            for name in self.objects:
+                groups |= OBJECT_GROUPS[name]
+        self.nl.bind(groups, async=True)
+        if nl is None:
+            # IPDB's own socket serves user requests as well,
+            # so filter only events there
+            self._filter_routes(self.nl, events=True)
+        if self.lean:
+            # the marshal map is shared by sockets of one class,
+            # so replace it with a private copy
+            msg_map = dict(self.nl.marshal.msg_map)
+            msg_map[RTM_NEWLINK] = ifinflean
+            self.nl.marshal.msg_map = msg_map
 
         # resolvers
         self.interfaces = Dotkeys()
@@ -436,17 +828,107 @@ class IPDB(object):
         # caches
         self.ipaddr = {}
         self.neighbors = {}
+        # port index -> master index, see update_slaves()
+        self._masters = {}
+
+        # readiness events and deferred events
+        self.ready = Dotkeys([(x, threading.Event()) for x in OBJECTS])
+        self._deferred = {'neighbors': [],
+                          'routes': []}
+
+        # start the dumps: at once on separate sockets, or
+        # one by one on the shared one
+        self._dumps = {}
+        previous = None
+        for (name, method, kwarg) in (('links', 'iter_links',
+                                       {'lean': self.lean}),
+                                      ('ipaddr', 'iter_addr', {}),
+                                      ('neighbors', 'iter_neighbors', {}),
+                                      ('routes', 'iter_routes', {})):
+            if name not in self.objects:
+                # nothing to load
+                self.ready[name].set()
+                continue
+            if isinstance(self.nl, IPRoute):
+                nl = IPRoute()
+                self._filter_routes(nl)
+                dump = Dump(nl, method, kwarg, close=True)
+            else:
+                dump = Dump(self.nl, method, kwarg, after=previous)
+            self._dumps[name] = dump
+            dump.start()
+            previous = dump
 
-        # load information
-        links = self.nl.get_links()
-        for link in links:
-            self.device_put(link, skip_slaves=True)
-        for link in links:
-            self.update_slaves(link)
-        self.update_addr(self.nl.get_addr())
-        self.update_neighbors(self.nl.get_neighbors())
-        routes = self.nl.get_routes()
-        self.update_routes(routes)
+        # load information: links and addresses
+        try:
+            links = []
+            for chunk in self._dumps.get('links', ()):
+                with self.exclusive:
+                    for link in chunk:
+                        self.device_put(link, skip_slaves=True)
+                links.extend(chunk)
+            with self.exclusive:
+                for link in links:
+                    self.update_slaves(link)
+            self.ready.links.set()
+            for chunk in self._dumps.get('ipaddr', ()):
+                with self.exclusive:
+                    self.update_addr(chunk)
+            self.ready.ipaddr.set()
+        except:
+            self._stop_loaders()
+            raise
+
+        # neighbors and routes are loaded in the background
+        for (name, method) in (('neighbors', self.update_neighbors),
+                               ('routes', self.update_routes)):
+            if name not in self._dumps:
+                continue
+            t = threading.Thread(target=self._load,
+                                 name='IPDB load %s' % (name),
+                                 args=(name, self._dumps[name], method,
+                                       self._deferred[name],
+                                       self.ready[name]))
+            t.setDaemon(True)
+            t.start()
+            self._loaders.append(t)
+
+    def _filter_routes(self, nl, events=False):
+        # drop routes of not maintained tables before they
+        # are decoded, see proxy_route_filter()
+        if self.route_tables is not None and \
+                getattr(nl, '_rproxy', None) is not None:
+            route_filter = proxy_route_filter(self.route_tables, events)
+            nl._rproxy.pmap[RTM_NEWROUTE] = route_filter
+            nl._rproxy.pmap[RTM_DELROUTE] = route_filter
+
+    def _load(self, name, dump, method, deferred, ready):
+        # background loader, see initdb()
+        try:
+            for chunk in dump:
+                if self._stop:
+                    break
+                with self.exclusive:
+                    method(chunk)
+        except Exception:
+            logging.error('IPDB %s dump failed:\n%s',
+                          name, traceback.format_exc())
+        finally:
+            with self.exclusive:
+                # do not touch the DB, if it is restarted
+                if not dump.stopped.is_set():
+                    for msg in deferred:
+                        self.load_netlink(msg)
+                dump.stop()
+                del deferred[:]
+                ready.set()
+
+    def _stop_loaders(self):
+        for dump in self._dumps.values():
+            dump.stop()
+        for t in self._loaders:
+            t.join()
+        self._loaders = []
 
     def register_callback(self, callback, mode='post'):
         '''
@@ -463,10 +945,18 @@ class IPDB(object):
         of the IP database.
 
         "Post" callbacks are executed asynchronously in
-        separate threads. These threads can work as long
-        as you want them to. Callback threads are joined
-        occasionally, so for a short time there can exist
-        stopped threads.
+        a pool of worker threads, see `IPDB(cb_workers=...)`
+        and `ipdb.workers.stats()`. A callback never runs
+        concurrently with itself, and it gets messages of one
+        object (an interface or a route) in the order they
+        arrive. Messages of different objects can be passed to
+        it in a different order.
+
+        A callback occupies a worker while it runs, so long
+        running jobs should be started in separate threads.
+        When the worker queue is full, the IPDB main loop
+        waits for it, and the netlink messages are buffered
+        in the socket.
 
         ...
 
@@ -476,6 +966,11 @@ class IPDB(object):
         places a restriction: until the callback exits, the
         main event IPDB loop is blocked.
 
+        "Sync" callbacks are executed in the main loop as well,
+        but after the message is processed, like "post" ones.
+        They are to be short and must not wait for IPDB; e.g.,
+        watchdogs are "sync" callbacks.
+
         Normally, only "post" callbacks are required. But in
         some specific cases "pre" also can be useful.
 
@@ -483,7 +978,8 @@ class IPDB(object):
 
         The routine, `register_callback()`, takes two arguments:
         1. callback function
-        2. mode (optional, default="post")
+        2. mode (optional, "post", "pre" or "sync",
+           default="post")
 
         The callback should be a routine, that accepts three
         arguments::
@@ -509,22 +1005,32 @@ class IPDB(object):
                 callback(*argv, **kwarg)
 
         safe.hook = callback
+        safe.lock = lock
+        safe.active = True
         if mode == 'post':
             self._post_callbacks.append(safe)
         elif mode == 'pre':
             self._pre_callbacks.append(safe)
+        elif mode == 'sync':
+            self._sync_callbacks.append(safe)
 
     def unregister_callback(self, callback, mode='post'):
         if mode == 'post':
             cbchain = self._post_callbacks
         elif mode == 'pre':
             cbchain = self._pre_callbacks
+        elif mode == 'sync':
+            cbchain = self._sync_callbacks
         else:
             raise KeyError('Unknown callback mode')
         for cb in tuple(cbchain):
             if callback == cb.hook:
-                for t in tuple(self._cb_threads):
-                    t.join(3)
+                # drop queued calls and wait for the running
+                # one, unless it is called from a callback
+                cb.active = False
+                if mode == 'post' and not self.workers.is_worker():
+                    with cb.lock:
+                        pass
                 return cbchain.pop(cbchain.index(cb))
 
     def release(self):
@@ -544,6 +1050,7 @@ class IPDB(object):
                 return
 
             self._stop = True
+            self._stop_loaders()
             try:
                 self.nl.put({'index': 1}, RTM_GETLINK)
                 self._mthread.join()
@@ -552,6 +1059,7 @@ class IPDB(object):
                 # It is possible when the instance gets stopped
                 # by atexit chain
                 self._mthread.setDaemon(True)
+            self.workers.stop()
             self.nl.close()
 
     def create(self, kind, ifname, reuse=False, **kwarg):
@@ -635,6 +1143,143 @@ class IPDB(object):
             device.begin()
             return device
 
+    def commit(self, objects=None, window=256):
+        '''
+        Commit transactions of many interfaces and routes at
+        once. Requests of all the objects are sent as one
+        pipelined batch, see `IPRoute.nlm_request_batch()`,
+        the kernel echo is applied at once, and all the targets
+        are checked together::
+
+            for name in vlans:
+                ip.interfaces[name].begin()
+                ip.interfaces[name].mtu = 1400
+            ip.commit()
+
+        * objects -- interfaces and routes to commit; by default
+          all the objects with a transaction, opened in the
+          current thread
+        * window -- how many requests can wait for ACK at once
+
+        The last transaction of every object is committed. If
+        any request fails, or some target is not reached, all
+        the objects are rolled back, and the exception is raised
+        with the list of transactions in `transactions`.
+
+        Interface creation, removal, and moving to another
+        network namespace are not batched: ValueError is raised
+        prior to any request, use the object's `commit()` then.
+        '''
+        if objects is None:
+            objects = list(self.by_index.values())
+            for table in tuple(self.routes.tables.values()):
+                objects.extend(table.values())
+
+        # 1. collect transactions and requests; routes are not
+        # hashable, so objects are tracked by id
+        batch = []
+        plan = []
+        seen = set()
+        routes = []
+        for obj in objects:
+            if id(obj) in seen or not obj._tids:
+                continue
+            seen.add(id(obj))
+            transaction = obj.last()
+            snapshot = obj.pick()
+            batch.append((obj, transaction, snapshot, obj._exists))
+            requests = obj._batch(transaction, snapshot)
+            for (phase, request, ignore) in requests:
+                plan.append((phase, len(plan), request, ignore))
+            if requests and isinstance(obj, Route):
+                routes.append(obj)
+        if not batch:
+            return self
+        # sort by phase, keeping the order of objects
+        plan.sort(key=lambda x: x[:2])
+        # all the objects are validated, so only now reset the
+        # route load events: the kernel echo sets them again
+        for route in routes:
+            route._load_event.clear()
+
+        # 2. send all the requests; on the first error go on,
+        # since the window is sent already, but the rest of
+        # the kernel state is required for the rollback
+        error = None
+        reload = set()
+        reload_addr = False
+        requests = [(msg, msg_type, msg_flags | NLM_F_ECHO)
+                    for (_, _, (msg, msg_type, msg_flags), _) in plan]
+        try:
+            results = self.nl.nlm_request_batch(requests, window)
+            for (step, (msg, result)) in enumerate(results):
+                (phase, _, _, ignore) = plan[step]
+                if isinstance(result, NetlinkError):
+                    if result.code not in ignore and error is None:
+                        error = result
+                elif result:
+                    for response in result:
+                        self.load_netlink(response)
+                elif phase in (BATCH_PORTS, BATCH_LINKS):
+                    reload.add(msg['index'])
+                elif phase != BATCH_ROUTES:
+                    reload_addr = True
+        except Exception as e:
+            error = e
+
+        # 3. reload objects, that the kernel doesn't echo
+        for (obj, transaction, snapshot, exists) in batch:
+            if isinstance(obj, Interface) and transaction._targets:
+                reload.add(obj['index'])
+        if reload:
+            requests = []
+            for index in reload:
+                msg = ifinfmsg()
+                msg['index'] = index
+                requests.append((msg, RTM_GETLINK, NLM_F_REQUEST))
+            for (msg, result) in self.nl.nlm_request_batch(requests,
+                                                           window):
+                if not isinstance(result, NetlinkError):
+                    for response in result:
+                        self.load_netlink(response)
+        if reload_addr:
+            for response in self.nl.get_addr():
+                self.load_netlink(response)
+
+        # 4. check targets
+        if error is None:
+            deadline = time.time() + SYNC_TIMEOUT
+            try:
+                for (obj, transaction, snapshot, exists) in batch:
+                    obj._batch_check(transaction, snapshot, deadline)
+            except Exception as e:
+                error = e
+
+        # 5. roll back all the objects
+        if error is not None:
+            failure = None
+            for (obj, transaction, snapshot, exists) in batch:
+                try:
+                    ret = obj._batch_rollback(snapshot, exists)
+                except Exception as e:
+                    ret = e
+                if isinstance(ret, Exception) and failure is None:
+                    failure = ret
+            # the rollback error substitutes the initial one,
+            # see Interface.commit()
+            error = failure or error
+
+        for (obj, transaction, snapshot, exists) in batch:
+            obj.drop(transaction)
+
+        if error is not None:
+            error.transactions = [x[1] for x in batch]
+            raise error
+
+        if reload or reload_addr:
+            time.sleep(_BARRIER)
+        return self
+
     def device_del(self, msg):
         # check for flicker devices
         if (msg.get('index', None) in self.interfaces) and \
@@ -653,6 +1298,7 @@ class IPDB(object):
                 del self.interfaces[msg['index']]
                 del self.ipaddr[msg['index']]
                 del self.neighbors[msg['index']]
+                self._masters.pop(msg['index'], None)
         except KeyError:
             pass
 
@@ -727,14 +1373,37 @@ class IPDB(object):
     def watchdog(self, action='RTM_NEWLINK', **kwarg):
         return Watchdog(self, action, kwarg)
 
-    def update_routes(self, routes):
+    def update_routes(self, routes, action='add'):
         for msg in routes:
-            self.routes.load_netlink(msg)
+            if self.route_tables is not None and \
+                    (msg.get_attr('RTA_TABLE') or
+                     msg.get('table', 254)) not in self.route_tables:
+                continue
+            if action == 'add':
+                self.routes.load_netlink(msg)
+            else:
+                self.routes.unload_netlink(msg)
 
     def _lookup_master(self, msg):
         master = msg.get_attr('IFLA_MASTER')
         return self.interfaces.get(master, None)
 
+    def _add_port(self, master, index):
+        master.add_port(index, direct=True)
+        self._masters[index] = master['index']
+
+    def _del_port(self, master, index):
+        master.del_port(index, direct=True)
+        if self._masters.get(index, None) == master['index']:
+            del self._masters[index]
+
+    def _port_master(self, index):
+        # get the interface, that has the port in `ports`
+        master = self.interfaces.get(self._masters.get(index, None), None)
+        if master is not None and index in master['ports']:
+            return master
+        return None
+
     def update_slaves(self, msg):
         # Update slaves list -- only after update IPDB!
 
@@ -750,31 +1419,29 @@ class IPDB(object):
                 # no 'RTM_DELLINK', only 'RTM_NEWLINK', and
                 # we can end up in a broken state, when two
                 # masters refers to the same slave
-                for device in self.by_index:
-                    if index in self.interfaces[device]['ports']:
-                        self.interfaces[device].del_port(index,
-                                                         direct=True)
-                master.add_port(index, direct=True)
+                current = self._port_master(index)
+                if current is not None and current is not master:
+                    self._del_port(current, index)
+                self._add_port(master, index)
             elif msg['event'] == 'RTM_DELLINK':
                 if index in master['ports']:
-                    master.del_port(index, direct=True)
+                    self._del_port(master, index)
         # there is NO masters for the interface, clean them if any
         else:
             device = self.interfaces[msg['index']]
 
             # clean device from ports
-            for master in self.by_index:
-                if index in self.interfaces[master]['ports']:
-                    self.interfaces[master].del_port(index,
-                                                     direct=True)
+            current = self._port_master(index)
+            if current is not None:
+                self._del_port(current, index)
             master = device.if_master
             if master is not None:
                 if 'master' in device:
                     device.del_item('master')
                 if (master in self.interfaces) and \
                         (msg['index'] in self.interfaces[master].ports):
-                    self.interfaces[master].del_port(msg['index'],
-                                                     direct=True)
+                    self._del_port(self.interfaces[master],
+                                   msg['index'])
 
     def update_addr(self, addrs, action='add'):
         # Update address list of an interface.
@@ -799,6 +1466,34 @@ class IPDB(object):
                 except:
                     pass
 
+    def load_netlink(self, msg):
+        '''
+        Apply a RTM_NEW*/RTM_DEL* message to the database. It is
+        used by the monitoring cycle, and by commits to apply the
+        kernel echo (NLM_F_ECHO) without waiting for broadcasts.
+        '''
+        event = msg.get('event', None)
+        if EVENT_OBJECTS.get(event) not in self.objects:
+            return
+        with self.exclusive:
+            if event == 'RTM_NEWLINK':
+                self.device_put(msg)
+                self._links_event.set()
+            elif event == 'RTM_DELLINK':
+                self.device_del(msg)
+            elif event == 'RTM_NEWADDR':
+                self.update_addr([msg], 'add')
+            elif event == 'RTM_DELADDR':
+                self.update_addr([msg], 'remove')
+            elif event == 'RTM_NEWNEIGH':
+                self.update_neighbors([msg], 'add')
+            elif event == 'RTM_DELNEIGH':
+                self.update_neighbors([msg], 'remove')
+            elif event == 'RTM_NEWROUTE':
+                self.update_routes([msg], 'add')
+            elif event == 'RTM_DELROUTE':
+                self.update_routes([msg], 'remove')
+
     def serve_forever(self):
         '''
         Main monitoring cycle. It gets messages from the
@@ -838,46 +1533,23 @@ class IPDB(object):
                         pass
 
                 with self.exclusive:
-                    if msg.get('event', None) == 'RTM_NEWLINK':
-                        self.device_put(msg)
-                        self._links_event.set()
-                    elif msg.get('event', None) == 'RTM_DELLINK':
-                        self.device_del(msg)
-                    elif msg.get('event', None) == 'RTM_NEWADDR':
-                        self.update_addr([msg], 'add')
-                    elif msg.get('event', None) == 'RTM_DELADDR':
-                        self.update_addr([msg], 'remove')
-                    elif msg.get('event', None) == 'RTM_NEWNEIGH':
-                        self.update_neighbors([msg], 'add')
-                    elif msg.get('event', None) == 'RTM_DELNEIGH':
-                        self.update_neighbors([msg], 'remove')
-                    elif msg.get('event', None) == 'RTM_NEWROUTE':
-                        self.update_routes([msg])
-                    elif msg.get('event', None) == 'RTM_DELROUTE':
-                        table = msg.get('table', 254)
-                        dst = msg.get_attr('RTA_DST', False)
-                        if not dst:
-                            key = 'default'
-                        else:
-                            key = '%s/%s' % (dst, msg.get('dst_len', 0))
-                        try:
-                            route = self.routes.tables[table][key]
-                            del self.routes.tables[table][key]
-                            route.sync()
-                        except KeyError:
-                            pass
+                    table = EVENT_OBJECTS.get(msg.get('event', None))
+                    if table in self._deferred and \
+                            not self.ready[table].is_set():
+                        # the table is being loaded, see initdb()
+                        self._deferred[table].append(msg)
+                    else:
+                        self.load_netlink(msg)
+
+                # run sync callbacks
+                for cb in tuple(self._sync_callbacks):
+                    try:
+                        cb(self, msg, msg['event'])
+                    except:
+                        pass
 
                 # run post-callbacks
-                # NOTE: post-callbacks are asynchronous
-                for cb in self._post_callbacks:
-                    t = threading.Thread(name="callback %s" % (id(cb)),
-                                         target=cb,
-                                         args=(self, msg, msg['event']))
-                    t.start()
-                    self._cb_threads.add(t)
-
-                # occasionally join cb threads
-                for t in tuple(self._cb_threads):
-                    t.join(0)
-                    if not t.is_alive():
-                        self._cb_threads.remove(t)
+                # NOTE: post-callbacks are asynchronous, the
+                # pool blocks when the queue is full
+                for cb in tuple(self._post_callbacks):
+                    self.workers.submit(cb, self, msg)
@@ -1,9 +1,39 @@
 import time
+import threading
 from pyroute2.common import ANCIENT
 from pyroute2.netlink import NetlinkError
 # How long should we wait on EACH commit() checkpoint: for ipaddr,
 # ports etc. That's not total commit() timeout.
 SYNC_TIMEOUT = 5
+# Request phases of the `IPDB.commit()` batch; requests of all the
+# objects are sent phase by phase, in this order
+BATCH_PORTS = 0
+BATCH_LINKS = 1
+BATCH_DELADDR = 2
+BATCH_ADDADDR = 3
+BATCH_ROUTES = 4
+
+
+# guards the creation of lazy attributes, see lazy()
+_lazy_lock = threading.RLock()
+
+
+def lazy(name, factory):
+    '''
+    Return a property, that creates the attribute with
+    `factory(obj)` on the first access and keeps it as `name`.
+    Used for locks, events and thread local storage, that are
+    not needed by most of snapshots.
+    '''
+    def get(self):
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            with _lazy_lock:
+                if name not in self.__dict__:
+                    self.__dict__[name] = factory(self)
+                return self.__dict__[name]
+    return property(get)
 
 
 class DeprecationException(Exception):
@@ -12,12 +12,43 @@ from pyroute2.ipdb.transactional import Transactional
 from pyroute2.ipdb.transactional import update
 from pyroute2.ipdb.linkedset import LinkedSet
 from pyroute2.ipdb.linkedset import IPaddrSet
+from pyroute2.ipdb.common import BATCH_PORTS
+from pyroute2.ipdb.common import BATCH_LINKS
+from pyroute2.ipdb.common import BATCH_DELADDR
+from pyroute2.ipdb.common import BATCH_ADDADDR
 from pyroute2.ipdb.common import CommitException
 from pyroute2.ipdb.common import SYNC_TIMEOUT
 from pyroute2.ipdb.common import compat
+from pyroute2.ipdb.common import lazy
 
 _BARRIER = 0.2
 
+# interface fields are the same for all the objects, so
+# build them once, see Interface.__init__()
+_VIRTUAL_FIELDS = ('removal', 'flicker', 'state')
+_XFIELDS = {'common': [ifinfmsg.nla2name(i[0]) for i
+                       in ifinfmsg.nla_map]}
+_XFIELDS['common'].append('index')
+_XFIELDS['common'].append('flags')
+_XFIELDS['common'].append('mask')
+_XFIELDS['common'].append('change')
+_XFIELDS['common'].append('kind')
+_XFIELDS['common'].append('peer')
+_XFIELDS['common'].append('vlan_id')
+_XFIELDS['common'].append('bond_mode')
+_XFIELDS['common'].extend([ifinfmsg.ifinfo.bridge_data.nla2name(i[0])
+                           for i in ifinfmsg.ifinfo.bridge_data.nla_map])
+_XFIELDS['common'].extend([ifinfmsg.ifinfo.bond_data.nla2name(i[0])
+                           for i in ifinfmsg.ifinfo.bond_data.nla_map])
+_XFIELDS['common'].extend([ifinfmsg.ifinfo.tuntap_data.nla2name(i[0])
+                           for i in ifinfmsg.ifinfo.tuntap_data.nla_map])
+_FIELDS = []
+for _ftype in _XFIELDS:
+    _FIELDS += _XFIELDS[_ftype]
+_FIELDS.extend(_VIRTUAL_FIELDS)
+_DEFAULTS = dict.fromkeys([i for i in _FIELDS
+                           if i not in ('state', 'change', 'mask')])
+
 
 class Interface(Transactional):
     '''
@@ -41,6 +72,7 @@ class Interface(Transactional):
     will be attached to the exception.
     '''
     _fields_cmp = {'flags': lambda x, y: x & y & IFF_MASK == y & IFF_MASK}
+    _load_event = lazy('_lazy_load_event', lambda x: threading.Event())
 
     def __init__(self, ipdb, mode=None, parent=None, uid=None):
         '''
@@ -63,42 +95,19 @@ class Interface(Transactional):
         self._flicker = False
         self._exception = None
         self._tb = None
-        self._virtual_fields = ('removal', 'flicker', 'state')
-        self._xfields = {'common': [ifinfmsg.nla2name(i[0]) for i
-                                    in ifinfmsg.nla_map]}
-        self._xfields['common'].append('index')
-        self._xfields['common'].append('flags')
-        self._xfields['common'].append('mask')
-        self._xfields['common'].append('change')
-        self._xfields['common'].append('kind')
-        self._xfields['common'].append('peer')
-        self._xfields['common'].append('vlan_id')
-        self._xfields['common'].append('bond_mode')
-        brmsg = ifinfmsg.ifinfo.bridge_data
-        self._xfields['common'].extend([brmsg.nla2name(i[0]) for i
-                                        in brmsg.nla_map])
-        bomsg = ifinfmsg.ifinfo.bond_data
-        self._xfields['common'].extend([bomsg.nla2name(i[0]) for i
-                                        in bomsg.nla_map])
-        tuntap = ifinfmsg.ifinfo.tuntap_data
-        self._xfields['common'].extend([tuntap.nla2name(i[0]) for i
-                                        in tuntap.nla_map])
-        for ftype in self._xfields:
-            self._fields += self._xfields[ftype]
-        self._fields.extend(self._virtual_fields)
-        self._load_event = threading.Event()
+        # shared by all the interfaces, must not be changed
+        self._virtual_fields = _VIRTUAL_FIELDS
+        self._xfields = _XFIELDS
+        self._fields = _FIELDS
         self._linked_sets.add('ipaddr')
         self._linked_sets.add('ports')
         self._freeze = None
         # 8<-----------------------------------
-        # local setup: direct state is required
-        with self._direct_state:
-            self['ipaddr'] = IPaddrSet()
-            self['ports'] = LinkedSet()
-            for i in self._fields:
-                self[i] = None
-            for i in ('state', 'change', 'mask'):
-                del self[i]
+        # local setup: a new object has no targets and
+        # transactions, so set all the defaults at once
+        dict.update(self, _DEFAULTS)
+        dict.update(self, {'ipaddr': IPaddrSet(),
+                           'ports': LinkedSet()})
         # 8<-----------------------------------
 
     def __hash__(self):
@@ -300,6 +309,13 @@ class Interface(Transactional):
                 time.sleep(1)
         return self
 
+    def _echo(self, response):
+        # apply the kernel echo, see NLM_F_ECHO in IPRoute.link();
+        # return False if there was no echo
+        for msg in response:
+            self.ipdb.load_netlink(msg)
+        return len(response) > 0
+
     def filter(self, ftype):
         ret = {}
         for key in self:
@@ -325,6 +341,9 @@ class Interface(Transactional):
                 transaction = self.last()
 
         wd = None
+        # wait for broadcasts to settle, unless all the
+        # changes are confirmed by the kernel echo
+        barrier = False
         with self._write_lock:
             # if the interface does not exist, create it first ;)
             if not self._exists:
@@ -373,6 +392,7 @@ class Interface(Transactional):
 
         if wd is not None:
             wd.wait()
+            barrier = True
 
         # now we have our index and IP set and all other stuff
         snapshot = self.pick()
@@ -383,26 +403,40 @@ class Interface(Transactional):
 
             # 8<---------------------------------------------
             # Interface slaves
+            #
+            # All the requests are sent with NLM_F_ECHO, and
+            # the echoed state is applied at once; objects,
+            # that the kernel doesn't echo, are reloaded
             self['ports'].set_target(transaction['ports'])
+            echoed = set()
 
             for i in removed['ports']:
                 # detach the port
                 port = self.ipdb.interfaces[i]
                 port.set_target('master', None)
                 port.mirror_target('master', 'link')
-                self.nl.link('set', index=port['index'], master=0)
+                if self._echo(self.nl.link('set',
+                                           index=port['index'],
+                                           master=0,
+                                           echo=True)):
+                    echoed.add(i)
 
             for i in added['ports']:
                 # enslave the port
                 port = self.ipdb.interfaces[i]
                 port.set_target('master', self['index'])
                 port.mirror_target('master', 'link')
-                self.nl.link('set',
-                             index=port['index'],
-                             master=self['index'])
+                if self._echo(self.nl.link('set',
+                                           index=port['index'],
+                                           master=self['index'],
+                                           echo=True)):
+                    echoed.add(i)
 
             if removed['ports'] or added['ports']:
-                self.nl.get_links(*(removed['ports'] | added['ports']))
+                ports = (removed['ports'] | added['ports']) - echoed
+                if ports:
+                    self.nl.get_links(*ports)
+                    barrier = True
                 self['ports'].target.wait(SYNC_TIMEOUT)
                 if not self['ports'].target.is_set():
                     raise CommitException('ports target is not set')
@@ -434,9 +468,17 @@ class Interface(Transactional):
             request['index'] = self['index']
 
             # apply changes only if there is something to apply
+            reloaded = False
             if any([request[item] is not None for item in request
                     if item != 'index']):
-                self.nl.link('set', **request)
+                # an interface, moved to another netns, must
+                # be checked with reload(), see below
+                netns = ('net_ns_fd' in request) or \
+                    ('net_ns_pid' in request)
+                reloaded = self._echo(self.nl.link('set',
+                                                   echo=not netns,
+                                                   **request))
+                barrier |= not reloaded
                 # hardcoded pause -- if the interface was moved
                 # across network namespaces
                 if 'net_ns_fd' in request:
@@ -445,6 +487,8 @@ class Interface(Transactional):
             # 8<---------------------------------------------
             # IP address changes
             self['ipaddr'].set_target(transaction['ipaddr'])
+            # are all the address changes echoed
+            addr_echo = True
 
             for i in removed['ipaddr']:
                 # Ignore link-local IPv6 addresses
@@ -454,12 +498,18 @@ class Interface(Transactional):
                 # can be removed. In this case you will fail, but
                 # it is OK, no need to roll back
                 try:
-                    self.nl.addr('delete', self['index'], i[0], i[1])
+                    if not self._echo(self.nl.addr('delete',
+                                                   self['index'],
+                                                   i[0], i[1],
+                                                   echo=True)):
+                        addr_echo = False
                 except NetlinkError as x:
+                    addr_echo = False
                     # bypass only errno 99, 'Cannot assign address'
                     if x.code != 99:
                         raise
                 except socket.error as x:
+                    addr_echo = False
                     # bypass illegal IP requests
                     if not x.args[0].startswith('illegal IP'):
                         raise
@@ -473,8 +523,11 @@ class Interface(Transactional):
                     kwarg = transaction.ipaddr[i]
                 except KeyError:
                     kwarg = None
-                self.nl.addr('add', self['index'], i[0], i[1],
-                             **kwarg if kwarg else {})
+                kwarg = dict(kwarg or {})
+                kwarg['echo'] = True
+                if not self._echo(self.nl.addr('add', self['index'],
+                                               i[0], i[1], **kwarg)):
+                    addr_echo = False
 
                 # 8<--------------------------------------
                 # FIXME: kernel bug, sometimes `addr add` for
@@ -501,6 +554,7 @@ class Interface(Transactional):
                 # 8<--------------------------------------
 
             if removed['ipaddr'] or added['ipaddr']:
+                barrier |= not addr_echo
                 # 8<--------------------------------------
                 # bond and bridge interfaces do not send
                 # IPv6 address updates, when are down
@@ -513,7 +567,11 @@ class Interface(Transactional):
                 #
                 # FIXME: probably, we should handle other
                 # types as well
-                if self['kind'] in ('bond', 'bridge', 'veth'):
+                #
+                # not needed, if the kernel echoed all the
+                # changes
+                if self['kind'] in ('bond', 'bridge', 'veth') and \
+                        not addr_echo:
                     self.nl.get_addr()
                 # 8<--------------------------------------
                 self['ipaddr'].target.wait(SYNC_TIMEOUT)
@@ -521,8 +579,9 @@ class Interface(Transactional):
                     raise CommitException('ipaddr target is not set')
 
             # 8<---------------------------------------------
-            # reload interface to hit targets
-            if transaction._targets:
+            # reload interface to hit targets; the echoed
+            # link state is as good as the reloaded one
+            if transaction._targets and not reloaded:
                 try:
                     self.reload()
                 except NetlinkError as e:
@@ -610,9 +669,110 @@ class Interface(Transactional):
             error.transaction = transaction
             raise error
 
-        time.sleep(_BARRIER)
+        if barrier:
+            time.sleep(_BARRIER)
         return self
 
+    def _batch(self, transaction, snapshot):
+        #
+        # Return requests to apply the transaction within
+        # IPDB.commit() as (phase, (msg, type, flags), ignore)
+        # tuples, where `ignore` lists bypassed error codes;
+        # the requests are the same as in commit()
+        #
+        added = transaction - snapshot
+        removed = snapshot - transaction
+        if not self._exists or \
+                added.get('removal') or \
+                added.get('flicker') or \
+                added.get('net_ns_fd') is not None or \
+                added.get('net_ns_pid') is not None:
+            raise ValueError('%s can not be committed in a batch, '
+                             'use commit()' % (self['ifname']))
+        ret = []
+
+        for i in removed['ports']:
+            ret.append((BATCH_PORTS,
+                        self.nl._link_request('set', index=i, master=0),
+                        ()))
+
+        for i in added['ports']:
+            ret.append((BATCH_PORTS,
+                        self.nl._link_request('set', index=i,
+                                              master=self['index']),
+                        ()))
+
+        request = IPLinkRequest()
+        for key in added:
+            if key in self._xfields['common']:
+                request[key] = added[key]
+        request['index'] = self['index']
+        if any([request[item] is not None for item in request
+                if item != 'index']):
+            ret.append((BATCH_LINKS,
+                        self.nl._link_request('set', **request),
+                        ()))
+
+        for i in removed['ipaddr']:
+            # Ignore link-local IPv6 addresses
+            if i[0][:4] == 'fe80' and i[1] == 64:
+                continue
+            # bypass errno 99, 'Cannot assign address', see commit()
+            ret.append((BATCH_DELADDR,
+                        self.nl._addr_request('delete', self['index'],
+                                              i[0], i[1]),
+                        (99, )))
+
+        for i in added['ipaddr']:
+            # Ignore link-local IPv6 addresses
+            if i[0][:4] == 'fe80' and i[1] == 64:
+                continue
+            try:
+                kwarg = transaction.ipaddr[i]
+            except KeyError:
+                kwarg = None
+            ret.append((BATCH_ADDADDR,
+                        self.nl._addr_request('add', self['index'],
+                                              i[0], i[1],
+                                              **dict(kwarg or {})),
+                        ()))
+        return ret
+
+    def _batch_check(self, transaction, snapshot, deadline):
+        #
+        # Check targets after IPDB.commit(); the kernel echo and
+        # reloaded links are applied already, so waits are short
+        #
+        added = transaction - snapshot
+        removed = snapshot - transaction
+
+        if removed['ports'] or added['ports']:
+            self['ports'].set_target(transaction['ports'])
+            self['ports'].target.wait(max(deadline - time.time(), 0))
+            if not self['ports'].target.is_set():
+                raise CommitException('ports target is not set')
+            for i in list(added['ports']) + list(removed['ports']):
+                port = self.ipdb.interfaces[i]
+                if (port.if_master == self['index']) != \
+                        (i in added['ports']):
+                    raise CommitException('master target failed')
+
+        if removed['ipaddr'] or added['ipaddr']:
+            self['ipaddr'].set_target(transaction['ipaddr'])
+            self['ipaddr'].target.wait(max(deadline - time.time(), 0))
+            if not self['ipaddr'].target.is_set():
+                raise CommitException('ipaddr target is not set')
+
+        transaction._wait_all_targets(max(deadline - time.time(), 0))
+
+        for ch in self._commit_hooks:
+            # An exception will rollback the batch
+            ch(self.dump(), snapshot.dump(), transaction.dump())
+
+    def _batch_rollback(self, snapshot, exists):
+        # roll back the interface after a failed IPDB.commit()
+        return self.commit(transaction=snapshot, rollback=True)
+
     def up(self):
         '''
         Shortcut: change the interface state to 'up'.
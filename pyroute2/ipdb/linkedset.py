@@ -1,6 +1,7 @@
 '''
 '''
 import threading
+from pyroute2.ipdb.common import lazy
 
 
 class LinkedSet(set):
@@ -13,13 +14,15 @@ class LinkedSet(set):
     member should be counted in target checks (target methods
     see below), or `False` if it should be ignored.
     '''
+    # created on demand, see Transactional
+    lock = lazy('_lock', lambda x: threading.RLock())
+    target = lazy('_target', lambda x: threading.Event())
+
     def target_filter(self, x):
         return True
 
     def __init__(self, *argv, **kwarg):
         set.__init__(self, *argv, **kwarg)
-        self.lock = threading.RLock()
-        self.target = threading.Event()
         self._ct = None
         self.raw = {}
         self.links = []
@@ -1,35 +1,292 @@
+import time
+import struct
+import binascii
 import threading
+from socket import AF_INET
+from socket import AF_INET6
 from socket import AF_UNSPEC
+from socket import inet_pton
+from pyroute2.netlink.rtnl import RTM_NEWROUTE
+from pyroute2.netlink.rtnl import RTM_DELROUTE
 from pyroute2.netlink.rtnl.rtmsg import rtmsg
 from pyroute2.netlink.rtnl.req import IPRouteRequest
+from pyroute2.ipdb.common import BATCH_ROUTES
+from pyroute2.ipdb.common import CommitException
+from pyroute2.ipdb.common import lazy
 from pyroute2.ipdb.transactional import Transactional
 
 
+RTA_TABLE = [x[0] for x in rtmsg.nla_map].index('RTA_TABLE')
+RT_TABLE_COMPAT = 252
+ADDR_BITS = {AF_INET: 32,
+             AF_INET6: 128}
+# fields are shared by all the objects, see Transactional.pick()
+METRICS_FIELDS = [rtmsg.metrics.nla2name(i[0]) for i
+                  in rtmsg.metrics.nla_map]
+ROUTE_FIELDS = [rtmsg.nla2name(i[0]) for i in rtmsg.nla_map] + \
+    ['flags', 'src_len', 'dst_len', 'table', 'removal']
+
+
+def route_table(data, offset):
+    '''
+    Get the table id of a raw RTM_*ROUTE message at `offset`
+    without decoding it: the rtmsg table field or, for ids
+    above 255, the RTA_TABLE attribute.
+    '''
+    table = struct.unpack('B', data[offset + 20:offset + 21])[0]
+    if table == RT_TABLE_COMPAT:
+        end = offset + struct.unpack('I', data[offset:offset + 4])[0]
+        # NLA follow the nlmsg header (16) and rtmsg (12)
+        pos = offset + 28
+        while pos + 4 <= end:
+            (length, nla) = struct.unpack('HH', data[pos:pos + 4])
+            if length < 4:
+                break
+            if nla == RTA_TABLE:
+                return struct.unpack('I', data[pos + 4:pos + 8])[0]
+            pos += (length + 3) & ~3
+    return table
+
+
+def proxy_route_filter(tables, events=False):
+    '''
+    Return a receive proxy plugin, that drops RTM_NEWROUTE
+    and RTM_DELROUTE messages of tables, not in `tables`,
+    before they are decoded; see `IPDB(route_tables=...)`.
+
+    With `events=True` only multicast events are dropped:
+    messages with the socket's own port id in `nlmsg_pid`
+    are responses to its requests, and they are passed as is.
+    '''
+    def proxy(data, nl):
+        offset = 0
+        ret = []
+        while offset + 16 <= len(data):
+            (length, mtype, _, _, pid) = \
+                struct.unpack('IHHII', data[offset:offset + 16])
+            if length < 16:
+                break
+            end = offset + ((length + 3) & ~3)
+            if mtype not in (RTM_NEWROUTE, RTM_DELROUTE) or \
+                    (events and pid == nl.epid) or \
+                    route_table(data, offset) in tables:
+                ret.append(data[offset:end])
+            offset = end
+        return {'verdict': 'forward',
+                'data': b''.join(ret)}
+    return proxy
+
+
+def parse_prefix(prefix, family=None):
+    '''
+    Parse 'addr', 'addr/len' or 'default' into a tuple
+    (family, network as int, prefix length). The family is
+    guessed from the address, 'default' is IPv4 by default.
+    '''
+    if prefix == 'default':
+        return (family or AF_INET, 0, 0)
+    if '/' in prefix:
+        (addr, length) = prefix.split('/')
+        length = int(length)
+    else:
+        (addr, length) = (prefix, None)
+    family = family or (AF_INET6 if ':' in addr else AF_INET)
+    bits = ADDR_BITS[family]
+    if length is None:
+        length = bits
+    if not 0 <= length <= bits:
+        raise ValueError('invalid prefix length %s' % (length))
+    value = int(binascii.hexlify(inet_pton(family, addr)), 16)
+    return (family, value & ~((1 << (bits - length)) - 1), length)
+
+
+class PrefixNode(object):
+    __slots__ = ('prefix', 'length', 'value', 'children')
+
+    def __init__(self, prefix, length, value=None):
+        self.prefix = prefix
+        self.length = length
+        self.value = value
+        self.children = [None, None]
+
+
+class PrefixTree(object):
+    '''
+    Path compressed binary (Patricia) trie of network prefixes
+    of one address family. Prefixes are integers with zeroed
+    host bits; nodes with `value is None` are glue nodes::
+
+        tree = PrefixTree(32)
+        tree.insert(0x0a000000, 8, 'a')
+        tree.lookup(0x0a010203)  # -> 'a'
+    '''
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = None
+        self.size = 0
+
+    def _bit(self, prefix, pos):
+        return (prefix >> (self.bits - 1 - pos)) & 1
+
+    def _mask(self, prefix, length):
+        return prefix & ~((1 << (self.bits - length)) - 1)
+
+    def _match(self, node, prefix, length):
+        # does the node cover the prefix
+        return node.length <= length and \
+            self._mask(prefix, node.length) == node.prefix
+
+    def _find(self, prefix, length):
+        # return (parent, node) for an exact match
+        (parent, node) = (None, self.root)
+        while node is not None and node.length < length:
+            if not self._match(node, prefix, length):
+                return (None, None)
+            (parent, node) = (node,
+                              node.children[self._bit(prefix, node.length)])
+        if node is None or node.length != length or node.prefix != prefix:
+            return (None, None)
+        return (parent, node)
+
+    def _replace(self, parent, node, new):
+        if parent is None:
+            self.root = new
+        else:
+            parent.children[parent.children.index(node)] = new
+
+    def insert(self, prefix, length, value):
+        (parent, node) = (None, self.root)
+        while node is not None:
+            diff = node.prefix ^ prefix
+            common = min(self.bits - diff.bit_length(), node.length, length)
+            if common == node.length == length:
+                if node.value is None:
+                    self.size += 1
+                node.value = value
+                return
+            if common == node.length:
+                # go down
+                (parent, node) = (node,
+                                  node.children[self._bit(prefix, common)])
+                continue
+            new = PrefixNode(prefix, length, value)
+            if common == length:
+                # the new node covers the node
+                new.children[self._bit(node.prefix, common)] = node
+            else:
+                # the prefixes diverge, add a glue node
+                glue = PrefixNode(self._mask(prefix, common), common)
+                glue.children[self._bit(prefix, common)] = new
+                glue.children[self._bit(node.prefix, common)] = node
+                new = glue
+            self._replace(parent, node, new)
+            self.size += 1
+            return
+        new = PrefixNode(prefix, length, value)
+        if parent is None:
+            self.root = new
+        else:
+            parent.children[self._bit(prefix, parent.length)] = new
+        self.size += 1
+
+    def get(self, prefix, length):
+        (parent, node) = self._find(prefix, length)
+        return None if node is None else node.value
+
+    def remove(self, prefix, length):
+        '''
+        Remove a prefix and return its value, or None
+        '''
+        (parent, node) = self._find(prefix, length)
+        if node is None or node.value is None:
+            return None
+        value = node.value
+        node.value = None
+        self.size -= 1
+        # compress the path
+        children = [x for x in node.children if x is not None]
+        if len(children) < 2:
+            self._replace(parent, node, children[0] if children else None)
+            if not children and parent is not None and \
+                    parent.value is None:
+                # a glue node with one child left
+                grand = self._find(parent.prefix, parent.length)[0]
+                self._replace(grand, parent,
+                              [x for x in parent.children
+                               if x is not None][0])
+        return value
+
+    def lookup(self, addr):
+        '''
+        Longest prefix match for an address
+        '''
+        ret = None
+        node = self.root
+        while node is not None and self._match(node, addr, self.bits):
+            if node.value is not None:
+                ret = node.value
+            if node.length == self.bits:
+                break
+            node = node.children[self._bit(addr, node.length)]
+        return ret
+
+    def covering(self, prefix, length):
+        '''
+        Values of prefixes, that cover the prefix, including
+        the prefix itself; the shortest prefixes first
+        '''
+        ret = []
+        node = self.root
+        while node is not None and self._match(node, prefix, length):
+            if node.value is not None:
+                ret.append(node.value)
+            if node.length == length:
+                break
+            node = node.children[self._bit(prefix, node.length)]
+        return ret
+
+    def covered(self, prefix, length):
+        '''
+        Values of prefixes, covered by the prefix, including
+        the prefix itself
+        '''
+        node = self.root
+        while node is not None and node.length < length:
+            if not self._match(node, prefix, length):
+                return []
+            node = node.children[self._bit(prefix, node.length)]
+        if node is None or self._mask(node.prefix, length) != prefix:
+            return []
+        ret = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.value is not None:
+                ret.append(node.value)
+            stack.extend([x for x in node.children[::-1] if x is not None])
+        return ret
+
+
 class Metrics(Transactional):
 
     def __init__(self, *argv, **kwarg):
         Transactional.__init__(self, *argv, **kwarg)
-        self._fields = [rtmsg.metrics.nla2name(i[0]) for i
-                        in rtmsg.metrics.nla_map]
+        self._fields = METRICS_FIELDS
 
 
 class Route(Transactional):
+    _load_event = lazy('_lazy_load_event', lambda x: threading.Event())
 
     def __init__(self, ipdb, mode=None, parent=None, uid=None):
         Transactional.__init__(self, ipdb, mode, parent, uid)
         self._exists = False
-        self._load_event = threading.Event()
-        self._fields = [rtmsg.nla2name(i[0]) for i in rtmsg.nla_map]
-        self._fields.append('flags')
-        self._fields.append('src_len')
-        self._fields.append('dst_len')
-        self._fields.append('table')
-        self._fields.append('removal')
+        self._fields = ROUTE_FIELDS
         self.cleanup = ('attrs',
                         'header',
                         'event')
-        with self._direct_state:
-            self['metrics'] = Metrics(parent=self)
+        # a new object has no targets and transactions
+        dict.__setitem__(self, 'metrics', Metrics(parent=self))
 
     def load_netlink(self, msg):
         with self._direct_state:
@@ -46,9 +303,22 @@ class Route(Transactional):
                             rtax_norm = rtmsg.metrics.nla2name(rtax)
                             ret[rtax_norm] = rtax_value
                     self[norm] = ret
+                elif norm == 'multipath':
+                    # snapshots share values, so the nexthop list
+                    # must be immutable: change it by assignment
+                    self[norm] = tuple(value)
                 else:
                     self[norm] = value
 
+            # ECMP routes have no gateway and oif, but nexthops;
+            # drop stale keys, if the route type was changed
+            if msg.get_attr('RTA_MULTIPATH') is not None:
+                for key in ('gateway', 'oif'):
+                    if key in self:
+                        del self[key]
+            elif 'multipath' in self:
+                del self['multipath']
+
             if msg.get_attr('RTA_DST', None) is not None:
                 dst = '%s/%s' % (msg.get_attr('RTA_DST'),
                                  msg['dst_len'])
@@ -70,6 +340,11 @@ class Route(Transactional):
         self._load_event.wait()
         return self
 
+    def _echo(self, response):
+        # apply the kernel echo, see NLM_F_ECHO in IPRoute.link()
+        for msg in response:
+            self.ipdb.load_netlink(msg)
+
     def commit(self, tid=None, transaction=None, rollback=False):
         self._load_event.clear()
         error = None
@@ -82,7 +357,8 @@ class Route(Transactional):
         # create a new route
         if not self._exists:
             try:
-                self.nl.route('add', **IPRouteRequest(self))
+                self._echo(self.nl.route('add', echo=True,
+                                         **IPRouteRequest(self)))
             except Exception:
                 self.nl = None
                 self.ipdb.routes.remove(self)
@@ -94,10 +370,12 @@ class Route(Transactional):
             # route set
             request = IPRouteRequest(transaction - snapshot)
             if any([request[x] not in (None, {'attrs': []}) for x in request]):
-                self.nl.route('set', **IPRouteRequest(transaction))
+                self._echo(self.nl.route('set', echo=True,
+                                         **IPRouteRequest(transaction)))
 
             if transaction.get('removal'):
-                self.nl.route('delete', **IPRouteRequest(snapshot))
+                self._echo(self.nl.route('delete', echo=True,
+                                         **IPRouteRequest(snapshot)))
 
         except Exception as e:
             if not rollback:
@@ -122,17 +400,105 @@ class Route(Transactional):
 
         return self
 
+    def _batch(self, transaction, snapshot):
+        #
+        # Return requests to apply the transaction within
+        # IPDB.commit(), see Interface._batch()
+        #
+        ret = []
+        if not self._exists:
+            ret.append((BATCH_ROUTES,
+                        self.nl._route_request('add',
+                                               **IPRouteRequest(self)),
+                        ()))
+
+        request = IPRouteRequest(transaction - snapshot)
+        if any([request[x] not in (None, {'attrs': []}) for x in request]):
+            ret.append((BATCH_ROUTES,
+                        self.nl._route_request('set',
+                                               **IPRouteRequest(transaction)),
+                        ()))
+
+        if transaction.get('removal'):
+            ret.append((BATCH_ROUTES,
+                        self.nl._route_request('delete',
+                                               **IPRouteRequest(snapshot)),
+                        ()))
+        return ret
+
+    def _batch_check(self, transaction, snapshot, deadline):
+        # the route is loaded from the kernel echo
+        self._load_event.wait(max(deadline - time.time(), 0))
+        if not self._load_event.is_set():
+            raise CommitException('route target is not set')
+
+    def _batch_rollback(self, snapshot, exists):
+        #
+        # Roll back the route after a failed IPDB.commit(); the
+        # kernel state can be any, so compare it with the snapshot
+        #
+        table = self.ipdb.routes.tables.get(snapshot.get('table', 254), {})
+        if not exists:
+            if self._exists:
+                self._echo(self.nl.route('delete', echo=True,
+                                         **IPRouteRequest(self)))
+            if table.get(snapshot['dst']) is self:
+                self.ipdb.routes.remove(self)
+            self.nl = None
+        elif table.get(snapshot['dst']) is not self:
+            # the route was removed
+            self._echo(self.nl.route('add', echo=True,
+                                     **IPRouteRequest(snapshot)))
+        else:
+            request = IPRouteRequest(snapshot - self.pick())
+            if any([request[x] not in (None, {'attrs': []})
+                    for x in request]):
+                self._echo(self.nl.route('set', echo=True,
+                                         **IPRouteRequest(snapshot)))
+        return self
+
     def remove(self):
         self['removal'] = True
         return self
 
 
 class RoutingTables(dict):
+    '''
+    Routes by tables and destinations. Routes, loaded from
+    the OS, are indexed also by prefixes in a trie per table
+    and family, so one can find the route for an address,
+    or routes for a network, without netlink requests::
+
+        ipdb.routes.lookup('10.1.2.3')
+        ipdb.routes.lookup('2001:db8::1', table=100)
+        ipdb.routes.covering('10.1.2.0/24')
+        ipdb.routes.covered('10.0.0.0/8')
+    '''
 
     def __init__(self, ipdb):
         dict.__init__(self)
         self.ipdb = ipdb
         self.tables = {254: {}}
+        self.trees = {}
+
+    def _tree(self, table, family, create=False):
+        if (table, family) not in self.trees:
+            if not create:
+                return None
+            self.trees[(table, family)] = PrefixTree(ADDR_BITS[family])
+        return self.trees[(table, family)]
+
+    def _msg_key(self, msg):
+        # get (table, dict key, family, prefix, length) of a rtmsg
+        table = msg.get_attr('RTA_TABLE', None) or msg.get('table', 254)
+        family = msg.get('family', AF_INET)
+        dst = msg.get_attr('RTA_DST', None)
+        if dst is None:
+            return (table, 'default', family, 0, 0)
+        key = '%s/%s' % (dst, msg.get('dst_len', 0))
+        if family not in ADDR_BITS:
+            return (table, key, family, None, None)
+        return (table, key) + parse_prefix(key, family)
 
     def add(self, spec=None, **kwarg):
         '''
@@ -141,6 +507,11 @@ class RoutingTables(dict):
         spec = spec or kwarg
         table = spec.get('table', 254)
         assert 'dst' in spec
+        if 'routes' not in self.ipdb.objects or \
+                (self.ipdb.route_tables is not None and
+                 table not in self.ipdb.route_tables):
+            raise ValueError('routes of table %s are not maintained' %
+                             (table))
         route = Route(self.ipdb)
         metrics = spec.pop('metrics', {})
         route.update(spec)
@@ -155,45 +526,102 @@ class RoutingTables(dict):
         '''
         Loads an existing route from a rtmsg
         '''
-        table = msg.get('table', 254)
+        (table, key, family, prefix, length) = self._msg_key(msg)
         if table not in self.tables:
             self.tables[table] = dict()
 
-        dst = msg.get_attr('RTA_DST', None)
-        if dst is None:
-            key = 'default'
-        else:
-            key = '%s/%s' % (dst, msg.get('dst_len', 0))
-
-        if key in self.tables[table]:
-            ret = self.tables[table][key]
-            ret.load_netlink(msg)
-        else:
+        ret = self.tables[table].get(key, None)
+        # IPv4 and IPv6 default routes share the key, but
+        # not the object
+        if ret is None or ret.get('family', None) not in (None, family):
             ret = Route(ipdb=self.ipdb)
-            ret.load_netlink(msg)
             self.tables[table][key] = ret
+        ret.load_netlink(msg)
+        if family in ADDR_BITS:
+            self._tree(table, family, True).insert(prefix, length, ret)
         return ret
 
+    def unload_netlink(self, msg):
+        '''
+        Removes a route on a RTM_DELROUTE message
+        '''
+        (table, key, family, prefix, length) = self._msg_key(msg)
+        tree = self._tree(table, family)
+        ret = None if tree is None else tree.remove(prefix, length)
+        route = self.tables.get(table, {}).get(key, None)
+        if route is not None and route.get('family', family) == family:
+            del self.tables[table][key]
+            if route is not ret:
+                route.sync()
+        if ret is not None:
+            ret.sync()
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the routes dump, see `IPDB.initdb()`
+        '''
+        self.ipdb.ready.routes.wait(timeout)
+
     def remove(self, route, table=None):
         if isinstance(route, Route):
             table = route.get('table', 254)
             route = route.get('dst', 'default')
         else:
             table = table or 254
-        del self.tables[table][route]
+        obj = self.tables[table].pop(route)
+        family = obj.get('family', None)
+        tree = self._tree(table, family)
+        if tree is not None:
+            (family, prefix, length) = parse_prefix(route, family)
+            if tree.get(prefix, length) is obj:
+                tree.remove(prefix, length)
+
+    def lookup(self, addr, table=254):
+        '''
+        Get the route for an address with the longest prefix
+        match, or None
+        '''
+        self.wait()
+        (family, addr, length) = parse_prefix(addr)
+        tree = self._tree(table, family)
+        return None if tree is None else tree.lookup(addr)
+
+    def covering(self, prefix, table=254, family=None):
+        '''
+        Get routes, that cover the prefix (including the route
+        for the prefix itself), the shortest prefixes first
+        '''
+        self.wait()
+        (family, prefix, length) = parse_prefix(prefix, family)
+        tree = self._tree(table, family)
+        return [] if tree is None else tree.covering(prefix, length)
+
+    def covered(self, prefix, table=254, family=None):
+        '''
+        Get routes within the prefix (including the route
+        for the prefix itself)
+        '''
+        self.wait()
+        (family, prefix, length) = parse_prefix(prefix, family)
+        tree = self._tree(table, family)
+        return [] if tree is None else tree.covered(prefix, length)
 
     def get(self, dst, table=None):
+        self.wait()
         table = table or 254
         return self.tables[table][dst]
 
     def keys(self, table=254, family=AF_UNSPEC):
+        self.wait()
         return [x['dst'] for x in self.tables[table].values()
                 if (x['family'] == family) or (family == AF_UNSPEC)]
 
     def has_key(self, key, table=254):
+        self.wait()
         return key in self.tables[table]
 
     def __contains__(self, key):
+        self.wait()
         return key in self.tables[254]
 
     def __getitem__(self, key):
@@ -3,6 +3,7 @@
 import uuid
 import threading
 from pyroute2.common import Dotkeys
+from pyroute2.ipdb.common import lazy
 from pyroute2.ipdb.common import SYNC_TIMEOUT
 from pyroute2.ipdb.common import CommitException
 from pyroute2.ipdb.common import DeprecationException
@@ -85,6 +86,13 @@ class Transactional(Dotkeys):
     Utility class that implements common transactional logic.
     '''
     _fields_cmp = {}
+    # snapshots are created on every begin() and commit(), but
+    # rarely use these, so they are created on demand
+    uid = lazy('_uid', lambda x: uuid.uuid4())
+    _ts = lazy('_lazy_ts', lambda x: threading.local())
+    _write_lock = lazy('_lazy_write_lock', lambda x: threading.RLock())
+    _direct_state = lazy('_lazy_direct_state',
+                         lambda x: State(x._write_lock))
 
     def __init__(self, ipdb=None, mode=None, parent=None, uid=None):
         #
@@ -105,17 +113,15 @@ class Transactional(Dotkeys):
             self._mode = mode or 'implicit'
         #
         self.nlmsg = None
-        self.uid = uid or uuid.uuid4()
+        if uid is not None:
+            self.__dict__['_uid'] = uid
         self.last_error = None
         self._commit_hooks = []
         self._fields = []
         self._sids = []
-        self._ts = threading.local()
         self._snapshots = {}
         self._targets = {}
         self._local_targets = {}
-        self._write_lock = threading.RLock()
-        self._direct_state = State(self._write_lock)
         self._linked_sets = set()
 
     @property
@@ -159,14 +165,21 @@ class Transactional(Dotkeys):
         Please note, that "updated" doesn't mean "in sync".
         The reason behind this logic is that snapshots can be
         used as transactions.
+
+        Values are not copied, but shared with the snapshot:
+        they are replaced on change, not modified in place.
+        Only nested transactional objects and linked sets are
+        copied.
         '''
         with self._write_lock:
             res = self.__class__(ipdb=self.ipdb,
                                  mode='snapshot',
                                  parent=parent,
                                  uid=uid)
+            fields = set(self._fields)
+            values = {}
             for (key, value) in self.items():
-                if key in self._fields:
+                if key in fields:
                     if isinstance(value, Transactional):
                         t = value.pick(detached=detached,
                                        uid=res.uid,
@@ -175,13 +188,16 @@ class Transactional(Dotkeys):
                             # forge the transaction for nested objects
                             value._transactions[res.uid] = t
                             value._tids.append(res.uid)
-                        res[key] = t
+                        values[key] = t
                     else:
-                        res[key] = self[key]
+                        values[key] = value
             for key in self._linked_sets:
-                res[key] = LinkedSet(self[key])
+                values[key] = LinkedSet(self[key])
                 if not detached:
-                    self[key].connect(res[key])
+                    self[key].connect(values[key])
+            # the new snapshot has no targets and transactions
+            # to update, so bypass __setitem__()
+            dict.update(res, values)
             return res
 
     def __enter__(self):
@@ -210,16 +226,20 @@ class Transactional(Dotkeys):
 
     def __sub__(self, vs):
         res = self.__class__(ipdb=self.ipdb, mode='snapshot')
+        fields = set(self._fields)
+        values = {}
         with self._direct_state:
             # simple keys
             for key in self:
-                if (key in self._fields) and \
+                if (key in fields) and \
                         ((key not in vs) or (self[key] != vs[key])):
-                    res[key] = self[key]
+                    values[key] = self[key]
         for key in self._linked_sets:
             diff = LinkedSet(self[key] - vs[key])
             if diff:
-                res[key] = diff
+                values[key] = diff
+        # see pick()
+        dict.update(res, values)
         return res
 
     def dump(self, not_none=True):
@@ -378,10 +398,10 @@ class Transactional(Dotkeys):
         del self[key]
         return self
 
-    def _wait_all_targets(self):
+    def _wait_all_targets(self, timeout=SYNC_TIMEOUT):
         for key, target in self._targets.items():
             if key not in self._virtual_fields:
-                target.wait(SYNC_TIMEOUT)
+                target.wait(timeout)
                 if not target.is_set():
                     raise CommitException('target %s is not set' % key)
 
@@ -55,11 +55,19 @@ classes
 -------
 '''
 
+import errno
+import threading
+import collections
+from socket import MSG_DONTWAIT
+from socket import error as SocketError
 from socket import htons
+from socket import inet_pton
 from socket import AF_INET
 from socket import AF_INET6
 from socket import AF_UNSPEC
+from socket import AF_BRIDGE
 from pyroute2.netlink import NLMSG_ERROR
+from pyroute2.netlink import NetlinkError
 from pyroute2.netlink import NLM_F_ATOMIC
 from pyroute2.netlink import NLM_F_ROOT
 from pyroute2.netlink import NLM_F_REPLACE
@@ -68,6 +76,8 @@ from pyroute2.netlink import NLM_F_ACK
 from pyroute2.netlink import NLM_F_DUMP
 from pyroute2.netlink import NLM_F_CREATE
 from pyroute2.netlink import NLM_F_EXCL
+from pyroute2.netlink import NLM_F_APPEND
+from pyroute2.netlink import NLM_F_ECHO
 from pyroute2.netlink.rtnl import RTM_NEWADDR
 from pyroute2.netlink.rtnl import RTM_GETADDR
 from pyroute2.netlink.rtnl import RTM_DELADDR
@@ -83,7 +93,9 @@ from pyroute2.netlink.rtnl import RTM_DELTFILTER
 from pyroute2.netlink.rtnl import RTM_NEWTCLASS
 from pyroute2.netlink.rtnl import RTM_GETTCLASS
 from pyroute2.netlink.rtnl import RTM_DELTCLASS
+from pyroute2.netlink.rtnl import RTM_NEWNEIGH
 from pyroute2.netlink.rtnl import RTM_GETNEIGH
+from pyroute2.netlink.rtnl import RTM_DELNEIGH
 from pyroute2.netlink.rtnl import RTM_NEWRULE
 from pyroute2.netlink.rtnl import RTM_GETRULE
 from pyroute2.netlink.rtnl import RTM_DELRULE
@@ -92,6 +104,7 @@ from pyroute2.netlink.rtnl import RTM_GETROUTE
 from pyroute2.netlink.rtnl import RTM_DELROUTE
 from pyroute2.netlink.rtnl import RTM_SETLINK
 from pyroute2.netlink.rtnl import RTM_GETDHCP
+from pyroute2.netlink.rtnl import RTNLGRP_LINK
 from pyroute2.netlink.rtnl import TC_H_INGRESS
 from pyroute2.netlink.rtnl import TC_H_ROOT
 from pyroute2.netlink.rtnl import rtprotos
@@ -107,22 +120,171 @@ from pyroute2.netlink.rtnl.tcmsg import get_netem_parameters
 from pyroute2.netlink.rtnl.tcmsg import get_fw_parameters
 from pyroute2.netlink.rtnl.tcmsg import tcmsg
 from pyroute2.netlink.rtnl.rtmsg import rtmsg
+from pyroute2.netlink.rtnl.fibmsg import fibmsg
+from pyroute2.netlink.rtnl.fibmsg import FR_ACT_NAMES
+from pyroute2.netlink.rtnl.fibmsg import FR_ACT_TO_TBL
+from pyroute2.netlink.rtnl.fibmsg import FIB_RULE_INVERT
 from pyroute2.netlink.rtnl.ndmsg import ndmsg
+from pyroute2.netlink.rtnl.ndmsg import NUD_NAMES
+from pyroute2.netlink.rtnl.ndmsg import NUD_PERMANENT
+from pyroute2.netlink.rtnl.ndmsg import NUD_NOARP
+from pyroute2.netlink.rtnl.ndmsg import NTF_USE
+from pyroute2.netlink.rtnl.ndmsg import NTF_SELF
+from pyroute2.netlink.rtnl.ndmsg import NTF_MASTER
+from pyroute2.netlink.rtnl.ndmsg import NTF_EXT_LEARNED
 from pyroute2.netlink.rtnl.dhcpmsg import dhcpmsg
 from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+from pyroute2.netlink.rtnl.ifinfmsg import ifinflean
+from pyroute2.netlink.rtnl.ifinfmsg import RTEXT_FILTER_SKIP_STATS
+from pyroute2.netlink.rtnl.ifinfmsg import stats_names
 from pyroute2.netlink.rtnl.ifaddrmsg import ifaddrmsg
 from pyroute2.netlink.rtnl import IPRSocket
+from pyroute2.netlink.template import RequestTemplate
+from pyroute2.stats import LinkSampler
+from pyroute2.stats import TCSampler
+from pyroute2.tctree import TCTree
 
 from pyroute2.common import basestring
+from pyroute2.common import transform_handle
+from pyroute2.common import DEFAULT_RCVBUF
 
 DEFAULT_TABLE = 254
 
 
-def transform_handle(handle):
-    if isinstance(handle, basestring):
-        (major, minor) = [int(x if x else '0', 16) for x in handle.split(':')]
-        handle = (major << 8 * 2) | minor
-    return handle
+class LinkCache(object):
+    '''
+    Interface cache for `link_lookup()`. It is seeded with one
+    RTM_GETLINK dump and then kept up to date with RTM_NEWLINK
+    and RTM_DELLINK broadcasts, received by a separate socket
+    bound to RTNLGRP_LINK. So there are no threads: pending
+    broadcasts are read without blocking right before each
+    lookup.
+
+    Since netlink broadcasts are delivered synchronously, all
+    the changes made before the lookup -- by this process or
+    by any other one -- are already in the socket queue at the
+    moment of the lookup.
+
+    The cache can not vouch for freshness after the socket
+    overrun (ENOBUFS), when some broadcasts are lost. In that
+    case the next lookup reloads the cache with a new dump.
+
+    Lookups are served from hash indexes, that are built
+    for every requested NLA on the first lookup and then
+    maintained along with the cache. NLA with unhashable
+    values, like IFLA_LINKINFO, are looked up with a scan
+    of cached messages.
+    '''
+
+    def __init__(self, nl=None):
+        self.nl = nl or IPRSocket()
+        self.nl.bind(groups=RTNLGRP_LINK)
+        self.lock = threading.RLock()
+        self.links = {}
+        self.indexes = {}
+        self.fresh = False
+        self.reloads = 0
+
+    def close(self):
+        self.nl.close()
+
+    def reload(self):
+        '''
+        Drop the cache and load it again with a dump.
+        '''
+        with self.lock:
+            # queued broadcasts are superseded by the dump
+            for msg in self.pending():
+                pass
+            msg = ifinfmsg()
+            msg['family'] = AF_UNSPEC
+            links = self.nl.nlm_request(msg, RTM_GETLINK)
+            self.links = {}
+            self.indexes = {}
+            for link in links:
+                self.links[link['index']] = link
+            # broadcasts, received along with the dump
+            events = self.nl.backlog[0]
+            self.nl.backlog[0] = []
+            for event in events:
+                self.apply(event)
+            self.fresh = True
+            self.reloads += 1
+
+    def pending(self):
+        '''
+        Yield broadcasts, pending in the socket queue.
+        '''
+        while True:
+            try:
+                data = self.nl.recv(DEFAULT_RCVBUF, MSG_DONTWAIT)
+            except SocketError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                elif e.errno == errno.ENOBUFS:
+                    # some broadcasts are lost
+                    self.fresh = False
+                    continue
+                raise
+            for msg in self.nl.marshal.parse(data):
+                yield msg
+
+    def update(self):
+        '''
+        Apply all the pending broadcasts, or reload the cache,
+        if it can not be trusted anymore.
+        '''
+        with self.lock:
+            for msg in self.pending():
+                self.apply(msg)
+            if not self.fresh:
+                self.reload()
+
+    def apply(self, msg):
+        # AF_BRIDGE messages are bridge port events, not links
+        if msg['family'] != AF_UNSPEC:
+            return
+        index = msg['index']
+        if msg['header']['type'] == RTM_NEWLINK:
+            self._unindex(index)
+            self.links[index] = msg
+            for name, values in self.indexes.items():
+                for value in msg.get_attrs(name):
+                    values.setdefault(value, set()).add(index)
+        elif msg['header']['type'] == RTM_DELLINK:
+            self._unindex(index)
+            self.links.pop(index, None)
+
+    def _unindex(self, index):
+        msg = self.links.get(index)
+        if msg is None:
+            return
+        for name, values in self.indexes.items():
+            for value in msg.get_attrs(name):
+                values.get(value, set()).discard(index)
+                if not values.get(value, True):
+                    del values[value]
+
+    def lookup(self, name, value):
+        '''
+        Return sorted list of interface indices with NLA
+        `name` equal to `value`.
+        '''
+        with self.lock:
+            self.update()
+            if name not in self.indexes:
+                try:
+                    values = {}
+                    for (index, msg) in self.links.items():
+                        for v in msg.get_attrs(name):
+                            values.setdefault(v, set()).add(index)
+                    values.get(value)
+                except TypeError:
+                    # unhashable NLA, no index
+                    return sorted([i for (i, x) in self.links.items()
+                                   if value in x.get_attrs(name)])
+                self.indexes[name] = values
+            return sorted(self.indexes[name].get(value, ()))
 
 
 class IPRouteMixin(object):
@@ -154,6 +316,8 @@ class IPRouteMixin(object):
 
     '''
 
+    link_cache = None
+
     # 8<---------------------------------------------------------------
     #
     # Listing methods
@@ -205,26 +369,100 @@ class IPRouteMixin(object):
 
             interfaces = [1, 2, 3]
             ip.get_links(*interfaces)
+
+        Keyword arguments: `family` and `lean`, see `iter_links()`.
+        '''
+        return list(self.iter_links(*argv, **kwarg))
+
+    def link_sampler(self, counters=stats_names):
+        '''
+        Return `LinkSampler` -- interface counters sampler, that
+        computes per-interval deltas and rates with lean dumps::
+
+            sampler = ip.link_sampler(('rx_bytes', 'tx_bytes'))
+            sampler.sample()
+            ...
+            ret = sampler.sample()
+            ret['ifname']             # interface names column
+            ret['rate']['rx_bytes']   # rx rates column
+
+        See `pyroute2.stats` for details.
+        '''
+        return LinkSampler(self, counters)
+
+    def tc_sampler(self, index, counters=('bytes', 'packets', 'drops',
+                                          'overlimits', 'requeues')):
+        '''
+        Return `TCSampler` -- qdisc and class counters sampler
+        for the interface, that decodes only statistics NLA and
+        aggregates deltas up the tc hierarchy::
+
+            sampler = ip.tc_sampler(index)
+            sampler.sample()
+            ...
+            ret = sampler.sample()
+            ret['key']                # handles column
+            ret['parent']             # parent handles column
+            ret['rate']['bytes']      # own rates
+            ret['total']['bytes']     # subtree deltas
+
+        See `pyroute2.stats` for details.
+        '''
+        return TCSampler(self, index, counters)
+
+    def iter_links(self, *argv, **kwarg):
+        '''
+        The same as `get_links()`, but returns a generator,
+        that yields interfaces as they are received from the
+        kernel. Useful on hosts with thousands of interfaces::
+
+            for link in ip.iter_links():
+                if link.get_attr('IFLA_IFNAME') == 'eth0':
+                    break
+
+        It is safe to stop the iteration at any moment, the
+        rest of the dump will be discarded.
+
+        With `lean=True` the kernel is asked to skip statistics
+        (IFLA_EXT_MASK with RTEXT_FILTER_SKIP_STATS), so there
+        will be no IPv6/ICMPv6 and VF statistics; IFLA_STATS and
+        IFLA_STATS64 are still sent by the kernel. IFLA_AF_SPEC
+        is not decoded, but returned as raw bytes, and can be
+        decoded on demand, see `ifinflean`::
+
+            for link in ip.iter_links(lean=True):
+                spec = link.get_af_spec()
+                ...
         '''
-        result = []
         links = argv or ['all']
         msg_flags = NLM_F_REQUEST | NLM_F_DUMP
+        msg_map = None
         for index in links:
             msg = ifinfmsg()
             msg['family'] = kwarg.get('family', AF_UNSPEC)
+            if kwarg.get('lean'):
+                msg['attrs'] = [['IFLA_EXT_MASK', RTEXT_FILTER_SKIP_STATS]]
+                msg_map = {RTM_NEWLINK: ifinflean}
             if index != 'all':
                 msg['index'] = index
                 msg_flags = NLM_F_REQUEST
-            result.extend(self.nlm_request(msg, RTM_GETLINK, msg_flags))
-        return result
+            for link in self.nlm_request_iter(msg, RTM_GETLINK, msg_flags,
+                                              msg_map=msg_map):
+                yield link
 
     def get_neighbors(self, family=AF_UNSPEC):
         '''
         Retrieve ARP cache records.
         '''
+        return list(self.iter_neighbors(family))
+
+    def iter_neighbors(self, family=AF_UNSPEC):
+        '''
+        The same as `get_neighbors()`, but returns a generator.
+        '''
         msg = ndmsg()
         msg['family'] = family
-        return self.nlm_request(msg, RTM_GETNEIGH)
+        return self.nlm_request_iter(msg, RTM_GETNEIGH)
 
     def get_addr(self, family=AF_UNSPEC):
         '''
@@ -234,6 +472,14 @@ class IPRouteMixin(object):
         msg['family'] = family
         return self.nlm_request(msg, RTM_GETADDR)
 
+    def iter_addr(self, family=AF_UNSPEC):
+        '''
+        The same as `get_addr()`, but returns a generator.
+        '''
+        msg = ifaddrmsg()
+        msg['family'] = family
+        return self.nlm_request_iter(msg, RTM_GETADDR)
+
     def get_dhcp(self, name, address=None):
         msg = dhcpmsg()
         msg['family'] = AF_INET
@@ -251,10 +497,16 @@ class IPRouteMixin(object):
             ip.get_rules() # get all the rules for all families
             ip.get_routes(family=AF_INET6)  # get only IPv6 rules
         '''
-        msg = ndmsg()
+        return list(self.iter_rules(family))
+
+    def iter_rules(self, family=AF_UNSPEC):
+        '''
+        The same as `get_rules()`, but returns a generator.
+        '''
+        msg = fibmsg()
         msg['family'] = family
         msg_flags = NLM_F_REQUEST | NLM_F_ROOT | NLM_F_ATOMIC
-        return self.nlm_request(msg, RTM_GETRULE, msg_flags)
+        return self.nlm_request_iter(msg, RTM_GETRULE, msg_flags)
 
     def get_routes(self, family=AF_UNSPEC, **kwarg):
         '''
@@ -269,6 +521,18 @@ class IPRouteMixin(object):
             ip.get_routes(family=AF_INET6)  # get only IPv6 routes
             ip.get_routes(table=254)  # get routes from 254 table
         '''
+        return list(self.iter_routes(family, **kwarg))
+
+    def iter_routes(self, family=AF_UNSPEC, **kwarg):
+        '''
+        The same as `get_routes()`, but returns a generator.
+        Routes are filtered and yielded as they arrive, so
+        the full routing table is never kept in memory::
+
+            count = 0
+            for route in ip.iter_routes(table=254):
+                count += 1
+        '''
 
         msg_flags = NLM_F_DUMP | NLM_F_REQUEST
         msg = rtmsg()
@@ -290,10 +554,10 @@ class IPRouteMixin(object):
             if kwarg[key] is not None:
                 msg['attrs'].append([nla, kwarg[key]])
 
-        routes = self.nlm_request(msg, RTM_GETROUTE, msg_flags)
-        return [x for x in routes
-                if x.get_attr('RTA_TABLE') == table or
-                kwarg.get('table', None) is None]
+        check = kwarg.get('table', None) is not None
+        for route in self.nlm_request_iter(msg, RTM_GETROUTE, msg_flags):
+            if not check or route.get_attr('RTA_TABLE') == table:
+                yield route
     # 8<---------------------------------------------------------------
 
     # 8<---------------------------------------------------------------
@@ -353,6 +617,33 @@ class IPRouteMixin(object):
         '''
         self.link('delete', index=index)
 
+    def enable_link_cache(self, nl=None):
+        '''
+        Serve `link_lookup()` from the `LinkCache`, that is kept
+        up to date with broadcasts instead of dumping all the
+        interfaces on every call. The cache uses a separate
+        netlink socket; by default it is a new `IPRSocket` in
+        the current network namespace, so with `NetNS` pass a
+        socket in the same namespace as `nl`.
+
+        Returns the cache object.
+        '''
+        if self.link_cache is None:
+            self.link_cache = LinkCache(nl)
+        return self.link_cache
+
+    def disable_link_cache(self):
+        '''
+        Drop the link cache and close its socket.
+        '''
+        if self.link_cache is not None:
+            self.link_cache.close()
+            self.link_cache = None
+
+    def close(self):
+        self.disable_link_cache()
+        super(IPRouteMixin, self).close()
+
     def link_lookup(self, **kwarg):
         '''
         Lookup interface index (indeces) by first level NLA
@@ -366,7 +657,14 @@ class IPRouteMixin(object):
 
         Please note, that link_lookup() returns list, not one
         value.
+
+        With the link cache enabled, see `enable_link_cache()`,
+        the lookup uses no dump. To bypass the cache, use
+        `cache=False`::
+
+            ip.link_lookup(ifname="lo", cache=False)
         '''
+        cache = kwarg.pop('cache', True)
         name = tuple(kwarg.keys())[0]
         value = kwarg[name]
 
@@ -374,6 +672,9 @@ class IPRouteMixin(object):
         if not name.startswith('IFLA_'):
             name = 'IFLA_%s' % (name)
 
+        if cache and self.link_cache is not None:
+            return self.link_cache.lookup(name, value)
+
         return [k['index'] for k in
                 [i for i in self.get_links() if 'attrs' in i] if
                 [l for l in k['attrs'] if l[0] == name and l[1] == value]]
@@ -383,16 +684,217 @@ class IPRouteMixin(object):
         Flush routes -- purge route records from a table.
         Arguments are the same as for `get_routes()`
         routine. Actually, this routine implements a pipe from
-        `get_routes()` to `nlm_request()`.
+        `get_routes()` to `nlm_request_batch()`: dumped messages
+        are sent back as RTM_DELROUTE requests, only the header
+        is changed.
+
+        Extra keywords:
+
+        * stream -- do not keep the dump in memory, but delete
+          routes as they arrive; default False
+        * window -- see `nlm_request_batch()`
+
+        Returns a dictionary::
+
+            {'deleted': 1024,  # number of deleted routes
+             'errors': [(route, NetlinkError), ...]}
+
+        In the stream mode the routine runs dump passes until
+        a pass deletes nothing, since a dump can skip entries,
+        if the table changes under it. Errors of the last pass
+        are reported then.
         '''
-        flags = NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL | NLM_F_REQUEST
-        ret = []
+        flags = NLM_F_ACK | NLM_F_REQUEST
+        stream = kwarg.pop('stream', False)
+        window = kwarg.pop('window', 256)
         kwarg['table'] = kwarg.get('table', DEFAULT_TABLE)
-        for route in self.get_routes(*argv, **kwarg):
-            ret.append(self.nlm_request(route,
-                                        msg_type=RTM_DELROUTE,
-                                        msg_flags=flags))
+        ret = {'deleted': 0,
+               'errors': []}
+        while True:
+            queue = collections.deque()
+            errors = []
+            deleted = 0
+
+            def requests(routes):
+                for route in routes:
+                    queue.append(route)
+                    yield (route.raw, RTM_DELROUTE, flags)
+
+            if stream:
+                routes = self.iter_routes(*argv, **kwarg)
+            else:
+                routes = self.get_routes(*argv, **kwarg)
+            for (msg, result) in self.nlm_request_batch(requests(routes),
+                                                        window):
+                route = queue.popleft()
+                if isinstance(result, NetlinkError):
+                    errors.append((route, result))
+                else:
+                    deleted += 1
+            ret['deleted'] += deleted
+            ret['errors'] = errors
+            if not stream or not deleted:
+                return ret
+
+    def sync_routes(self, desired, table=DEFAULT_TABLE,
+                    proto='RTPROT_STATIC', family=AF_INET, window=256):
+        '''
+        Converge a routing table to the desired state. The
+        `desired` argument is an iterable of dictionaries with
+        the same keywords as for `route()`::
+
+            desired = [{'dst': '10.0.0.0', 'mask': 24,
+                        'gateway': '192.168.0.1'},
+                       {'dst': '10.0.1.0', 'mask': 24,
+                        'gateway': '192.168.0.2',
+                        'priority': 10}]
+            report = ip.sync_routes(desired, table=100,
+                                    proto='RTPROT_ZEBRA')
+
+        * table -- the table to sync, default 254
+        * proto -- the routing protocol of managed routes
+        * family -- the address family, default AF_INET
+        * window -- see `nlm_request_batch()`
+
+        The table is dumped as a stream, and routes are indexed
+        by (dst, dst_len, tos, priority, table). Routes of the
+        `proto` protocol, that are not desired, are deleted;
+        changed ones are replaced; missing ones are added.
+        Specs are compared by the attributes they set, along
+        with the type and scope. The table, the protocol and the
+        family are forced in specs. Notice, that IPv6 routes get
+        the default priority 1024, if not set, so it should be
+        set explicitly in IPv6 specs.
+
+        Routes of other protocols are left untouched: specs that
+        collide with them are not applied, but reported as
+        skipped.
+
+        All the changes are sent in one batch, additions and
+        replacements first. Returns the report::
+
+            {'added': [spec, ...],
+             'replaced': [spec, ...],
+             'deleted': [route, ...],
+             'skipped': [spec, ...],
+             'unchanged': 10,
+             'errors': [(action, spec or route, NetlinkError), ...]}
+        '''
+        proto_id = rtprotos[proto]
+
+        def key(msg):
+            dst = msg.get_attr('RTA_DST')
+            if dst is not None and msg['dst_len']:
+                dst = inet_pton(family, dst)
+            else:
+                dst = None
+            return (dst, msg['dst_len'], msg['tos'],
+                    msg.get_attr('RTA_PRIORITY') or 0, table)
+
+        def compare(value, current):
+            if isinstance(value, (list, tuple)):
+                # RTA_MULTIPATH: compare keys, set in the spec,
+                # and the weight, that is always set by the kernel
+                if current is None or len(value) != len(current):
+                    return False
+                for (want, nexthop) in zip(value, current):
+                    want = dict(want)
+                    want['hops'] = want.get('hops') or 0
+                    for name in want:
+                        if not compare(want[name], nexthop.get(name)):
+                            return False
+                return True
+            if isinstance(value, dict):
+                # nested NLA, like RTA_METRICS
+                if current is None:
+                    return False
+                for (name, item) in value.get('attrs', ()):
+                    if current.get_attr(name) != item:
+                        return False
+                return True
+            if isinstance(value, basestring) and \
+                    isinstance(current, basestring):
+                try:
+                    return inet_pton(family, value) == \
+                        inet_pton(family, current)
+                except (ValueError, SocketError):
+                    pass
+            return value == current
+
+        def changed(want, route):
+            if want['type'] != route['type'] or \
+                    want['scope'] != route['scope']:
+                return True
+            for (name, value) in want['attrs']:
+                # skip key attributes and pseudo-NLA like RTA_MASK,
+                # that come from route() keywords and are not encoded
+                if name in ('RTA_DST', 'RTA_TABLE', 'RTA_PRIORITY') or \
+                        name not in want.r_nla_map:
+                    continue
+                if not compare(value, route.get_attr(name)):
+                    return True
+            return False
+
+        # 8<-----------------------------------------------------
+        # index the table, keep only managed routes
+        index = {}
+        foreign = set()
+        for route in self.iter_routes(family, table=table):
+            if route['header']['type'] != RTM_NEWROUTE:
+                continue
+            if route['proto'] == proto_id:
+                index[key(route)] = route
+            else:
+                foreign.add(key(route))
+
+        # 8<-----------------------------------------------------
+        # compute the diff
+        ret = {'added': [],
+               'replaced': [],
+               'deleted': [],
+               'skipped': [],
+               'unchanged': 0,
+               'errors': []}
+        ops = []
+        seen = set()
+        for spec in desired:
+            spec = dict(spec)
+            spec.pop('rtproto', None)
+            spec['table'] = table
+            spec['family'] = family
+            (msg, msg_type, msg_flags) = self._route_request('add',
+                                                             rtproto=proto,
+                                                             **spec)
+            k = key(msg)
+            seen.add(k)
+            if k in index:
+                if changed(msg, index[k]):
+                    msg_flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_REPLACE
+                    ops.append(('replaced', spec,
+                                (msg, msg_type, msg_flags)))
+                else:
+                    ret['unchanged'] += 1
+            elif k in foreign:
+                ret['skipped'].append(spec)
+            else:
+                ops.append(('added', spec, (msg, msg_type, msg_flags)))
+        for (k, route) in index.items():
+            if k not in seen:
+                ops.append(('deleted', route,
+                            (route.raw, RTM_DELROUTE,
+                             NLM_F_REQUEST | NLM_F_ACK)))
+
+        # 8<-----------------------------------------------------
+        # apply
+        results = self.nlm_request_batch([x[2] for x in ops], window)
+        for (op, (msg, result)) in enumerate(results):
+            (action, item, request) = ops[op]
+            if isinstance(result, NetlinkError):
+                ret['errors'].append((action, item, result))
+            else:
+                ret[action].append(item)
         return ret
+
     # 8<---------------------------------------------------------------
 
     # 8<---------------------------------------------------------------
@@ -434,8 +936,44 @@ class IPRouteMixin(object):
         You can also delete interface with::
 
             ip.link("delete", index=x)
+
+        With `echo=True` the request is sent with NLM_F_ECHO, and
+        the call returns the list of messages, that the kernel
+        echoes back: the new object state, the same as in the
+        broadcast notification. The ACK is not included. The
+        same keyword is accepted by `addr()`, `neigh()`, `route()`
+        and `rule()`::
+
+            for msg in ip.addr("add", x, "10.0.0.1", 24, echo=True):
+                print(msg.get_attr("IFA_ADDRESS"))
+
+        Not all the objects support echo: e.g., links and
+        neighbors are notified without the requester reference,
+        and the returned list is empty then.
         '''
+        echo = kwarg.pop('echo', False)
+        (msg, command, msg_flags) = self._link_request(command, **kwarg)
+        return self._modify(msg, command, msg_flags, echo)
+
+    def _modify(self, msg, msg_type, msg_flags, echo=False):
+        #
+        # Run a modifying request; with `echo` set NLM_F_ECHO,
+        # and return echoed messages up to the ACK, see link()
+        #
+        if not echo:
+            return self.nlm_request(msg, msg_type=msg_type,
+                                    msg_flags=msg_flags)
+        return self.nlm_request(msg,
+                                msg_type=msg_type,
+                                msg_flags=msg_flags | NLM_F_ECHO,
+                                terminate=lambda x: x['header']['type'] ==
+                                NLMSG_ERROR)
 
+    def _link_request(self, command, **kwarg):
+        #
+        # Return (msg, msg_type, msg_flags) for a link request,
+        # see link() for parameters
+        #
         commands = {'set': RTM_SETLINK,
                     'add': RTM_NEWLINK,
                     'del': RTM_DELLINK,
@@ -465,7 +1003,7 @@ class IPRouteMixin(object):
             if kwarg[key] is not None:
                 msg['attrs'].append([nla, kwarg[key]])
 
-        return self.nlm_request(msg, msg_type=command, msg_flags=msg_flags)
+        return (msg, command, msg_flags)
 
     def addr(self, command, index, address, mask=24,
              family=None, scope=0, **kwarg):
@@ -484,15 +1022,52 @@ class IPRouteMixin(object):
             index = 62
             ip.addr("add", index, address="10.0.0.1", mask=24)
             ip.addr("add", index, address="10.0.0.2", mask=24)
-        '''
 
-        commands = {'add': RTM_NEWADDR,
-                    'del': RTM_DELADDR,
-                    'remove': RTM_DELADDR,
-                    'delete': RTM_DELADDR}
-        command = commands.get(command, command)
+        With `echo=True` returns the kernel echo, see `link()`.
+        '''
+        echo = kwarg.pop('echo', False)
+        (msg, command, flags) = self._addr_request(command, index, address,
+                                                   mask, family, scope,
+                                                   **kwarg)
+        if echo:
+            flags |= NLM_F_ECHO
+        return self.nlm_request(msg,
+                                msg_type=command,
+                                msg_flags=flags,
+                                terminate=lambda x: x['header']['type'] ==
+                                NLMSG_ERROR)
 
-        flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL
+    def addr_batch(self, command, specs, window=256):
+        '''
+        Batch address operations. The `specs` argument is an
+        iterable of dictionaries with the same keywords as for
+        `addr()`::
+
+            specs = ({'index': 2,
+                      'address': '10.0.0.%i' % (x),
+                      'mask': 24} for x in range(1, 255))
+            for (spec, error) in ip.addr_batch('add', specs):
+                ...
+
+        Returns a generator of `(spec, None | NetlinkError)`
+        tuples, see also `route_batch()`.
+        '''
+        return self._request_batch(self._addr_request, command,
+                                   specs, window)
+
+    def _addr_request(self, command, index, address, mask=24,
+                      family=None, scope=0, **kwarg):
+        #
+        # Return (msg, msg_type, msg_flags) for an address request,
+        # see addr() for parameters
+        #
+        flags_base = NLM_F_REQUEST | NLM_F_ACK
+        commands = {'add': (RTM_NEWADDR,
+                            flags_base | NLM_F_CREATE | NLM_F_EXCL),
+                    'del': (RTM_DELADDR, flags_base),
+                    'remove': (RTM_DELADDR, flags_base),
+                    'delete': (RTM_DELADDR, flags_base)}
+        (command, flags) = commands.get(command, command)
 
         # try to guess family, if it is not forced
         if family is None:
@@ -515,12 +1090,288 @@ class IPRouteMixin(object):
             nla = ifaddrmsg.name2nla(key)
             if kwarg[key] is not None:
                 msg['attrs'].append([nla, kwarg[key]])
+        return (msg, command, flags)
+
+    def neigh(self, command, ifindex=None, dst=None, lladdr=None,
+              state=NUD_PERMANENT, flags=0, family=None, **kwarg):
+        '''
+        Neighbor (ARP, NDP and FDB) operations
+
+        * command -- add, set (replace), change, append, del
+        * ifindex -- device index
+        * dst -- the protocol address; for FDB -- the remote
+          address, e.g. VXLAN VTEP
+        * lladdr -- the link layer address
+        * state -- NUD state, int or name, default "permanent"
+        * flags -- NTF flags, e.g. NTF_SELF or NTF_MASTER for FDB
+        * family -- socket.AF_INET, AF_INET6 or AF_BRIDGE; if not
+          set, is guessed from `dst`, and without `dst` -- AF_BRIDGE
+
+        Other keywords are from ndmsg.nla_map: vlan, port, vni.
+
+        Example::
+
+            # static ARP record
+            ip.neigh('add', ifindex=2, dst='10.0.0.2',
+                     lladdr='00:11:22:33:44:55')
+            # VXLAN FDB record
+            ip.neigh('append', ifindex=vx, lladdr='00:00:00:00:00:00',
+                     dst='192.168.0.2', family=AF_BRIDGE, flags=NTF_SELF)
+            # delete
+            ip.neigh('del', ifindex=2, dst='10.0.0.2')
+
+        With `echo=True` returns the kernel echo, see `link()`.
+        '''
+        echo = kwarg.pop('echo', False)
+        (msg, command, msg_flags) = self._neigh_request(command,
+                                                        ifindex,
+                                                        dst,
+                                                        lladdr,
+                                                        state,
+                                                        flags,
+                                                        family,
+                                                        **kwarg)
+        if echo:
+            msg_flags |= NLM_F_ECHO
         return self.nlm_request(msg,
                                 msg_type=command,
-                                msg_flags=flags,
+                                msg_flags=msg_flags,
                                 terminate=lambda x: x['header']['type'] ==
                                 NLMSG_ERROR)
 
+    def neigh_batch(self, command, specs, window=256):
+        '''
+        Batch neighbor operations. The `specs` argument is an
+        iterable of dictionaries with the same keywords as for
+        `neigh()`. Returns a generator of
+        `(spec, None | NetlinkError)` tuples, see also
+        `route_batch()`.
+        '''
+        return self._request_batch(self._neigh_request, command,
+                                   specs, window)
+
+    def sync_neighbors(self, desired, family=AF_INET, ifindex=None,
+                       learned=False, window=256):
+        '''
+        Converge the neighbor (ARP, NDP) or FDB table to the
+        desired state. The `desired` argument is an iterable of
+        dictionaries with the same keywords as for `neigh()`::
+
+            desired = [{'ifindex': 2, 'dst': '10.0.0.2',
+                        'lladdr': '00:11:22:33:44:55'},
+                       {'ifindex': 2, 'dst': '10.0.0.3',
+                        'lladdr': '00:11:22:33:44:66'}]
+            report = ip.sync_neighbors(desired, ifindex=2)
+
+        * family -- AF_INET, AF_INET6 or AF_BRIDGE (FDB)
+        * ifindex -- an interface index or a list of indices;
+          if set, only entries of these interfaces are synced
+        * learned -- manage also entries learned by the kernel
+        * window -- see `nlm_request_batch()`
+
+        The table is dumped once for the family, and entries are
+        indexed by (ifindex, dst); FDB entries -- by (ifindex,
+        lladdr, dst, vlan, NTF_SELF), since there the link layer
+        address identifies the entry. Entries are compared by
+        lladdr, state, flags and other keywords, set in specs.
+        Not desired entries are deleted, changed ones are
+        replaced, missing ones are added.
+
+        Entries learned by the kernel are not touched, unless
+        `learned` is set: specs that collide with them are not
+        applied, but reported as skipped. Learned are entries:
+
+        * not in NUD_PERMANENT state; for FDB -- not in
+          NUD_PERMANENT or NUD_NOARP ("static") state
+        * with NTF_EXT_LEARNED flag
+        * FDB multicast entries, that come from interface
+          address lists, and local entries of bridges, i.e.
+          ones with addresses of local interfaces
+
+        All the changes are sent in one batch. Returns the same
+        report as `sync_routes()`.
+        '''
+        if isinstance(ifindex, int):
+            ifindex = (ifindex, )
+        if ifindex is not None:
+            ifindex = set(ifindex)
+        # NTF_SELF and NTF_MASTER select the FDB, NTF_USE is
+        # a request flag; the rest are entry flags
+        flags_mask = ~(NTF_SELF | NTF_MASTER | NTF_USE) & 0xff
+        local = set()
+        if family == AF_BRIDGE:
+            static = NUD_PERMANENT | NUD_NOARP
+            for link in self.iter_links():
+                if link['header']['type'] == RTM_NEWLINK:
+                    lladdr = link.get_attr('IFLA_ADDRESS')
+                    if lladdr is not None:
+                        local.add(lladdr.lower())
+        else:
+            static = NUD_PERMANENT
+
+        def address(dst):
+            if dst is None:
+                return None
+            return inet_pton(AF_INET6 if dst.find(':') > -1 else AF_INET,
+                             dst)
+
+        def key(msg):
+            if family == AF_BRIDGE:
+                lladdr = msg.get_attr('NDA_LLADDR')
+                return (msg['ifindex'],
+                        lladdr.lower() if lladdr else None,
+                        address(msg.get_attr('NDA_DST')),
+                        msg.get_attr('NDA_VLAN'),
+                        bool(msg['flags'] & NTF_SELF))
+            return (msg['ifindex'], address(msg.get_attr('NDA_DST')))
+
+        def owned(msg):
+            # is the entry owned by the kernel?
+            if msg['flags'] & NTF_EXT_LEARNED:
+                return True
+            if family == AF_BRIDGE:
+                lladdr = msg.get_attr('NDA_LLADDR')
+                if lladdr is None or int(lladdr[:2], 16) & 1 or \
+                        lladdr.lower() in local:
+                    return True
+            return not msg['state'] & static
+
+        def changed(want, entry):
+            if want['state'] != entry['state'] or \
+                    want['flags'] & flags_mask != \
+                    entry['flags'] & flags_mask:
+                return True
+            for (name, value) in want['attrs']:
+                if name in ('NDA_DST', 'NDA_VLAN'):
+                    continue
+                current = entry.get_attr(name)
+                if name == 'NDA_LLADDR':
+                    value = value.lower()
+                    current = current.lower() if current else None
+                if value != current:
+                    return True
+            return False
+
+        # 8<-----------------------------------------------------
+        # index the table
+        index = {}
+        foreign = set()
+        for entry in self.iter_neighbors(family):
+            if entry['header']['type'] != RTM_NEWNEIGH or \
+                    entry['family'] != family:
+                continue
+            if ifindex is not None and entry['ifindex'] not in ifindex:
+                continue
+            if learned or not owned(entry):
+                index[key(entry)] = entry
+            else:
+                foreign.add(key(entry))
+
+        # 8<-----------------------------------------------------
+        # compute the diff
+        ret = {'added': [],
+               'replaced': [],
+               'deleted': [],
+               'skipped': [],
+               'unchanged': 0,
+               'errors': []}
+        ops = []
+        seen = set()
+        for spec in desired:
+            spec = dict(spec)
+            spec['family'] = family
+            request = self._neigh_request('add', **spec)
+            k = key(request[0])
+            seen.add(k)
+            if k in index:
+                if changed(request[0], index[k]):
+                    ops.append(('replaced', spec,
+                                self._neigh_request('replace', **spec)))
+                else:
+                    ret['unchanged'] += 1
+            elif k in foreign:
+                ret['skipped'].append(spec)
+            else:
+                ops.append(('added', spec, request))
+        for (k, entry) in index.items():
+            if k not in seen:
+                kwarg = {}
+                for name in ('NDA_DST', 'NDA_LLADDR', 'NDA_VLAN',
+                             'NDA_PORT', 'NDA_VNI'):
+                    value = entry.get_attr(name)
+                    if value is not None:
+                        kwarg[name[4:].lower()] = value
+                ops.append(('deleted', entry,
+                            self._neigh_request('del',
+                                                ifindex=entry['ifindex'],
+                                                state=entry['state'],
+                                                flags=entry['flags'] &
+                                                (NTF_SELF | NTF_MASTER),
+                                                family=family,
+                                                **kwarg)))
+
+        # 8<-----------------------------------------------------
+        # apply
+        results = self.nlm_request_batch([x[2] for x in ops], window)
+        for (op, (msg, result)) in enumerate(results):
+            (action, item, request) = ops[op]
+            if isinstance(result, NetlinkError):
+                ret['errors'].append((action, item, result))
+            else:
+                ret[action].append(item)
+        return ret
+
+    def _neigh_request(self, command, ifindex=None, dst=None, lladdr=None,
+                       state=NUD_PERMANENT, flags=0, family=None, **kwarg):
+        #
+        # Return (msg, msg_type, msg_flags) for a neighbor request,
+        # see neigh() for parameters
+        #
+        flags_base = NLM_F_REQUEST | NLM_F_ACK
+        commands = {'add': (RTM_NEWNEIGH,
+                            flags_base | NLM_F_CREATE | NLM_F_EXCL),
+                    'set': (RTM_NEWNEIGH,
+                            flags_base | NLM_F_CREATE | NLM_F_REPLACE),
+                    'replace': (RTM_NEWNEIGH,
+                                flags_base | NLM_F_CREATE | NLM_F_REPLACE),
+                    'change': (RTM_NEWNEIGH,
+                               flags_base | NLM_F_REPLACE),
+                    'append': (RTM_NEWNEIGH,
+                               flags_base | NLM_F_CREATE | NLM_F_APPEND),
+                    'del': (RTM_DELNEIGH, flags_base),
+                    'remove': (RTM_DELNEIGH, flags_base),
+                    'delete': (RTM_DELNEIGH, flags_base)}
+        (command, msg_flags) = commands.get(command, command)
+
+        if family is None:
+            if dst is None:
+                family = AF_BRIDGE
+            elif dst.find(':') > -1:
+                family = AF_INET6
+            else:
+                family = AF_INET
+
+        if isinstance(state, basestring):
+            state = state.upper()
+            if not state.startswith('NUD_'):
+                state = 'NUD_%s' % (state)
+            state = NUD_NAMES[state]
+
+        msg = ndmsg()
+        msg['family'] = family
+        msg['ifindex'] = ifindex
+        msg['state'] = state
+        msg['flags'] = flags
+        if dst is not None:
+            msg['attrs'].append(['NDA_DST', dst])
+        if lladdr is not None:
+            msg['attrs'].append(['NDA_LLADDR', lladdr])
+        for key in kwarg:
+            nla = ndmsg.name2nla(key)
+            if kwarg[key] is not None:
+                msg['attrs'].append([nla, kwarg[key]])
+        return (msg, command, msg_flags)
+
     def tc(self, command, kind, index, handle=0, **kwarg):
         '''
         "Swiss knife" for traffic control. With the method you can
@@ -612,8 +1463,14 @@ class IPRouteMixin(object):
                   protocol=socket.AF_INET,
                   target=0x10020,
                   keys=["0x5/0xf+0", "0x10/0xff+33"])
+
+        To install or delete lots of filters, use `filter_batch()`.
         '''
+        (msg, command, flags) = self._tc_request(command, kind, index,
+                                                 handle, **kwarg)
+        return self.nlm_request(msg, msg_type=command, msg_flags=flags)
 
+    def _tc_request(self, command, kind, index, handle=0, **kwarg):
         commands = {'add': RTM_NEWQDISC,
                     'del': RTM_DELQDISC,
                     'remove': RTM_DELQDISC,
@@ -659,13 +1516,13 @@ class IPRouteMixin(object):
             msg['parent'] = kwarg.get('parent')
             msg['info'] = htons(kwarg.get('protocol', 0) & 0xffff) |\
                 ((kwarg.get('prio', 0) << 16) & 0xffff0000)
-            if kwarg:
+            if kwarg and command != RTM_DELTFILTER:
                 opts = get_u32_parameters(kwarg)
         elif kind == 'fw':
             msg['parent'] = kwarg.get('parent')
             msg['info'] = htons(kwarg.get('protocol', 0) & 0xffff) |\
                 ((kwarg.get('prio', 0) << 16) & 0xffff0000)
-            if kwarg:
+            if kwarg and command != RTM_DELTFILTER:
                 opts = get_fw_parameters(kwarg)
         else:
             msg['parent'] = kwarg.get('parent', TC_H_ROOT)
@@ -674,7 +1531,189 @@ class IPRouteMixin(object):
             msg['attrs'] = [['TCA_KIND', kind]]
         if opts is not None:
             msg['attrs'].append(['TCA_OPTIONS', opts])
-        return self.nlm_request(msg, msg_type=command, msg_flags=flags)
+        return (msg, command, flags)
+
+    def filter_batch(self, command, index, parent, specs, window=256):
+        '''
+        Batch filter operations on one interface and parent.
+        The `specs` argument is an iterable of dictionaries with
+        the same keywords as for `tc()` filters: 'kind' (default
+        'u32'), 'prio', 'protocol', 'target', 'keys' etc.::
+
+            specs = ({'prio': 10,
+                      'protocol': protocols.ETH_P_IP,
+                      'target': 0x10010,
+                      'keys': ['0x0a000000/0xffffff00+16',
+                               '0x%04x/0xffff+22' % port]}
+                     for port in range(1024, 4096))
+            for (spec, error) in ip.filter_batch('add', eth0,
+                                                 0x10000, specs):
+                ...
+
+        * command -- 'add' or 'del', or `RTM_NEWTFILTER` and
+          `RTM_DELTFILTER` constants
+        * index -- the interface index
+        * parent -- the parent qdisc handle
+        * window -- see `nlm_request_batch()`
+
+        Returns a generator of `(spec, None | NetlinkError)`
+        tuples, see also `route_batch()`. Yielded specs are copies
+        of the source ones, with 'index', 'parent' and 'handle'
+        set, so they can be passed to the delete batch as is.
+
+        On add, u32 filters without explicit handle get handles
+        allocated before the batch starts: existing filters are
+        dumped once, and free node ids are taken in the root hash
+        table of the filter priority, or in the hash table slot,
+        set by the 'hash' key, e.g. `0x200000 | (bucket << 12)`
+        for the table 2: -- that is TCA_U32_HASH. If there is no
+        classifier with the priority yet, the first filter of the
+        priority is installed synchronously to create it, and it
+        is yielded first. If the classifier can not be created,
+        the error is yielded for all the filters of the priority
+        and protocol, that depend on it, and they are not sent.
+        The handle of fw filters is the firewall mark, so it must
+        be set in the spec.
+
+        Selectors, compiled from 'keys', are cached by the
+        keys tuple, so filters with the same match are parsed
+        only once, see `tcmsg.u32_sel_cache`.
+        '''
+        commands = {'add': RTM_NEWTFILTER,
+                    'add-filter': RTM_NEWTFILTER,
+                    'del': RTM_DELTFILTER,
+                    'delete': RTM_DELTFILTER,
+                    'remove': RTM_DELTFILTER,
+                    'del-filter': RTM_DELTFILTER}
+        command = commands.get(command, command)
+        parent = transform_handle(parent)
+        specs = [dict(x) for x in specs]
+        for spec in specs:
+            spec['index'] = index
+            spec['parent'] = parent
+            spec['kind'] = spec.get('kind', 'u32')
+        if command == RTM_NEWTFILTER:
+            done = self._filter_alloc(index, parent, specs)
+            for ret in done:
+                yield ret
+            done = set([id(x[0]) for x in done])
+            specs = [x for x in specs if id(x) not in done]
+        for ret in self._request_batch(self._filter_request, command,
+                                       specs, window):
+            yield ret
+
+    def tc_apply(self, index, tree, window=256):
+        '''
+        Bring qdiscs, classes and filters of the interface to the
+        state, described by the tree spec::
+
+            tree = {'qdiscs': [{'kind': 'htb', 'handle': '1:'}],
+                    'classes': [{'handle': '1:1', 'parent': '1:',
+                                 'rate': '10mbit'}],
+                    'filters': [{'parent': '1:', ...}]}
+
+        Current setup is dumped and compared with the tree, and
+        only the difference is applied, in one pipelined batch.
+        Returns the report of added, changed and deleted objects,
+        and errors. See `pyroute2.tctree` for details.
+        '''
+        return TCTree(self, index).apply(tree, window)
+
+    def _filter_alloc(self, index, parent, specs):
+        #
+        # Allocate u32 handles for specs w/o handles; returns
+        # the list of (spec, None | NetlinkError) for specs,
+        # installed to create classifiers, and for specs, that
+        # depend on classifiers failed to create
+        #
+        def info(spec):
+            return htons(spec.get('protocol', 0) & 0xffff) |\
+                ((spec.get('prio', 0) << 16) & 0xffff0000)
+
+        def dump():
+            roots = {}
+            used = set()
+            for msg in self.get_filters(index=index, parent=parent):
+                if msg.get_attr('TCA_KIND') != 'u32' or not msg['handle']:
+                    continue
+                used.add(msg['handle'])
+                # hash tables have node id 0 and are dumped newest
+                # first, so the last one is the classifier root
+                if not msg['handle'] & 0xfff:
+                    roots[msg['info']] = msg['handle']
+            return (roots, used)
+
+        pending = [x for x in specs if x['kind'] == 'u32' and
+                   not x.get('handle')]
+        for spec in pending:
+            spec['handle'] = 0
+        if not pending:
+            return []
+        (roots, used) = dump()
+        created = []
+        failed = {}
+        for spec in pending:
+            key = info(spec)
+            if spec.get('hash') is None and key not in roots and \
+                    key not in failed and \
+                    key not in [info(x) for x in created]:
+                # node id w/o hash table id: the kernel adds
+                # the root table id to it
+                spec['handle'] = 1
+                try:
+                    self.nlm_request(*self._filter_request(RTM_NEWTFILTER,
+                                                           **spec))
+                except NetlinkError as e:
+                    failed[key] = e
+                    continue
+                created.append(spec)
+        ret = []
+        if created:
+            (roots, used) = dump()
+            for spec in created:
+                key = info(spec)
+                if key in roots:
+                    spec['handle'] |= roots[key]
+                    ret.append((spec, None))
+                else:
+                    failed[key] = NetlinkError(errno.ENOENT,
+                                               'u32 classifier root '
+                                               'not found')
+                    ret.append((spec, failed[key]))
+        # filters of failed classifiers are not sent
+        done = set([id(x[0]) for x in ret])
+        for spec in pending:
+            if spec.get('hash') is None and info(spec) in failed and \
+                    id(spec) not in done:
+                ret.append((spec, failed[info(spec)]))
+                done.add(id(spec))
+
+        nodes = {}
+        for spec in pending:
+            if spec['handle'] or id(spec) in done:
+                continue
+            if spec.get('hash') is not None:
+                prefix = spec['hash'] & 0xfffff000
+            else:
+                prefix = roots[info(spec)]
+            node = nodes.get(prefix, 0)
+            while True:
+                node += 1
+                if node > 0xfff:
+                    raise ValueError('no free u32 handles in %x' % prefix)
+                if prefix | node not in used:
+                    break
+            nodes[prefix] = node
+            used.add(prefix | node)
+            spec['handle'] = prefix | node
+        return ret
+
+    def _filter_request(self, command, kind, index, handle=0, **kwarg):
+        (msg, command, flags) = self._tc_request(command, kind, index,
+                                                 handle, **kwarg)
+        if command == RTM_DELTFILTER:
+            flags = NLM_F_REQUEST | NLM_F_ACK
+        return (msg, command, flags)
 
     def route(self, command,
               rtype='RTN_UNICAST',
@@ -701,14 +1740,172 @@ class IPRouteMixin(object):
         * src -- source address
         * iif -- incoming traffic interface
         * oif -- outgoing traffic interface
+        * multipath -- ECMP nexthops, a list of dictionaries with
+          keys gateway, oif, hops (weight - 1) and flags
 
         etc.
 
         Example::
 
             ip.route("add", dst="10.0.0.0", mask=24, gateway="192.168.0.1")
+            # ECMP route
+            ip.route("add", dst="10.0.1.0", mask=24,
+                     multipath=[{"gateway": "192.168.0.1"},
+                                {"gateway": "192.168.0.2", "hops": 1}])
+
+        Commands "set" and "replace" replace an existing route, but
+        "replace" creates also a missing one.
+
+        With `echo=True` returns the kernel echo, see `link()`.
+        '''
+        echo = kwarg.pop('echo', False)
+        (msg, command, flags) = self._route_request(command,
+                                                    rtype,
+                                                    rtproto,
+                                                    rtscope,
+                                                    **kwarg)
+        return self._modify(msg, command, flags, echo)
+
+    def route_batch(self, command, specs, window=256):
+        '''
+        Batch route operations. The `specs` argument is an
+        iterable of dictionaries with the same keywords as for
+        `route()`. Requests are sent in big datagrams and the
+        socket doesn't wait for every ACK, so it is much faster
+        than calling `route()` in a loop, see also
+        `nlm_request_batch()`.
+
+        Returns a generator, that yields `(spec, result)` tuples
+        in the same order as specs, where result is `None` on
+        success, or the `NetlinkError` instance::
+
+            specs = ({'dst': '10.0.%i.0' % x,
+                      'mask': 24,
+                      'gateway': '192.168.0.1'} for x in range(256))
+            for (spec, error) in ip.route_batch('add', specs):
+                if error is not None:
+                    print("%s failed: %s" % (spec['dst'], error))
+
+        The generator must be exhausted or closed, otherwise the
+        rest of requests will not be sent.
+        '''
+        return self._request_batch(self._route_request, command,
+                                   specs, window)
+
+    def replace_nexthops(self, specs, window=256, **kwarg):
+        '''
+        Replace nexthop sets of many routes with one pipelined
+        batch. The `specs` argument is an iterable of dictionaries
+        with `dst`, `mask` and `multipath` keys; other keywords of
+        `route()`, common for all the routes, like `table`, can be
+        passed as `kwarg`::
+
+            a = [{'gateway': '192.168.0.1'},
+                 {'gateway': '192.168.0.2'}]
+            b = [{'gateway': '192.168.0.2'},
+                 {'gateway': '192.168.0.3'}]
+            specs = ({'dst': '10.0.%i.0' % x,
+                      'mask': 24,
+                      'multipath': a if x % 2 else b}
+                     for x in range(256))
+            for (spec, error) in ip.replace_nexthops(specs, table=100):
+                ...
+
+        Routes are replaced with RTM_NEWROUTE and NLM_F_REPLACE,
+        missing ones are created. Encoded nexthop sets are cached,
+        so when many routes share the same set, it is encoded only
+        once. Returns a generator of `(spec, None | NetlinkError)`
+        tuples, see also `route_batch()`.
+        '''
+        def requests():
+            for spec in specs:
+                request = dict(kwarg)
+                request.update(spec)
+                yield request
+
+        return self._request_batch(self._route_request, 'replace',
+                                   requests(), window)
+
+    def template(self, target, command, slots, **kwarg):
         '''
+        Build a `RequestTemplate` for repeated requests.
+
+        * target -- 'link', 'addr', 'route' or 'neigh'
+        * command -- the command, as for the corresponding method
+        * slots -- slot names, see `pyroute2.netlink.template`
+        * \*\*kwarg -- keywords, as for the corresponding method;
+          slots must be set here to sample values
+
+        For 'addr' IPv4 requests the 'address' slot patches
+        both IFA_LOCAL and IFA_ADDRESS.
+
+        Example::
 
+            t = ip.template('route', 'set', ('gateway', ),
+                            dst='10.0.0.0', mask=24,
+                            gateway='192.168.0.1')
+            ip.nlm_request(t.stamp(gateway='192.168.0.2'),
+                           t.msg_type, t.msg_flags)
+        '''
+        builders = {'link': self._link_request,
+                    'addr': self._addr_request,
+                    'route': self._route_request,
+                    'neigh': self._neigh_request}
+        (msg, msg_type, msg_flags) = builders[target](command, **kwarg)
+        if target == 'addr' and msg['family'] == AF_INET:
+            slots = dict([(x, (x, )) for x in slots])
+            if 'address' in slots:
+                slots['address'] = ('IFA_LOCAL', 'IFA_ADDRESS')
+        return RequestTemplate(msg, msg_type, msg_flags, slots)
+
+    def template_batch(self, template, values, window=256):
+        '''
+        Send requests, stamped out from the template, as a batch.
+        The `values` argument is an iterable of dictionaries of
+        slot values::
+
+            t = ip.template('link', 'set', ('index', ),
+                            index=1, state='up')
+            values = ({'index': x} for x in indices)
+            for (value, error) in ip.template_batch(t, values):
+                ...
+
+        Returns a generator of `(value, None | NetlinkError)`
+        tuples, see also `route_batch()`.
+        '''
+        def builder(command, **kwarg):
+            return (template.stamp(**kwarg),
+                    template.msg_type,
+                    template.msg_flags)
+
+        return self._request_batch(builder, None, values, window)
+
+    def _request_batch(self, builder, command, specs, window):
+        #
+        # Send requests, built with `builder(command, **spec)`, as
+        # a batch and yield (spec, None | NetlinkError) tuples
+        #
+        queue = collections.deque()
+
+        def requests():
+            for spec in specs:
+                queue.append(spec)
+                yield builder(command, **spec)
+
+        for (msg, result) in self.nlm_request_batch(requests(), window):
+            if not isinstance(result, NetlinkError):
+                result = None
+            yield (queue.popleft(), result)
+
+    def _route_request(self, command,
+                       rtype='RTN_UNICAST',
+                       rtproto='RTPROT_STATIC',
+                       rtscope='RT_SCOPE_UNIVERSE',
+                       **kwarg):
+        #
+        # Return (msg, msg_type, msg_flags) for a route request,
+        # see route() for parameters
+        #
         # 8<----------------------------------------------------
         # FIXME
         # flags should be moved to some more general place
@@ -718,9 +1915,10 @@ class IPRouteMixin(object):
         # 8<----------------------------------------------------
         commands = {'add': (RTM_NEWROUTE, flags_make),
                     'set': (RTM_NEWROUTE, flags_replace),
-                    'del': (RTM_DELROUTE, flags_make),
-                    'remove': (RTM_DELROUTE, flags_make),
-                    'delete': (RTM_DELROUTE, flags_make)}
+                    'replace': (RTM_NEWROUTE, flags_replace | NLM_F_CREATE),
+                    'del': (RTM_DELROUTE, flags_base),
+                    'remove': (RTM_DELROUTE, flags_base),
+                    'delete': (RTM_DELROUTE, flags_base)}
         (command, flags) = commands.get(command, command)
         msg = rtmsg()
         # table is mandatory; by default == 254
@@ -734,6 +1932,7 @@ class IPRouteMixin(object):
         msg['scope'] = rtscopes[rtscope]
         msg['dst_len'] = kwarg.get('dst_len', None) or \
             kwarg.get('mask', 0)
+        msg['tos'] = kwarg.pop('tos', 0)
         msg['attrs'] = []
         # FIXME
         # deprecated "prefix" support:
@@ -745,12 +1944,11 @@ class IPRouteMixin(object):
             if kwarg[key] is not None:
                 msg['attrs'].append([nla, kwarg[key]])
 
-        return self.nlm_request(msg, msg_type=command,
-                                msg_flags=flags)
+        return (msg, command, flags)
 
     def rule(self, command, table, priority=32000, rtype='RTN_UNICAST',
              rtscope='RT_SCOPE_UNIVERSE', family=AF_INET, src=None,
-             src_len=None, dst=None, dst_len=None, fwmark=None):
+             src_len=None, dst=None, dst_len=None, fwmark=None, **kwarg):
         '''
         Rule operations
 
@@ -767,6 +1965,17 @@ class IPRouteMixin(object):
         * dst      - IP for Destination Based (Policy Based) routing's rule
         * src_len  - Mask for Source Based (Policy Based) routing's rule
         * dst_len  - Mask for Destination Based (Policy Based) routing's rule
+        * fwmark   - firewall mark
+
+        The rule type can be set also as FR_ACT_* action, e.g.
+        'FR_ACT_GOTO'; RTN_UNICAST, RTN_BLACKHOLE, RTN_UNREACHABLE
+        and RTN_PROHIBIT types are mapped to corresponding actions.
+        The table is required only for FR_ACT_TO_TBL (RTN_UNICAST).
+        The `rtscope` argument is ignored, since the field is
+        reserved in rule messages.
+
+        Other keywords are from fibmsg.nla_map: iifname, oifname,
+        fwmask, goto, suppress_prefixlen, protocol etc.
 
         Example::
             ip.rule('add', 10, 32000)
@@ -812,26 +2021,218 @@ class IPRouteMixin(object):
             ...
             32006: from 10.64.75.141 fwmark 0xa lookup 15
             ...
+
+        With `echo=True` returns the kernel echo, see `link()`.
         '''
-        if table < 1:
-            raise ValueError('unsupported table number')
+        echo = kwarg.pop('echo', False)
+        (msg, command, msg_flags) = self._rule_request(command, table,
+                                                       priority, rtype,
+                                                       rtscope, family,
+                                                       src, src_len,
+                                                       dst, dst_len,
+                                                       fwmark, **kwarg)
+        return self._modify(msg, command, msg_flags, echo)
+
+    def rule_batch(self, command, specs, window=256):
+        '''
+        Batch rule operations. The `specs` argument is an
+        iterable of dictionaries with the same keywords as for
+        `rule()`. Returns a generator of
+        `(spec, None | NetlinkError)` tuples, see also
+        `route_batch()`.
+        '''
+        return self._request_batch(self._rule_request, command,
+                                   specs, window)
 
-        commands = {'add': RTM_NEWRULE,
-                    'del': RTM_DELRULE,
-                    'remove': RTM_DELRULE,
-                    'delete': RTM_DELRULE}
-        command = commands.get(command, command)
+    def sync_rules(self, desired, family=AF_INET, proto='RTPROT_STATIC',
+                   window=256):
+        '''
+        Converge policy routing rules to the desired state. The
+        `desired` argument is an iterable of dictionaries with
+        the same keywords as for `rule()`::
+
+            desired = [{'table': 100 + x,
+                        'priority': 1000 + x,
+                        'src': '10.0.%i.0' % x,
+                        'src_len': 24} for x in range(100)]
+            report = ip.sync_rules(desired)
+
+        * family -- the address family, default AF_INET
+        * proto -- the protocol (FRA_PROTOCOL) of managed rules
+        * window -- see `nlm_request_batch()`
+
+        Rules are dumped once and indexed by (priority, selector),
+        where the selector is the set of match criteria: source
+        and destination prefixes, tos, fwmark and mask, interface
+        names etc. Rules of the `proto` protocol, that are not
+        desired, are deleted; missing ones are added. Rules with
+        a changed action, table or other parameters are replaced:
+        since the kernel does not support NLM_F_REPLACE for rules,
+        the new version is added before the old one, that is
+        deleted only if the new one was added, so the traffic
+        always hits one of them.
+
+        Rules of other protocols, like default rules of the
+        kernel, are left untouched: specs that collide with them
+        are not applied, but reported as skipped. Notice, that
+        FRA_PROTOCOL is supported by kernels since 4.17; with
+        older kernels all rules are foreign.
+
+        All the changes are sent in one batch; old versions of
+        replaced rules are deleted with a follow-up one. Returns
+        the same report as `sync_routes()`.
+        '''
+        proto_id = rtprotos[proto]
+        selector = ('FRA_SRC', 'FRA_DST', 'FRA_IIFNAME', 'FRA_OIFNAME',
+                    'FRA_FWMARK', 'FRA_FWMASK', 'FRA_FLOW', 'FRA_TUN_ID',
+                    'FRA_L3MDEV', 'FRA_UID_RANGE', 'FRA_IP_PROTO',
+                    'FRA_SPORT_RANGE', 'FRA_DPORT_RANGE')
+
+        def normalize(name, value):
+            if name in ('FRA_SRC', 'FRA_DST') and value is not None:
+                return inet_pton(family, value)
+            if isinstance(value, dict):
+                # ranges
+                return (value.get('start'), value.get('end'))
+            return value
+
+        def key(msg):
+            attrs = dict([(x, normalize(x, msg.get_attr(x)))
+                          for x in selector])
+            # the kernel uses the full mask, if it is not set
+            if attrs['FRA_FWMARK'] and attrs['FRA_FWMASK'] is None:
+                attrs['FRA_FWMASK'] = 0xffffffff
+            return (msg.get_attr('FRA_PRIORITY') or 0,
+                    msg['src_len'],
+                    msg['dst_len'],
+                    msg['tos'],
+                    msg['flags'] & FIB_RULE_INVERT,
+                    tuple([attrs[x] for x in selector]))
+
+        def changed(want, rule):
+            if want['action'] != rule['action'] or \
+                    (want.get_attr('FRA_TABLE') or want['table']) != \
+                    (rule.get_attr('FRA_TABLE') or rule['table']):
+                return True
+            for (name, value) in want['attrs']:
+                if name in selector or \
+                        name in ('FRA_TABLE', 'FRA_PRIORITY',
+                                 'FRA_PROTOCOL') or \
+                        name not in want.r_nla_map:
+                    continue
+                if normalize(name, value) != \
+                        normalize(name, rule.get_attr(name)):
+                    return True
+            return False
+
+        # 8<-----------------------------------------------------
+        # index rules, keep only managed ones
+        index = {}
+        foreign = set()
+        duplicates = []
+        for rule in self.iter_rules(family):
+            if rule['header']['type'] != RTM_NEWRULE:
+                continue
+            k = key(rule)
+            if rule.get_attr('FRA_PROTOCOL') != proto_id:
+                foreign.add(k)
+            elif k in index:
+                duplicates.append(rule)
+            else:
+                index[k] = rule
+
+        # 8<-----------------------------------------------------
+        # compute the diff
+        ret = {'added': [],
+               'replaced': [],
+               'deleted': [],
+               'skipped': [],
+               'unchanged': 0,
+               'errors': []}
+        ops = []
+        stale = {}
+        seen = set()
+        for spec in desired:
+            spec = dict(spec)
+            spec['family'] = family
+            spec['protocol'] = proto_id
+            request = self._rule_request('add', **spec)
+            k = key(request[0])
+            seen.add(k)
+            if k in index:
+                if changed(request[0], index[k]):
+                    stale[len(ops)] = index[k]
+                    ops.append(('replaced', spec, request))
+                else:
+                    ret['unchanged'] += 1
+            elif k in foreign:
+                ret['skipped'].append(spec)
+            else:
+                ops.append(('added', spec, request))
+        for rule in [x[1] for x in index.items() if x[0] not in seen] + \
+                duplicates:
+            ops.append(('deleted', rule,
+                        (rule.raw, RTM_DELRULE, NLM_F_REQUEST | NLM_F_ACK)))
+
+        # 8<-----------------------------------------------------
+        # apply
+        results = self.nlm_request_batch([x[2] for x in ops], window)
+        for (op, (msg, result)) in enumerate(results):
+            (action, item, request) = ops[op]
+            if isinstance(result, NetlinkError):
+                ret['errors'].append((action, item, result))
+                stale.pop(op, None)
+            else:
+                ret[action].append(item)
+        # remove old versions of replaced rules
+        ops = [('replaced', ops[x][1],
+                (stale[x].raw, RTM_DELRULE, NLM_F_REQUEST | NLM_F_ACK))
+               for x in sorted(stale)]
+        results = self.nlm_request_batch([x[2] for x in ops], window)
+        for (op, (msg, result)) in enumerate(results):
+            if isinstance(result, NetlinkError):
+                ret['errors'].append(ops[op][:2] + (result, ))
+        return ret
 
-        msg_flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL
-        msg = rtmsg()
-        msg['table'] = table if table <= 255 else 252
+    def _rule_request(self, command, table=None, priority=32000,
+                      rtype='RTN_UNICAST', rtscope='RT_SCOPE_UNIVERSE',
+                      family=AF_INET, src=None, src_len=None, dst=None,
+                      dst_len=None, fwmark=None, **kwarg):
+        #
+        # Return (msg, msg_type, msg_flags) for a rule request,
+        # see rule() for parameters
+        #
+        if isinstance(rtype, basestring):
+            if rtype.startswith('FR_ACT_'):
+                action = FR_ACT_NAMES[rtype]
+            else:
+                # RTN_* types have the same values as FR_ACT_*
+                action = rtypes[rtype]
+        else:
+            action = rtype
+        if action == FR_ACT_TO_TBL and (table is None or table < 1):
+            raise ValueError('unsupported table number')
+
+        flags_base = NLM_F_REQUEST | NLM_F_ACK
+        commands = {'add': (RTM_NEWRULE,
+                            flags_base | NLM_F_CREATE | NLM_F_EXCL),
+                    'del': (RTM_DELRULE, flags_base),
+                    'remove': (RTM_DELRULE, flags_base),
+                    'delete': (RTM_DELRULE, flags_base)}
+        (command, msg_flags) = commands.get(command, command)
+
+        msg = fibmsg()
         msg['family'] = family
-        msg['type'] = rtypes[rtype]
-        msg['scope'] = rtscopes[rtscope]
-        msg['attrs'] = [['RTA_TABLE', table]]
-        msg['attrs'].append(['RTA_PRIORITY', priority])
+        msg['action'] = action
+        msg['tos'] = kwarg.pop('tos', 0)
+        msg['flags'] = kwarg.pop('flags', 0)
+        if table:
+            msg['table'] = table if table <= 255 else 252
+            msg['attrs'].append(['FRA_TABLE', table])
+        if priority is not None:
+            msg['attrs'].append(['FRA_PRIORITY', priority])
         if fwmark is not None:
-            msg['attrs'].append(['RTA_PROTOINFO', fwmark])
+            msg['attrs'].append(['FRA_FWMARK', fwmark])
         addr_len = {AF_INET6: 128, AF_INET:  32}[family]
         if(dst_len is not None and dst_len >= 0 and dst_len <= addr_len):
             msg['dst_len'] = dst_len
@@ -842,16 +2243,19 @@ class IPRouteMixin(object):
         else:
             msg['src_len'] = 0
         if src is not None:
-            msg['attrs'].append(['RTA_SRC', src])
+            msg['attrs'].append(['FRA_SRC', src])
             if src_len is None:
                 msg['src_len'] = addr_len
         if dst is not None:
-            msg['attrs'].append(['RTA_DST', dst])
+            msg['attrs'].append(['FRA_DST', dst])
             if dst_len is None:
                 msg['dst_len'] = addr_len
+        for key in kwarg:
+            nla = fibmsg.name2nla(key)
+            if kwarg[key] is not None:
+                msg['attrs'].append([nla, kwarg[key]])
 
-        return self.nlm_request(msg, msg_type=command,
-                                msg_flags=msg_flags)
+        return (msg, command, msg_flags)
     # 8<---------------------------------------------------------------
 
 
@@ -76,13 +76,33 @@ but it doesn't help much. So keep it in mind, and if you
 expect massive broadcast Netlink storms, perform stress
 testing prior to deploy a solution in the production.
 
+socket buffers
+--------------
+
+By default the socket uses 32k send and 1M receive buffers.
+With `set_buffer_policy()` one can set other sizes, force
+them over the sysctl limits with SO_RCVBUFFORCE (requires
+CAP_NET_ADMIN), or let the socket grow the receive buffer
+on overruns::
+
+    ip = IPRoute()
+    ip.set_buffer_policy('adaptive',
+                         rcvbuf=4 * 1024 * 1024,
+                         maxbuf=64 * 1024 * 1024,
+                         callback=lambda sock, info: print(info))
+
+Please notice, that the ENOBUF error is raised anyway, the
+buffer is resized after that.
+
 classes
 -------
 '''
 
 import os
 import time
+import errno
 import struct
+import collections
 import logging
 import traceback
 import threading
@@ -106,6 +126,7 @@ from pyroute2.netlink import NetlinkHeaderDecodeError
 from pyroute2.netlink import NLMSG_ERROR
 from pyroute2.netlink import NLMSG_DONE
 from pyroute2.netlink import NETLINK_GENERIC
+from pyroute2.netlink import NLM_F_ACK
 from pyroute2.netlink import NLM_F_DUMP
 from pyroute2.netlink import NLM_F_MULTI
 from pyroute2.netlink import NLM_F_REQUEST
@@ -115,6 +136,17 @@ try:
 except ImportError:
     from queue import Queue
 
+try:
+    from socket import SO_SNDBUFFORCE
+    from socket import SO_RCVBUFFORCE
+except ImportError:
+    SO_SNDBUFFORCE = 32
+    SO_RCVBUFFORCE = 33
+
+# default socket buffers
+SNDBUF = 32768
+RCVBUF = 1024 * 1024
+
 
 class Marshal(object):
     '''
@@ -129,6 +161,8 @@ class Marshal(object):
         # one marshal instance can be used to parse one
         # message at once
         self.msg_map = self.msg_map or {}
+        # per-request msg_map overrides, {msg_seq: msg_map}
+        self.seq_map = {}
         self.defragmentation = {}
 
     def parse(self, data):
@@ -143,14 +177,16 @@ class Marshal(object):
         result = []
         while offset < len(data):
             # pick type and length
-            (length, msg_type) = struct.unpack('IH', data[offset:offset+6])
+            (length, msg_type, msg_flags, msg_seq) = \
+                struct.unpack('IHHI', data[offset:offset+12])
             error = None
             if msg_type == NLMSG_ERROR:
                 code = abs(struct.unpack('i', data[offset+16:offset+20])[0])
                 if code > 0:
                     error = NetlinkError(code)
 
-            msg_class = self.msg_map.get(msg_type, nlmsg)
+            msg_map = self.seq_map.get(msg_seq, self.msg_map)
+            msg_class = msg_map.get(msg_type, nlmsg)
             msg = msg_class(data[offset:offset+length], debug=self.debug)
 
             try:
@@ -295,14 +331,120 @@ class NetlinkMixin(object):
         self.marshal = Marshal()
         # 8<-----------------------------------------
         # Set default sockopts
-        self.setsockopt(SOL_SOCKET, SO_SNDBUF, 32768)
-        self.setsockopt(SOL_SOCKET, SO_RCVBUF, 1024 * 1024)
+        self.buffer_policy = None
+        self.set_buffer_policy()
 
     def release(self):
         logging.warning("The `release()` call is deprecated")
         logging.warning("Use `close()` instead")
         self.close()
 
+    def set_buffer_policy(self, policy='fixed',
+                          rcvbuf=RCVBUF,
+                          sndbuf=SNDBUF,
+                          maxbuf=RCVBUF * 64,
+                          highwater=1000,
+                          callback=None):
+        '''
+        Set the socket buffers policy. Policies are:
+
+        * fixed -- just set SO_RCVBUF and SO_SNDBUF; the kernel
+          limits the size with net.core.rmem_max and wmem_max
+        * force -- use SO_RCVBUFFORCE and SO_SNDBUFFORCE, that
+          ignore the limits; requires CAP_NET_ADMIN, without it
+          the policy works as `fixed`
+        * adaptive -- start as `force`, and double the receive
+          buffer up to `maxbuf` every time the socket overruns
+          (ENOBUFS), or the async I/O queue gets more than
+          `highwater` datagrams
+
+        The `callback`, if set, will be called on every resize
+        as `callback(socket, info)`, where info is the dictionary
+        returned by `get_buffer_info()`, plus the `reason` key.
+
+        Returns `get_buffer_info()`. Example::
+
+            ip = IPRoute()
+            ip.set_buffer_policy('adaptive', rcvbuf=4 * 1024 * 1024)
+            ip.bind()
+            ...
+            print(ip.get_buffer_info())
+        '''
+        assert policy in ('fixed', 'force', 'adaptive')
+        force = policy != 'fixed'
+        self.buffer_policy = {'policy': policy,
+                              'rcvbuf': rcvbuf,
+                              'sndbuf': sndbuf,
+                              'maxbuf': max(maxbuf, rcvbuf),
+                              'highwater': highwater,
+                              'callback': callback,
+                              'forced': None,
+                              'overruns': 0,
+                              'resizes': 0}
+        self.buffer_policy['forced'] = \
+            self._set_buffer(SO_SNDBUF, SO_SNDBUFFORCE, sndbuf, force) & \
+            self._set_buffer(SO_RCVBUF, SO_RCVBUFFORCE, rcvbuf, force)
+        return self.get_buffer_info()
+
+    def get_buffer_info(self):
+        '''
+        Return the buffer policy and the effective buffer sizes,
+        as reported by the kernel. Please notice, that the kernel
+        doubles the requested values for the bookkeeping overhead.
+        '''
+        return {'policy': self.buffer_policy['policy'],
+                'rcvbuf': self.getsockopt(SOL_SOCKET, SO_RCVBUF),
+                'sndbuf': self.getsockopt(SOL_SOCKET, SO_SNDBUF),
+                'forced': self.buffer_policy['forced'],
+                'overruns': self.buffer_policy['overruns'],
+                'resizes': self.buffer_policy['resizes']}
+
+    def grow_buffer(self, reason='manual'):
+        '''
+        Double the receive buffer, if the `adaptive` policy is
+        set and `maxbuf` is not reached yet. Return True if the
+        buffer is resized.
+
+        The routine is called automatically on socket overruns
+        and queue high-water marks.
+        '''
+        bp = self.buffer_policy
+        if reason == 'overrun':
+            bp['overruns'] += 1
+        if bp['policy'] != 'adaptive' or bp['rcvbuf'] >= bp['maxbuf']:
+            return False
+        bp['rcvbuf'] = min(bp['rcvbuf'] * 2, bp['maxbuf'])
+        bp['highwater'] *= 2
+        bp['forced'] = self._set_buffer(SO_RCVBUF,
+                                        SO_RCVBUFFORCE,
+                                        bp['rcvbuf'],
+                                        True)
+        bp['resizes'] += 1
+        info = self.get_buffer_info()
+        info['reason'] = reason
+        logging.info("Netlink socket buffer resized: %s" % (info))
+        if bp['callback'] is not None:
+            try:
+                bp['callback'](self, info)
+            except Exception:
+                logging.warning("Buffer callback fail: %s" % (bp['callback']))
+                logging.warning(traceback.format_exc())
+        return True
+
+    def _set_buffer(self, option, force_option, size, force):
+        #
+        # Returns True if the forced option is applied
+        #
+        if force:
+            try:
+                self.setsockopt(SOL_SOCKET, force_option, size)
+                return True
+            except SocketError as e:
+                if e.errno != errno.EPERM:
+                    raise
+        self.setsockopt(SOL_SOCKET, option, size)
+        return False
+
     def register_callback(self, callback,
                           predicate=lambda e, x: True, args=None):
         '''
@@ -531,23 +673,44 @@ class NetlinkMixin(object):
         try:
             if msg_seq not in self.backlog:
                 self.backlog[msg_seq] = []
-            if not isinstance(msg, nlmsg):
-                msg_class = self.marshal.msg_map[msg_type]
-                msg = msg_class(msg)
-            if msg_pid is None:
-                msg_pid = os.getpid()
-            msg['header']['type'] = msg_type
-            msg['header']['flags'] = msg_flags
-            msg['header']['sequence_number'] = msg_seq
-            msg['header']['pid'] = msg_pid
-            msg.encode()
-            self.sendto(msg.buf.getvalue(), addr)
+            self.sendto(self.encode_request(msg, msg_type, msg_flags,
+                                            msg_seq, msg_pid), addr)
         except:
             raise
         finally:
             if msg_seq != 0:
                 self.lock[msg_seq].release()
 
+    def encode_request(self, msg, msg_type,
+                       msg_flags=NLM_F_REQUEST,
+                       msg_seq=0,
+                       msg_pid=None):
+        '''
+        Construct a message from a dictionary, if required,
+        set the header and return the encoded binary data.
+        Parameters are the same as for `put()`.
+
+        The `msg` can be also an already encoded message, e.g.
+        `raw` attribute of a received one. Then only the header
+        fields are patched, and the rest is sent as is.
+        '''
+        if msg_pid is None:
+            msg_pid = os.getpid()
+        if isinstance(msg, (bytes, bytearray)):
+            msg = bytearray(msg)
+            struct.pack_into('HHII', msg, 4,
+                             msg_type, msg_flags, msg_seq, msg_pid)
+            return bytes(msg)
+        if not isinstance(msg, nlmsg):
+            msg_class = self.marshal.msg_map[msg_type]
+            msg = msg_class(msg)
+        msg['header']['type'] = msg_type
+        msg['header']['flags'] = msg_flags
+        msg['header']['sequence_number'] = msg_seq
+        msg['header']['pid'] = msg_pid
+        msg.encode()
+        return msg.buf.getvalue()
+
     def get(self, bufsize=DEFAULT_RCVBUF, msg_seq=0, terminate=None):
         '''
         Get parsed messages list. If `msg_seq` is given, return
@@ -562,6 +725,35 @@ class NetlinkMixin(object):
               the network data
         * 0: bufsize will be calculated from SO_RCVBUF sockopt
         * int >= 0: just a bufsize
+
+        The `terminate` parameter, if given, is a function, that
+        gets a message and returns True on the response end. The
+        terminating message is not returned. With `terminate`
+        messages without NLM_F_MULTI do not end the response.
+        '''
+        ret = []
+        for chunk in self.get_chunks(bufsize, msg_seq, terminate):
+            ret.extend(chunk)
+        return ret
+
+    def get_iter(self, bufsize=DEFAULT_RCVBUF, msg_seq=0, terminate=None):
+        '''
+        The same as `get()`, but returns a generator. Messages
+        are yielded as soon as they are received, so the whole
+        response is never kept in memory.
+        '''
+        for chunk in self.get_chunks(bufsize, msg_seq, terminate):
+            for msg in chunk:
+                yield msg
+
+    def get_chunks(self, bufsize=DEFAULT_RCVBUF, msg_seq=0, terminate=None):
+        '''
+        The engine behind `get()` and `get_iter()`. Yields lists
+        of messages, one list per backlog round. Parameters are
+        the same as for `get()`.
+
+        No lock except `self.lock[msg_seq]` is held while the
+        generator is suspended.
         '''
         ctime = time.time()
 
@@ -573,7 +765,6 @@ class NetlinkMixin(object):
                 # get bufsize from SO_RCVBUF
                 bufsize = self.getsockopt(SOL_SOCKET, SO_RCVBUF) // 2
 
-            ret = []
             enough = False
             while not enough:
                 # 8<-----------------------------------------------------------
@@ -594,10 +785,11 @@ class NetlinkMixin(object):
                     #
                     # Load the backlog, if there is valid
                     # content in it
-                    ret.extend(self.backlog[0])
+                    ret = self.backlog[0]
                     self.backlog[0] = []
                     # And just exit
                     self.backlog_lock.release()
+                    yield ret
                     break
                 elif self.backlog.get(msg_seq, None):
                     # Any other msg_seq.
@@ -607,10 +799,15 @@ class NetlinkMixin(object):
                     #  * NLMSG_ERROR != 0
                     #  * NLMSG_DONE
                     #  * terminate() function (if defined)
-                    #  * not NLM_F_MULTI
+                    #  * not NLM_F_MULTI, if there is no terminate()
+                    #
+                    # With terminate() single messages do not end
+                    # the response: e.g., with NLM_F_ECHO the kernel
+                    # sends echoed messages and then the ACK.
                     #
                     # Please note, that if terminator not occured,
                     # more `recv()` rounds CAN be required.
+                    ret = []
                     for msg in tuple(self.backlog[msg_seq]):
 
                         # Drop the message from the backlog, if any
@@ -636,7 +833,8 @@ class NetlinkMixin(object):
                         if not enough:
                             ret.append(msg)
                             # But finish the loop on single messages
-                            if not msg['header']['flags'] & NLM_F_MULTI:
+                            if terminate is None and \
+                                    not msg['header']['flags'] & NLM_F_MULTI:
                                 # but not multi -- so end the loop
                                 enough = True
 
@@ -649,6 +847,8 @@ class NetlinkMixin(object):
 
                     # Next iteration
                     self.backlog_lock.release()
+                    if ret:
+                        yield ret
                 else:
                     # Stage 1. END
                     #
@@ -672,7 +872,7 @@ class NetlinkMixin(object):
                         if self.get_timeout_exception:
                             raise self.get_timeout_exception()
                         else:
-                            return ret
+                            return
                     #
                     if self.read_lock.acquire(False):
                         self.change_master.clear()
@@ -681,7 +881,15 @@ class NetlinkMixin(object):
                         #
                         # This is a time consuming process, so all the
                         # locks, except the read lock must be released
-                        data = self.recv_plugin(bufsize)
+                        try:
+                            data = self.recv_plugin(bufsize)
+                        except Exception as e:
+                            # Do not leave the socket locked
+                            self.change_master.set()
+                            self.read_lock.release()
+                            if getattr(e, 'errno', None) == errno.ENOBUFS:
+                                self.grow_buffer('overrun')
+                            raise e
                         # Parse data
                         msgs = self.marshal.parse(data)
                         # Reset ctime -- timeout should be measured
@@ -701,6 +909,8 @@ class NetlinkMixin(object):
                                 logging.debug(message)
                             else:
                                 logging.warning(message)
+                            if current > self.buffer_policy['highwater']:
+                                self.grow_buffer('highwater')
                             time.sleep(delay)
                         self.qsize = current
 
@@ -746,14 +956,15 @@ class NetlinkMixin(object):
                     #
                     # 8<-------------------------------------------------------
 
-            return ret
-
     def nlm_request(self, msg, msg_type,
                     msg_flags=NLM_F_REQUEST | NLM_F_DUMP,
-                    terminate=None):
+                    terminate=None,
+                    msg_map=None):
         msg_seq = self.addr_pool.alloc()
         with self.lock[msg_seq]:
             try:
+                if msg_map is not None:
+                    self.marshal.seq_map[msg_seq] = msg_map
                 self.put(msg, msg_type, msg_flags, msg_seq=msg_seq)
                 ret = self.get(msg_seq=msg_seq, terminate=terminate)
                 return ret
@@ -772,8 +983,185 @@ class NetlinkMixin(object):
                 # just dropped.
                 #
                 # Hack, but true.
+                self.marshal.seq_map.pop(msg_seq, None)
+                self.addr_pool.free(msg_seq, ban=0xff)
+
+    def nlm_request_iter(self, msg, msg_type,
+                         msg_flags=NLM_F_REQUEST | NLM_F_DUMP,
+                         terminate=None,
+                         msg_map=None):
+        '''
+        The same as `nlm_request()`, but returns a generator,
+        that yields response messages as they arrive. It allows
+        to process huge dumps without keeping them in memory::
+
+            for msg in ipr.nlm_request_iter(rtmsg(), RTM_GETROUTE):
+                print(msg.get_attr('RTA_DST'))
+
+        If the generator is stopped before the response end, e.g.
+        with `break` or `close()`, the rest of the response is
+        drained from the socket and discarded, so the socket
+        stays usable for next requests.
+
+        The `msg_map` argument, if given, replaces the marshal
+        msg_map for the response, e.g. to use lean decoders,
+        that parse only required NLA::
+
+            msg_map = {RTM_NEWLINK: ifinfstats}
+            for msg in ipr.nlm_request_iter(ifinfmsg(), RTM_GETLINK,
+                                            msg_map=msg_map):
+                print(msg['stats'])
+        '''
+        msg_seq = self.addr_pool.alloc()
+        with self.lock[msg_seq]:
+            try:
+                if msg_map is not None:
+                    self.marshal.seq_map[msg_seq] = msg_map
+                self.put(msg, msg_type, msg_flags, msg_seq=msg_seq)
+                chunks = self.get_chunks(msg_seq=msg_seq, terminate=terminate)
+                for chunk in chunks:
+                    for msg in chunk:
+                        yield msg
+            except GeneratorExit:
+                # The consumer has gone, but the kernel continues
+                # to send the response; read it up to the end
+                try:
+                    for chunk in chunks:
+                        pass
+                except Exception:
+                    pass
+            finally:
+                # see nlm_request() on the ban
+                self.marshal.seq_map.pop(msg_seq, None)
                 self.addr_pool.free(msg_seq, ban=0xff)
 
+    def nlm_request_batch(self, msgs, window=256, bufsize=16384):
+        '''
+        Send a batch of requests and collect ACKs. The `msgs`
+        argument is an iterable of `(msg, msg_type, msg_flags)`
+        tuples; NLM_F_ACK is added to all the requests.
+
+        Requests are encoded back-to-back into datagrams up to
+        `bufsize` bytes, and no more than `window` requests can
+        wait for ACK at once -- the kernel drops ACKs when the
+        socket receive buffer is full.
+
+        Returns a generator, that yields `(msg, result)` tuples
+        in the order of requests. The result is the list of
+        response messages (empty for a plain ACK) or, if the
+        request failed, the `NetlinkError` instance::
+
+            reqs = [(msg1, RTM_NEWROUTE, flags),
+                    (msg2, RTM_NEWROUTE, flags)]
+            for (msg, result) in ipr.nlm_request_batch(reqs):
+                if isinstance(result, NetlinkError):
+                    print("failed: %s" % (result))
+
+        The kernel processes messages of one datagram one by
+        one, so failed requests do not affect others.
+        '''
+        pending = collections.deque()
+        requests = iter(msgs)
+        exhausted = False
+        # the send proxy inspects only the first message in the
+        # datagram, so proxied messages must be sent alone
+        proxy = getattr(self, '_sproxy', None)
+        proxied = proxy.pmap if proxy is not None else {}
+        acks = set()
+
+        def terminate(msg):
+            if msg['header']['type'] == NLMSG_ERROR:
+                acks.add(msg['header']['sequence_number'])
+                return True
+            return False
+
+        def flush(data, unsent):
+            self.sendto(data, (0, 0))
+            pending.extend(unsent)
+            del unsent[:]
+            return b''
+
+        try:
+            while True:
+                # refill the window only when it is half empty,
+                # so datagrams are big enough
+                if not exhausted and len(pending) <= window // 2:
+                    data = b''
+                    unsent = []
+                    try:
+                        while len(pending) + len(unsent) < window:
+                            try:
+                                (msg, msg_type, msg_flags) = next(requests)
+                            except StopIteration:
+                                exhausted = True
+                                break
+                            msg_seq = self.addr_pool.alloc()
+                            self.backlog[msg_seq] = []
+                            unsent.append((msg_seq, msg))
+                            packet = self.encode_request(msg, msg_type,
+                                                         msg_flags |
+                                                         NLM_F_ACK,
+                                                         msg_seq)
+                            if msg_type in proxied:
+                                if data:
+                                    last = unsent.pop()
+                                    data = flush(data, unsent)
+                                    unsent.append(last)
+                                data = flush(packet, unsent)
+                                continue
+                            if data and len(data) + len(packet) > bufsize:
+                                last = unsent.pop()
+                                data = flush(data, unsent)
+                                unsent.append(last)
+                            data += packet
+                        if data:
+                            data = flush(data, unsent)
+                    except:
+                        # nothing will arrive for unsent requests
+                        for (msg_seq, msg) in unsent:
+                            self.backlog.pop(msg_seq, None)
+                            self.addr_pool.free(msg_seq)
+                        raise
+
+                if not pending:
+                    break
+
+                (msg_seq, msg) = pending.popleft()
+                try:
+                    result = self.get(msg_seq=msg_seq, terminate=terminate)
+                except NetlinkError as e:
+                    result = e
+                    acks.add(msg_seq)
+                finally:
+                    # the ACK is consumed, so there is no need to ban
+                    # msg_seq, see nlm_request()
+                    self.free_seq(msg_seq, msg_seq not in acks)
+                    acks.discard(msg_seq)
+                yield (msg, result)
+        finally:
+            # the consumer has gone or an error occured, but
+            # responses are on the way; read them
+            while pending:
+                (msg_seq, msg) = pending.popleft()
+                try:
+                    self.get(msg_seq=msg_seq, terminate=terminate)
+                    acks.add(msg_seq)
+                except NetlinkError:
+                    acks.add(msg_seq)
+                except Exception:
+                    pass
+                self.free_seq(msg_seq, msg_seq not in acks)
+                acks.discard(msg_seq)
+
+    def free_seq(self, msg_seq, ban=True):
+        '''
+        Return msg_seq to the pool. With `ban`, the msg_seq will
+        not be reused for 0xff allocations, so late responses
+        become orphaned and dropped.
+        '''
+        self.backlog.pop(msg_seq, None)
+        self.addr_pool.free(msg_seq, ban=0xff if ban else 0)
+
     def close(self):
         '''
         Correctly close the socket and free all resources.
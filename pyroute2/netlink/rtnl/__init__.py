@@ -35,6 +35,7 @@ Module contents:
 
 '''
 
+import struct
 from pyroute2.proxy import NetlinkProxy
 from pyroute2.common import map_namespace
 from pyroute2.common import ANCIENT
@@ -43,6 +44,7 @@ from pyroute2.netlink.nlsocket import Marshal
 from pyroute2.netlink.nlsocket import NetlinkSocket
 from pyroute2.netlink.rtnl.tcmsg import tcmsg
 from pyroute2.netlink.rtnl.rtmsg import rtmsg
+from pyroute2.netlink.rtnl.fibmsg import fibmsg
 from pyroute2.netlink.rtnl.ndmsg import ndmsg
 from pyroute2.netlink.rtnl.dhcpmsg import dhcpmsg
 from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
@@ -185,9 +187,9 @@ class MarshalRtnl(Marshal):
                RTM_NEWROUTE: rtmsg,
                RTM_DELROUTE: rtmsg,
                RTM_GETROUTE: rtmsg,
-               RTM_NEWRULE: rtmsg,
-               RTM_DELRULE: rtmsg,
-               RTM_GETRULE: rtmsg,
+               RTM_NEWRULE: fibmsg,
+               RTM_DELRULE: fibmsg,
+               RTM_GETRULE: fibmsg,
                RTM_NEWNEIGH: ndmsg,
                RTM_DELNEIGH: ndmsg,
                RTM_GETNEIGH: ndmsg,
@@ -259,6 +261,11 @@ class IPRSocketMixin(object):
 
     def proxy_recv(self, bufsize, flags=0):
         data = self._recv(bufsize, flags)
+        # responses to requests with own msg_map, see nlm_request(),
+        # are parsed with lean decoders and are not proxied
+        if self.marshal.seq_map and len(data) >= 12 and \
+                struct.unpack('I', data[8:12])[0] in self.marshal.seq_map:
+            return data
         ret = self._rproxy.handle(data)
         if ret is not None:
             if ret['verdict'] in ('forward', 'error'):
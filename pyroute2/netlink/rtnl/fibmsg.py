@@ -0,0 +1,96 @@
+from pyroute2.common import map_namespace
+from pyroute2.netlink import nlmsg
+from pyroute2.netlink import nla
+
+# rule actions
+FR_ACT_UNSPEC = 0
+FR_ACT_TO_TBL = 1
+FR_ACT_GOTO = 2
+FR_ACT_NOP = 3
+FR_ACT_RES3 = 4
+FR_ACT_RES4 = 5
+FR_ACT_BLACKHOLE = 6
+FR_ACT_UNREACHABLE = 7
+FR_ACT_PROHIBIT = 8
+
+(FR_ACT_NAMES, FR_ACT_VALUES) = map_namespace('FR_ACT', globals())
+
+# rule flags
+FIB_RULE_PERMANENT = 0x01
+FIB_RULE_INVERT = 0x02
+FIB_RULE_UNRESOLVED = 0x04
+FIB_RULE_IIF_DETACHED = 0x08
+FIB_RULE_OIF_DETACHED = 0x10
+FIB_RULE_FIND_SADDR = 0x10000
+
+(FIB_RULE_NAMES, FIB_RULE_VALUES) = map_namespace('FIB_RULE', globals())
+
+
+class fibmsg(nlmsg):
+    '''
+    Policy routing rule message
+
+    struct fib_rule_hdr {
+        __u8    family;
+        __u8    dst_len;
+        __u8    src_len;
+        __u8    tos;
+
+        __u8    table;
+        __u8    res1;   /* reserved */
+        __u8    res2;   /* reserved */
+        __u8    action;
+
+        __u32   flags;
+    };
+
+    The header shares the layout with `rtmsg`, and FRA_DST,
+    FRA_SRC, FRA_PRIORITY, FRA_FWMARK and FRA_TABLE have the
+    same types as corresponding RTA_* NLA, but the rest of
+    the NLA differs.
+    '''
+    prefix = 'FRA_'
+
+    fields = (('family', 'B'),
+              ('dst_len', 'B'),
+              ('src_len', 'B'),
+              ('tos', 'B'),
+              ('table', 'B'),
+              ('res1', 'B'),
+              ('res2', 'B'),
+              ('action', 'B'),
+              ('flags', 'I'))
+
+    nla_map = (('FRA_UNSPEC', 'none'),
+               ('FRA_DST', 'ipaddr'),
+               ('FRA_SRC', 'ipaddr'),
+               ('FRA_IIFNAME', 'asciiz'),
+               ('FRA_GOTO', 'uint32'),
+               ('FRA_UNUSED2', 'none'),
+               ('FRA_PRIORITY', 'uint32'),
+               ('FRA_UNUSED3', 'none'),
+               ('FRA_UNUSED4', 'none'),
+               ('FRA_UNUSED5', 'none'),
+               ('FRA_FWMARK', 'uint32'),
+               ('FRA_FLOW', 'uint32'),
+               ('FRA_TUN_ID', 'be64'),
+               ('FRA_SUPPRESS_IFGROUP', 'uint32'),
+               ('FRA_SUPPRESS_PREFIXLEN', 'uint32'),
+               ('FRA_TABLE', 'uint32'),
+               ('FRA_FWMASK', 'uint32'),
+               ('FRA_OIFNAME', 'asciiz'),
+               ('FRA_PAD', 'none'),
+               ('FRA_L3MDEV', 'uint8'),
+               ('FRA_UID_RANGE', 'uid_range'),
+               ('FRA_PROTOCOL', 'uint8'),
+               ('FRA_IP_PROTO', 'uint8'),
+               ('FRA_SPORT_RANGE', 'port_range'),
+               ('FRA_DPORT_RANGE', 'port_range'))
+
+    class uid_range(nla):
+        fields = (('start', 'I'),
+                  ('end', 'I'))
+
+    class port_range(nla):
+        fields = (('start', 'H'),
+                  ('end', 'H'))
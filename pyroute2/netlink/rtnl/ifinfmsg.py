@@ -176,7 +176,7 @@ class ifinfbase(object):
                ('IFLA_AF_SPEC', 'af_spec'),
                ('IFLA_GROUP', 'uint32'),
                ('IFLA_NET_NS_FD', 'netns_fd'),
-               ('IFLA_EXT_MASK', 'hex'),
+               ('IFLA_EXT_MASK', 'uint32'),
                ('IFLA_PROMISCUITY', 'uint32'),
                ('IFLA_NUM_TX_QUEUES', 'uint32'),
                ('IFLA_NUM_RX_QUEUES', 'uint32'),
@@ -527,6 +527,72 @@ class ifinfveth(ifinfbase, nla):
     pass
 
 
+class ifinflean(ifinfmsg):
+    '''
+    Lean RTM_NEWLINK decoder. IFLA_AF_SPEC is not decoded, but
+    returned as raw bytes: per-family data, first of all the
+    IPv6 devconf array and IPv6/ICMPv6 statistics, is the most
+    expensive part of the message to decode, and it is rarely
+    used. Use `get_af_spec()` to decode it on demand. Used with
+    IFLA_EXT_MASK and RTEXT_FILTER_SKIP_STATS, see
+    `IPRoute.get_links(lean=True)`.
+    '''
+    nla_map = tuple([(x[0], 'cdata') if x[0] == 'IFLA_AF_SPEC' else x
+                     for x in ifinfbase.nla_map])
+
+    def get_af_spec(self):
+        '''
+        Decode the raw IFLA_AF_SPEC; returns the same NLA as
+        `get_attr('IFLA_AF_SPEC')` of the full decoder, or None
+        '''
+        data = self.get_attr('IFLA_AF_SPEC')
+        if data is None:
+            return None
+        ret = ifinfmsg.af_spec(struct.pack('HH', len(data) + 4,
+                                           IFLA_AF_SPEC) + data)
+        ret.decode()
+        return ret
+
+
+IFLA_IFNAME = [x[0] for x in ifinfbase.nla_map].index('IFLA_IFNAME')
+IFLA_AF_SPEC = [x[0] for x in ifinfbase.nla_map].index('IFLA_AF_SPEC')
+IFLA_STATS64 = [x[0] for x in ifinfbase.nla_map].index('IFLA_STATS64')
+RTEXT_FILTER_VF = 1
+RTEXT_FILTER_SKIP_STATS = 8
+
+
+class ifinfstats(nlmsg):
+    '''
+    Lean RTM_NEWLINK decoder for counter polling. Only the
+    ifinfmsg fields, IFLA_IFNAME and IFLA_STATS64 are decoded,
+    all other NLA are skipped without parsing. Results are
+    stored as `msg['ifname']` and `msg['stats']` -- the tuple
+    of counters in the `stats_names` order, or None.
+    '''
+    fields = ifinfbase.fields
+    stats = struct.Struct('%iQ' % (len(stats_names)))
+
+    def decode(self):
+        nlmsg.decode(self)
+        self['ifname'] = None
+        self['stats'] = None
+        data = self.raw
+        offset = 32
+        while offset + 4 <= len(data):
+            (length, nla_type) = struct.unpack_from('HH', data, offset)
+            if length < 4:
+                break
+            if nla_type == IFLA_IFNAME:
+                ifname = data[offset + 4:offset + length].rstrip(b'\0')
+                if not isinstance(ifname, str):
+                    ifname = ifname.decode('utf-8')
+                self['ifname'] = ifname
+            elif nla_type == IFLA_STATS64 and \
+                    length - 4 >= self.stats.size:
+                self['stats'] = self.stats.unpack_from(data, offset + 4)
+            offset += (length + 3) & ~3
+
+
 def proxy_linkinfo(data, nl):
     offset = 0
     inbox = []
@@ -1,6 +1,32 @@
-
+import socket
+from pyroute2.common import map_namespace
 from pyroute2.netlink import nlmsg
 from pyroute2.netlink import nla
+from pyroute2.netlink import nla_base
+from pyroute2.netlink import nlmsg_atoms
+
+# neighbor cache entry states
+NUD_NONE = 0x00
+NUD_INCOMPLETE = 0x01
+NUD_REACHABLE = 0x02
+NUD_STALE = 0x04
+NUD_DELAY = 0x08
+NUD_PROBE = 0x10
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+NUD_PERMANENT = 0x80
+
+(NUD_NAMES, NUD_VALUES) = map_namespace('NUD', globals())
+
+# neighbor cache entry flags
+NTF_USE = 0x01
+NTF_SELF = 0x02
+NTF_MASTER = 0x04
+NTF_PROXY = 0x08
+NTF_EXT_LEARNED = 0x10
+NTF_ROUTER = 0x80
+
+(NTF_NAMES, NTF_VALUES) = map_namespace('NTF', globals())
 
 
 class ndmsg(nlmsg):
@@ -22,6 +48,8 @@ class ndmsg(nlmsg):
         __u32         ndm_refcnt;
     };
     '''
+    prefix = 'NDA_'
+
     fields = (('family', 'i'),
               ('ifindex', 'i'),
               ('state', 'H'),
@@ -39,17 +67,48 @@ class ndmsg(nlmsg):
     # ...
     #
     nla_map = (('NDA_UNSPEC', 'none'),
-               ('NDA_DST', 'ipaddr'),
+               ('NDA_DST', 'ndaddr'),
                ('NDA_LLADDR', 'l2addr'),
                ('NDA_CACHEINFO', 'cacheinfo'),
                ('NDA_PROBES', 'uint32'),
                ('NDA_VLAN', 'uint16'),
                ('NDA_PORT', 'be16'),
                ('NDA_VNI', 'be32'),
-               ('NDA_IFINDEX', 'uint32'))
+               ('NDA_IFINDEX', 'uint32'),
+               ('NDA_MASTER', 'uint32'),
+               ('NDA_LINK_NETNSID', 'uint32'),
+               ('NDA_SRC_VNI', 'uint32'))
 
     class cacheinfo(nla):
         fields = (('ndm_confirmed', 'I'),
                   ('ndm_used', 'I'),
                   ('ndm_updated', 'I'),
                   ('ndm_refcnt', 'I'))
+
+    class ndaddr(nlmsg_atoms.ipaddr):
+        '''
+        FDB records (AF_BRIDGE) can refer IPv4 or IPv6 remote
+        addresses, e.g. VXLAN, so in that case the family is
+        detected by the address format.
+        '''
+        fields = [('value', 's')]
+
+        def encode(self):
+            family = self.parent['family']
+            if family not in (socket.AF_INET, socket.AF_INET6):
+                if self.value.find(':') > -1:
+                    family = socket.AF_INET6
+                else:
+                    family = socket.AF_INET
+            self['value'] = socket.inet_pton(family, self.value)
+            nla_base.encode(self)
+
+        def decode(self):
+            nla_base.decode(self)
+            family = self.parent['family']
+            if family not in (socket.AF_INET, socket.AF_INET6):
+                if len(self['value']) == 16:
+                    family = socket.AF_INET6
+                else:
+                    family = socket.AF_INET
+            self.value = socket.inet_ntop(family, self['value'])
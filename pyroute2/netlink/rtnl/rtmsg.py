@@ -1,6 +1,35 @@
 
+import struct
+from socket import inet_pton
+from socket import inet_ntop
+from pyroute2.common import LRUCache
 from pyroute2.netlink import nlmsg
 from pyroute2.netlink import nla
+from pyroute2.netlink import nla_base
+from pyroute2.netlink import NLMSG_ALIGN
+
+# struct rtnexthop and NLA header
+RTNH = struct.Struct('HBBi')
+NLA_HEADER = struct.Struct('HH')
+# NLA types, used within rtnexthop
+RTA_GATEWAY = 5
+RTA_FLOW = 11
+
+# encoded nexthop sets, {(family, nexthops): bytes}
+nexthop_cache = LRUCache(1024)
+
+
+def nexthop_key(nexthop):
+    '''
+    Return the normalized nexthop tuple:
+    (gateway, oif, hops, flags, flow), where the
+    gateway is a string or None.
+    '''
+    return (nexthop.get('gateway'),
+            nexthop.get('oif') or 0,
+            nexthop.get('hops') or 0,
+            nexthop.get('flags') or 0,
+            nexthop.get('flow'))
 
 
 class rtmsg(nlmsg):
@@ -42,7 +71,7 @@ class rtmsg(nlmsg):
                ('RTA_PRIORITY', 'uint32'),
                ('RTA_PREFSRC', 'ipaddr'),
                ('RTA_METRICS', 'metrics'),
-               ('RTA_MULTIPATH', 'hex'),
+               ('RTA_MULTIPATH', 'multipath'),
                ('RTA_PROTOINFO', 'uint32'),
                ('RTA_FLOW', 'hex'),
                ('RTA_CACHEINFO', 'cacheinfo'),
@@ -79,3 +108,82 @@ class rtmsg(nlmsg):
                   ('rta_id', 'I'),
                   ('rta_ts', 'I'),
                   ('rta_tsage', 'I'))
+
+    class multipath(nla_base):
+        '''
+        RTA_MULTIPATH, an array of rtnexthop structures::
+
+            struct rtnexthop {
+                unsigned short rtnh_len;
+                unsigned char  rtnh_flags;
+                unsigned char  rtnh_hops;
+                int            rtnh_ifindex;
+            };
+
+        every one followed by its own RTA_GATEWAY and RTA_FLOW
+        NLA. The value is a list of dictionaries with keys
+        `gateway`, `oif`, `hops` (the weight - 1), `flags` and,
+        optionally, `flow`::
+
+            [{'gateway': '10.0.0.1', 'oif': 2, 'hops': 0},
+             {'gateway': '10.0.0.2', 'oif': 2, 'hops': 1}]
+
+        The array is packed and unpacked with precompiled
+        structures, not with the generic NLA machinery, and
+        encoded sets are cached, since usually many routes share
+        the same nexthops.
+        '''
+        fields = [('value', 's')]
+
+        def encode(self):
+            family = self.parent['family']
+            key = (family, tuple([nexthop_key(x) for x in self.value]))
+            data = nexthop_cache.get(key)
+            if data is None:
+                chunks = []
+                for (gateway, oif, hops, flags, flow) in key[1]:
+                    attrs = b''
+                    if gateway is not None:
+                        gateway = inet_pton(family, gateway)
+                        attrs += NLA_HEADER.pack(len(gateway) + 4, RTA_GATEWAY)
+                        attrs += gateway
+                    if flow is not None:
+                        attrs += NLA_HEADER.pack(8, RTA_FLOW)
+                        attrs += struct.pack('I', flow)
+                    chunks.append(RTNH.pack(RTNH.size + len(attrs),
+                                            flags, hops, oif))
+                    chunks.append(attrs)
+                data = b''.join(chunks)
+                nexthop_cache[key] = data
+            self['value'] = data
+            nla_base.encode(self)
+
+        def decode(self):
+            nla_base.decode(self)
+            family = self.parent['family']
+            data = self['value']
+            ret = []
+            offset = 0
+            while offset + RTNH.size <= len(data):
+                (length, flags, hops, oif) = RTNH.unpack_from(data, offset)
+                if length < RTNH.size:
+                    break
+                nexthop = {'flags': flags,
+                           'hops': hops,
+                           'oif': oif}
+                end = offset + length
+                offset += RTNH.size
+                while offset + NLA_HEADER.size <= end:
+                    (nla_length,
+                     nla_type) = NLA_HEADER.unpack_from(data, offset)
+                    if nla_length < NLA_HEADER.size:
+                        break
+                    value = data[offset + NLA_HEADER.size:offset + nla_length]
+                    if nla_type == RTA_GATEWAY:
+                        nexthop['gateway'] = inet_ntop(family, value)
+                    elif nla_type == RTA_FLOW:
+                        nexthop['flow'] = struct.unpack('I', value)[0]
+                    offset += NLMSG_ALIGN(nla_length)
+                ret.append(nexthop)
+                offset = NLMSG_ALIGN(end)
+            self.value = ret
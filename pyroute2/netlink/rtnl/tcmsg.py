@@ -6,6 +6,7 @@ from pyroute2.common import size_suffixes
 from pyroute2.common import time_suffixes
 from pyroute2.common import rate_suffixes
 from pyroute2.common import basestring
+from pyroute2.common import LRUCache
 from pyroute2.netlink import nlmsg
 from pyroute2.netlink import nla
 
@@ -77,6 +78,14 @@ def _time2tick(time):
     return int(time) * _tick_in_usec
 
 
+# computed rate tables, {(rate, mtu, cell_log, mpu, linklayer):
+#                        (cell_log, rtab, packed rtab)}
+rtab_cache = LRUCache(1024)
+
+# compiled u32 selectors, {keys: (nkeys, packed keys)}
+u32_sel_cache = LRUCache(1024)
+
+
 def _calc_xmittime(rate, size):
     # The current code is ported from tc utility
     return int(_time2tick(TIME_UNITS_PER_SEC * (float(size) / rate)))
@@ -184,6 +193,8 @@ def get_u32_parameters(kwarg):
             {'attrs': _get_filter_police_parameter(kwarg)}
         ])
 
+    if kwarg.get('hash') is not None:
+        ret['attrs'].append(['TCA_U32_HASH', kwarg['hash']])
     ret['attrs'].append(['TCA_U32_CLASSID', kwarg['target']])
     ret['attrs'].append(['TCA_U32_SEL', {'keys': kwarg['keys']}])
 
@@ -394,31 +405,43 @@ class nla_plus_rtab(nla):
 
         def calc_rtab(self, kind):
             # The current code is ported from tc utility
-            rtab = []
             mtu = self.get('mtu', 0) or 1600
             cell_log = self['%s_cell_log' % (kind)]
             mpu = self['%s_mpu' % (kind)]
             rate = self.get(kind, 'rate')
-
-            # calculate cell_log
-            if cell_log == 0:
-                while (mtu >> cell_log) > 255:
-                    cell_log += 1
-
-            # fill up the table
-            for i in range(256):
-                size = self.adjust_size((i + 1) << cell_log,
-                                        mpu,
-                                        LINKLAYER_ETHERNET)
-                rtab.append(_calc_xmittime(rate, size))
+            linklayer = LINKLAYER_ETHERNET
+
+            # tables depend only on these parameters, and usually
+            # there are only few distinct rates for many classes
+            key = (rate, mtu, cell_log, mpu, linklayer)
+            entry = rtab_cache.get(key)
+            if entry is None:
+                # calculate cell_log
+                if cell_log == 0:
+                    while (mtu >> cell_log) > 255:
+                        cell_log += 1
+
+                # fill up the table
+                rtab = []
+                for i in range(256):
+                    size = self.adjust_size((i + 1) << cell_log,
+                                            mpu,
+                                            linklayer)
+                    rtab.append(_calc_xmittime(rate, size))
+                rtab = tuple(rtab)
+                entry = (cell_log, rtab, struct.pack('I' * 256, *rtab))
+                rtab_cache[key] = entry
 
             self['%s_cell_align' % (kind)] = -1
-            self['%s_cell_log' % (kind)] = cell_log
-            return rtab
+            self['%s_cell_log' % (kind)] = entry[0]
+            self.packed[kind] = entry[2]
+            return entry[1]
 
         def encode(self):
             self.rtab = None
             self.ptab = None
+            self.ctab = None
+            self.packed = {}
             if self.get('rate', False):
                 self.rtab = self.calc_rtab('rate')
             if self.get('peak', False):
@@ -429,6 +452,7 @@ class nla_plus_rtab(nla):
 
     class rtab(nla):
         fields = (('value', 's'), )
+        kind = 'rate'
 
         def encode(self):
             parms = self.parent.get_encoded('TCA_TBF_PARMS') or \
@@ -436,8 +460,11 @@ class nla_plus_rtab(nla):
                 self.parent.get_encoded('TCA_POLICE_TBF')
             if parms is not None:
                 self.value = getattr(parms, self.__class__.__name__)
-                self['value'] = struct.pack('I' * 256,
-                                            *(int(x) for x in self.value))
+                packed = getattr(parms, 'packed', {}).get(self.kind)
+                if packed is None:
+                    packed = struct.pack('I' * 256,
+                                         *(int(x) for x in self.value))
+                self['value'] = packed
             nla.encode(self)
 
         def decode(self):
@@ -452,10 +479,10 @@ class nla_plus_rtab(nla):
                 setattr(parms, self.__class__.__name__, rtab)
 
     class ptab(rtab):
-        pass
+        kind = 'peak'
 
     class ctab(rtab):
-        pass
+        kind = 'ceil'
 
 
 class nla_plus_stats2(object):
@@ -742,16 +769,20 @@ class tcmsg(nlmsg, nla_plus_stats2):
                           ('key_off', 'i'),
                           ('key_offmask', 'i'))
 
-            def encode(self):
+            @staticmethod
+            def compile(keys):
                 '''
-                'keys': ['0x0006/0x00ff+8',
-                         '0x0000/0xffc0+2',
-                         '0x5/0xf+0',
-                         '0x10/0xff+33']
+                Parse string keys and return the list of
+                `(mask, value, offset)` tuples, one per u32 key::
+
+                    ['0x0006/0x00ff+8',
+                     '0x0000/0xffc0+2',
+                     '0x5/0xf+0',
+                     '0x10/0xff+33']
 
-                => 00060000/00ff0000 + 8
-                   05000000/0f00ffc0 + 0
-                   00100000/00ff0000 + 32
+                    => 00060000/00ff0000 + 8
+                       05000000/0f00ffc0 + 0
+                       00100000/00ff0000 + 32
 
                 '''
 
@@ -770,9 +801,9 @@ class tcmsg(nlmsg, nla_plus_stats2):
                 # 'header' array to pack keys to
                 header = [(0, 0) for i in range(256)]
 
-                keys = []
+                ret = []
                 # iterate keys and pack them to the 'header'
-                for key in self['keys']:
+                for key in keys:
                     # TODO tags: filter
                     (key, nh) = cut_field(key, '@')  # FIXME: do not ignore nh
                     (key, offset) = cut_field(key, '+')
@@ -794,11 +825,7 @@ class tcmsg(nlmsg, nla_plus_stats2):
                     value = int(key, 0)
                     bits = 24
                     if mask == 0 and value == 0:
-                        key = self.u32_key(self.buf)
-                        key['key_off'] = offset
-                        key['key_mask'] = mask
-                        key['key_val'] = value
-                        keys.append(key)
+                        ret.append((mask, value, offset))
                     for bmask in struct.unpack('4B', struct.pack('>I', mask)):
                         if bmask > 0:
                             bvalue = (value & (bmask << bits)) >> bits
@@ -808,33 +835,41 @@ class tcmsg(nlmsg, nla_plus_stats2):
 
                 # recalculate keys from 'header'
                 key = None
-                value = 0
-                mask = 0
                 for offset in range(256):
                     (bvalue, bmask) = header[offset]
                     if bmask > 0 and key is None:
-                        key = self.u32_key(self.buf)
-                        key['key_off'] = offset
-                        key['key_mask'] = 0
-                        key['key_val'] = 0
+                        key = [0, 0, offset]
                         bits = 24
                     if key is not None and bits >= 0:
-                        key['key_mask'] |= bmask << bits
-                        key['key_val'] |= bvalue << bits
+                        key[0] |= bmask << bits
+                        key[1] |= bvalue << bits
                         bits -= 8
                         if (bits < 0 or offset == 255):
-                            keys.append(key)
+                            ret.append(tuple(key))
                             key = None
 
-                assert keys
-                self['nkeys'] = len(keys)
+                assert ret
+                return ret
+
+            def encode(self):
+                # compiled selectors are cached by the keys, so
+                # filters with the same match are parsed only once
+                keys = tuple(self['keys'])
+                entry = u32_sel_cache.get(keys)
+                if entry is None:
+                    compiled = self.compile(keys)
+                    entry = (len(compiled),
+                             b''.join([struct.pack('>II', x[0], x[1]) +
+                                       struct.pack('ii', x[2], 0)
+                                       for x in compiled]))
+                    u32_sel_cache[keys] = entry
+                self['nkeys'] = entry[0]
                 # FIXME: do not hardcode flags :)
                 self['flags'] = 1
                 start = self.buf.tell()
 
                 nla.encode(self)
-                for key in keys:
-                    key.encode()
+                self.buf.write(entry[1])
                 self.update_length(start)
 
             def decode(self):
@@ -913,3 +948,78 @@ class tcmsg(nlmsg, nla_plus_stats2):
                   ('forced_mark', 'I'),
                   ('prob_mark_head', 'I'),
                   ('forced_mark_head', 'I'))
+
+
+TCA_KIND = 1
+TCA_STATS = 3
+TCA_STATS2 = 7
+TCA_STATS_BASIC = 1
+TCA_STATS_QUEUE = 3
+tc_stats_names = ('bytes',
+                  'packets',
+                  'drops',
+                  'overlimits',
+                  'requeues',
+                  'qlen',
+                  'backlog')
+
+
+class tcmsgstats(nlmsg):
+    '''
+    Lean qdisc/class decoder for statistics polling. Only the
+    tcmsg fields, TCA_KIND and statistics NLA are decoded, all
+    other NLA, like options and xstats, are skipped. Results
+    are stored as `msg['kind']` and `msg['stats']` -- the tuple
+    of counters in the `tc_stats_names` order, or None.
+
+    TCA_STATS2 is used if present, otherwise the legacy
+    TCA_STATS; the latter has no requeues counter.
+    '''
+    fields = tcmsg.fields
+    basic = struct.Struct('QI')
+    queue = struct.Struct('IIIII')
+    legacy = struct.Struct('QIIIIIII')
+
+    def decode(self):
+        nlmsg.decode(self)
+        self['kind'] = None
+        self['stats'] = None
+        data = self.raw
+        offset = 36
+        while offset + 4 <= len(data):
+            (length, nla_type) = struct.unpack_from('HH', data, offset)
+            if length < 4:
+                break
+            if nla_type == TCA_KIND:
+                kind = data[offset + 4:offset + length].rstrip(b'\0')
+                if not isinstance(kind, str):
+                    kind = kind.decode('utf-8')
+                self['kind'] = kind
+            elif nla_type == TCA_STATS2:
+                self['stats'] = self.decode_stats2(data, offset + 4,
+                                                   offset + length)
+            elif nla_type == TCA_STATS and self['stats'] is None and \
+                    length - 4 >= self.legacy.size:
+                (nbytes, packets, drops, overlimits,
+                 bps, pps, qlen, backlog) = \
+                    self.legacy.unpack_from(data, offset + 4)
+                self['stats'] = (nbytes, packets, drops, overlimits,
+                                 0, qlen, backlog)
+            offset += (length + 3) & ~3
+
+    def decode_stats2(self, data, offset, end):
+        nbytes = packets = 0
+        qlen = backlog = drops = requeues = overlimits = 0
+        while offset + 4 <= end:
+            (length, nla_type) = struct.unpack_from('HH', data, offset)
+            if length < 4:
+                break
+            if nla_type == TCA_STATS_BASIC and \
+                    length - 4 >= self.basic.size:
+                (nbytes, packets) = self.basic.unpack_from(data, offset + 4)
+            elif nla_type == TCA_STATS_QUEUE and \
+                    length - 4 >= self.queue.size:
+                (qlen, backlog, drops, requeues, overlimits) = \
+                    self.queue.unpack_from(data, offset + 4)
+            offset += (length + 3) & ~3
+        return (nbytes, packets, drops, overlimits, requeues, qlen, backlog)
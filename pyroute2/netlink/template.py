@@ -0,0 +1,167 @@
+'''
+Request templates
+=================
+
+Repeated requests, like bringing up thousands of interfaces
+or changing the gateway of the same prefix, produce messages
+with the same binary layout, that differ only in a few fields.
+A template encodes such request once, and then stamps out
+concrete messages by patching the slots in a copy of the
+encoded data, without building message objects::
+
+    from pyroute2.netlink.template import RequestTemplate
+
+    msg = ifinfmsg()
+    msg['index'] = 1
+    msg['flags'] = 1
+    msg['change'] = 1
+    t = RequestTemplate(msg, RTM_SETLINK,
+                        NLM_F_REQUEST | NLM_F_ACK,
+                        slots=('index', ))
+    data = t.stamp(index=5, seq=100)
+
+Slots can refer to:
+
+* 'seq', 'pid' -- the header fields; `nlm_request()` and
+  `nlm_request_batch()` set them anyway, if the encoded
+  message is passed to them
+* message fields, e.g. 'index' or 'dst_len'
+* top-level NLA, by full name or by human-friendly one, e.g.
+  'IFLA_ADDRESS' or 'gateway'
+
+The slot values must keep the encoded message size, so
+only fixed size NLA can be used as slots: integer types,
+IP and MAC addresses. The message to build the template
+from must contain all the NLA that are used as slots,
+with any value of the right size.
+
+One slot can patch several places at once; specify it as a
+dictionary::
+
+    slots={'address': ('IFA_LOCAL', 'IFA_ADDRESS')}
+
+IPRoute provides templates for its own requests, see
+`IPRoute.template()` and `IPRoute.template_batch()`.
+'''
+import struct
+import socket
+from pyroute2.netlink import nlmsg_atoms
+from pyroute2.netlink import NLMSG_ALIGN
+
+
+# header field offsets, see nlmsg_header
+HEADER_SLOTS = {'seq': (8, 'I'),
+                'pid': (12, 'I')}
+
+
+def _struct_packer(fmt):
+    return struct.Struct(fmt).pack_into
+
+
+def _bytes_packer(size, convert):
+    def pack_into(buf, offset, value):
+        value = convert(value)
+        if len(value) != size:
+            raise ValueError('value size mismatch: %i != %i' %
+                             (len(value), size))
+        buf[offset:offset + size] = value
+    return pack_into
+
+
+def _l2addr(value):
+    return struct.pack('BBBBBB', *[int(i, 16) for i in value.split(':')])
+
+
+class RequestTemplate(object):
+    '''
+    Encoded request with named slots.
+
+    * msg -- the message object, with sample slot values
+    * msg_type -- the message type
+    * msg_flags -- the message flags
+    * slots -- iterable of slot names, or a dictionary
+      `{slot: (target, ...)}`
+    '''
+
+    def __init__(self, msg, msg_type, msg_flags, slots=()):
+        self.msg_type = msg_type
+        self.msg_flags = msg_flags
+        msg['header']['type'] = msg_type
+        msg['header']['flags'] = msg_flags
+        msg['header']['sequence_number'] = 0
+        msg['header']['pid'] = 0
+        msg.encode()
+        self.data = bytearray(msg.buf.getvalue())
+        self.slots = {}
+        if not isinstance(slots, dict):
+            slots = dict([(x, (x, )) for x in slots])
+        for (name, targets) in slots.items():
+            places = []
+            for target in targets:
+                places.extend(self._locate(msg, target))
+            self.slots[name] = places
+
+    def _locate(self, msg, target):
+        #
+        # Return the list of (offset, pack_into) for the target
+        #
+        if target in HEADER_SLOTS:
+            (offset, fmt) = HEADER_SLOTS[target]
+            return [(offset, _struct_packer(fmt))]
+
+        # message fields are packed one by one, w/o alignment
+        offset = 16
+        for (name, fmt) in msg.fields:
+            if name == target:
+                if fmt[-1] in ('s', 'z', 'x'):
+                    raise ValueError('slot %s: unsupported format %s' %
+                                     (target, fmt))
+                return [(offset, _struct_packer(fmt))]
+            offset += struct.calcsize(fmt)
+
+        # top-level NLA
+        nla = type(msg).name2nla(target)
+        if nla not in msg.r_nla_map:
+            raise KeyError('slot %s: no such field or NLA' % (target))
+        (nla_class, nla_type) = msg.r_nla_map[nla]
+        offset = NLMSG_ALIGN(offset)
+        ret = []
+        while offset < len(self.data):
+            (length, t) = struct.unpack_from('HH', self.data, offset)
+            if t == nla_type:
+                ret.append((offset + 4,
+                            self._packer(msg, target, nla_class,
+                                         length - 4)))
+            offset += NLMSG_ALIGN(length)
+        if not ret:
+            raise ValueError('slot %s: NLA %s not found in the message' %
+                             (target, nla))
+        return ret
+
+    def _packer(self, msg, target, nla_class, size):
+        if not isinstance(nla_class, type):
+            raise ValueError('slot %s: unsupported NLA type' % (target))
+        if issubclass(nla_class, (nlmsg_atoms.ipXaddr,
+                                  nlmsg_atoms.ipaddr)):
+            # the family is defined by the sample address
+            family = {4: socket.AF_INET, 16: socket.AF_INET6}[size]
+            return _bytes_packer(size,
+                                 lambda x: socket.inet_pton(family, x))
+        elif issubclass(nla_class, nlmsg_atoms.l2addr):
+            return _bytes_packer(size, _l2addr)
+        elif len(nla_class.fields) == 1 and \
+                nla_class.fields[0][1][-1] not in ('s', 'z', 'x'):
+            return _struct_packer(nla_class.fields[0][1])
+        raise ValueError('slot %s: variable size NLA' % (target))
+
+    def stamp(self, **kwarg):
+        '''
+        Return a bytearray with the encoded message, where slots
+        are set to the values from keyword arguments. Slots that
+        are not mentioned keep values of the template.
+        '''
+        data = bytearray(self.data)
+        for (name, value) in kwarg.items():
+            for (offset, pack_into) in self.slots[name]:
+                pack_into(data, offset, value)
+        return data
@@ -0,0 +1,476 @@
+'''
+Declarative traffic control
+===========================
+
+`IPRoute.tc_apply()` brings the traffic control setup of
+an interface to the state, described by a tree spec, with
+the minimal set of changes::
+
+    from pyroute2 import IPRoute
+    from pyroute2 import protocols
+
+    ip = IPRoute()
+    tree = {'qdiscs': [{'kind': 'htb', 'handle': '1:',
+                        'default': '1:20'},
+                       {'kind': 'pfifo', 'handle': '10:',
+                        'parent': '1:10'}],
+            'classes': [{'handle': '1:1', 'parent': '1:',
+                         'rate': '10mbit'},
+                        {'handle': '1:10', 'parent': '1:1',
+                         'rate': '5mbit', 'prio': 1},
+                        {'handle': '1:20', 'parent': '1:1',
+                         'rate': '5mbit', 'prio': 2}],
+            'filters': [{'kind': 'u32', 'parent': '1:',
+                         'prio': 10,
+                         'protocol': protocols.ETH_P_IP,
+                         'target': '1:10',
+                         'keys': ['0x0006/0x00ff+8']}]}
+    report = ip.tc_apply(eth0, tree)
+
+Specs use the same keywords as `IPRoute.tc()`. The class
+kind, if not set, is the kind of the qdisc it belongs to,
+the filter kind is 'u32' by default.
+
+The tree spec is complete: qdiscs, classes and filters of
+the interface, that are not in the spec, are deleted. Only
+default qdiscs with kernel assigned handles are left alone.
+
+Objects are identified:
+
+* qdiscs -- by the handle, the parent and the kind
+* classes -- by the handle and the parent
+* u32 filters -- by the parent, prio, protocol, target and
+  keys; the handle is not compared, since it is allocated
+  by the kernel
+* fw and other filters -- by the parent, prio, protocol and
+  handle
+
+Parameters of qdiscs and classes are compared for htb, tbf,
+sfq and netem, see `PARAMETERS`; for other kinds only the
+identity is compared. Changed qdiscs are replaced in place,
+changed classes are changed in place, other objects are
+deleted and created again. Notice, that some qdiscs, like
+htb, do not support the change of the qdisc parameters, and
+the kernel returns an error then.
+
+All the operations are sent in one `nlm_request_batch()`
+in the dependency order: filter deletes, qdisc and class
+deletes from leaves to the root, qdisc and class changes
+and additions from the root to leaves, filter additions.
+'''
+from socket import ntohs
+from socket import AF_UNSPEC
+from pyroute2.common import basestring
+from pyroute2.common import transform_handle
+from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink import NLM_F_ACK
+from pyroute2.netlink import NLM_F_CREATE
+from pyroute2.netlink import NLM_F_REPLACE
+from pyroute2.netlink import NetlinkError
+from pyroute2.netlink.rtnl import RTM_NEWQDISC
+from pyroute2.netlink.rtnl import RTM_DELQDISC
+from pyroute2.netlink.rtnl import RTM_NEWTCLASS
+from pyroute2.netlink.rtnl import RTM_DELTCLASS
+from pyroute2.netlink.rtnl import RTM_NEWTFILTER
+from pyroute2.netlink.rtnl import RTM_DELTFILTER
+from pyroute2.netlink.rtnl import TC_H_ROOT
+from pyroute2.netlink.rtnl.tcmsg import tcmsg
+
+# compared parameters, {(kind, class): (NLA, fields, auto)};
+# NLA None means TCA_OPTIONS itself, auto fields are compared
+# only if set in the spec, as zero means the kernel default
+PARAMETERS = {('htb', False): ('TCA_HTB_INIT',
+                               ('rate2quantum', 'defcls'),
+                               ()),
+              ('htb', True): ('TCA_HTB_PARMS',
+                              ('rate', 'ceil', 'buffer', 'cbuffer',
+                               'quantum', 'prio'),
+                              ('quantum', )),
+              ('tbf', False): ('TCA_TBF_PARMS',
+                               ('rate', 'peak', 'limit', 'buffer',
+                                'mtu'),
+                               ()),
+              ('sfq', False): (None,
+                               ('quantum', 'perturb_period', 'limit'),
+                               ('quantum', 'limit')),
+              ('netem', False): (None,
+                                 ('delay', 'limit', 'loss', 'gap',
+                                  'duplicate', 'jitter'),
+                                 ())}
+
+
+def _attr(value, name):
+    #
+    # NLA value; requests are compared before encoding, and
+    # there NLA values are plain dictionaries
+    #
+    if value is None:
+        return None
+    if hasattr(value, 'get_attr'):
+        return value.get_attr(name)
+    for item in value.get('attrs', ()):
+        if item[0] == name:
+            return item[1]
+    return None
+
+
+def _class_parent(msg):
+    # top level classes refer TC_H_ROOT, not the qdisc
+    if msg['parent'] == TC_H_ROOT:
+        return msg['handle'] & 0xffff0000
+    return msg['parent']
+
+
+def _match(want, have, is_class):
+    #
+    # Compare parameters of a qdisc or a class
+    #
+    kind = want.get_attr('TCA_KIND')
+    if kind != have.get_attr('TCA_KIND'):
+        return False
+    if (kind, is_class) not in PARAMETERS:
+        return True
+    (nla, fields, auto) = PARAMETERS[(kind, is_class)]
+    want = want.get_attr('TCA_OPTIONS')
+    have = have.get_attr('TCA_OPTIONS')
+    if isinstance(have, basestring):
+        return False
+    if nla is not None:
+        want = _attr(want, nla)
+        have = _attr(have, nla)
+    if want is None:
+        return True
+    if have is None:
+        return False
+    for name in fields:
+        value = want.get(name)
+        if name in auto and not value:
+            continue
+        # floats are truncated on encoding
+        if isinstance(value, float):
+            value = int(value)
+        if value != have.get(name):
+            return False
+    return True
+
+
+def _filter_key(msg):
+    #
+    # Filter identity, see the module doc
+    #
+    kind = msg.get_attr('TCA_KIND')
+    key = (msg['parent'], msg['info'], kind)
+    if kind != 'u32':
+        return key + (msg['handle'], )
+    options = msg.get_attr('TCA_OPTIONS')
+    sel = _attr(options, 'TCA_U32_SEL')
+    if sel is None:
+        # hash tables and classifier roots
+        return None
+    if hasattr(sel, 'get_attr'):
+        keys = tuple([(x['key_val'], x['key_mask'], x['key_off'])
+                      for x in sel['keys']])
+    else:
+        keys = tuple([(x[1], x[0], x[2]) for x
+                      in tcmsg.options_u32.u32_sel.compile(sel['keys'])])
+    return key + (_attr(options, 'TCA_U32_CLASSID'), keys)
+
+
+def _describe(msg):
+    #
+    # Spec of a dumped object, for reports
+    #
+    ret = {'kind': msg.get_attr('TCA_KIND'),
+           'handle': msg['handle'],
+           'parent': msg['parent']}
+    if msg['header']['type'] == RTM_NEWTFILTER:
+        ret['prio'] = msg['info'] >> 16
+        ret['protocol'] = ntohs(msg['info'] & 0xffff)
+    return ret
+
+
+class TCTree(object):
+    '''
+    Traffic control setup of one interface, dumped from the
+    kernel and indexed to compute the diff with a tree spec.
+
+    * nl -- IPRoute or NetNS instance
+    * index -- the interface index
+    '''
+
+    def __init__(self, nl, index):
+        self.nl = nl
+        self.index = index
+        # {handle: msg}
+        self.qdiscs = {}
+        self.classes = {}
+        # {handle: parent}
+        self.parents = {}
+        # [msg, ...]
+        self.filters = []
+        self.load()
+
+    def load(self):
+        self.qdiscs = {}
+        self.classes = {}
+        self.parents = {}
+        self.filters = []
+        for msg in self.nl.get_qdiscs(self.index):
+            major = msg['handle'] >> 16
+            # default qdiscs, the kernel assigns handles to them
+            if major == 0 or 0x8000 <= major < 0xffff:
+                continue
+            self.qdiscs[msg['handle']] = msg
+            self.parents[msg['handle']] = msg['parent']
+        for msg in self.nl.get_classes(self.index):
+            if msg['index'] != self.index:
+                continue
+            self.classes[msg['handle']] = msg
+            self.parents[msg['handle']] = _class_parent(msg)
+        for parent in list(self.qdiscs) + list(self.classes):
+            for msg in self.nl.get_filters(index=self.index,
+                                           parent=parent):
+                if msg['header']['type'] == RTM_NEWTFILTER and \
+                        msg['handle']:
+                    self.filters.append(msg)
+
+    def level(self, handle, parents=None):
+        '''
+        Depth of the handle in the tree; `parents` is the
+        dictionary `{handle: parent}`, current one by default
+        '''
+        parents = self.parents if parents is None else parents
+        ret = 0
+        seen = set()
+        while handle in parents and handle not in seen:
+            seen.add(handle)
+            handle = parents[handle]
+            ret += 1
+        return ret
+
+    def children(self, handle):
+        '''
+        Current qdiscs and classes, that are direct children
+        of the handle
+        '''
+        return [x for (x, y) in self.parents.items() if y == handle]
+
+    def subtree(self, handle):
+        '''
+        All the current descendants of the handle, parents
+        before children
+        '''
+        ret = []
+        queue = self.children(handle)
+        while queue:
+            item = queue.pop(0)
+            if item in ret:
+                continue
+            ret.append(item)
+            queue.extend(self.children(item))
+        return ret
+
+    def plan(self, tree):
+        '''
+        Compute operations to bring the setup to the tree spec.
+        Returns the list of `(action, obj, spec, request)` tuples
+        in the execution order; action is 'add', 'change' or
+        'delete', obj -- 'qdisc', 'class' or 'filter', request
+        is `(msg, msg_type, msg_flags)`.
+        '''
+        nl = self.nl
+        index = self.index
+        # objects, that will be gone after deletes and replaces
+        gone = set()
+        deletes = []
+        updates = []
+        depth = {}
+
+        def remove(handle, explicit):
+            #
+            # Delete a qdisc or a class with all the subtree
+            #
+            if handle in gone:
+                return
+            if handle in self.classes:
+                # classes must be deleted leaves first; classes
+                # of child qdiscs go with the qdiscs
+                for item in reversed(self.subtree(handle)):
+                    if item in self.classes and \
+                            item & 0xffff0000 == handle & 0xffff0000:
+                        remove(item, True)
+                msg = self.classes[handle]
+                obj = 'class'
+            else:
+                msg = self.qdiscs[handle]
+                obj = 'qdisc'
+            # the rest of the subtree goes with the object
+            gone.add(handle)
+            gone.update(self.subtree(handle))
+            if explicit:
+                deletes.append((obj, msg))
+
+        # 8<---------------------------------------------------
+        # qdiscs
+        want_qdiscs = {}
+        slots = dict([(y['parent'], x) for (x, y) in self.qdiscs.items()])
+        for spec in tree.get('qdiscs', ()):
+            spec = dict(spec)
+            request = nl._tc_request(RTM_NEWQDISC, index=index, **spec)
+            want = request[0]
+            handle = want['handle']
+            parent = want['parent']
+            want_qdiscs[handle] = spec
+            depth[handle] = parent
+            current = self.qdiscs.get(handle)
+            if current is not None and current['parent'] == parent and \
+                    current.get_attr('TCA_KIND') == spec['kind']:
+                if not _match(want, current, False):
+                    updates.append(('change', 'qdisc', spec, request))
+                continue
+            if current is not None:
+                # the handle is used elsewhere or by another kind
+                remove(handle, True)
+            if slots.get(parent, handle) != handle:
+                # replaced by the new qdisc
+                remove(slots[parent], False)
+            updates.append(('add', 'qdisc', spec, request))
+
+        # 8<---------------------------------------------------
+        # classes
+        kinds = dict([(x & 0xffff0000, y['kind']) for (x, y)
+                      in want_qdiscs.items()])
+        want_classes = {}
+        for spec in tree.get('classes', ()):
+            spec = dict(spec)
+            if 'kind' not in spec:
+                major = transform_handle(spec.get('handle', 0)) & 0xffff0000
+                spec['kind'] = kinds.get(major)
+            request = nl._tc_request(RTM_NEWTCLASS, index=index, **spec)
+            want = request[0]
+            handle = want['handle']
+            parent = _class_parent(want)
+            want_classes[handle] = spec
+            depth[handle] = parent
+            current = self.classes.get(handle)
+            if current is not None and handle not in gone:
+                if self.parents[handle] == parent:
+                    if not _match(want, current, True):
+                        (msg, msg_type, msg_flags) = request
+                        updates.append(('change', 'class', spec,
+                                        (msg, msg_type,
+                                         NLM_F_REQUEST | NLM_F_ACK)))
+                    continue
+                remove(handle, True)
+            updates.append(('add', 'class', spec, request))
+
+        # 8<---------------------------------------------------
+        # the rest of current qdiscs and classes, parents first,
+        # so subtrees of deleted qdiscs are not deleted one by one
+        for handle in sorted(self.parents, key=self.level):
+            if handle not in want_classes and \
+                    handle not in want_qdiscs:
+                remove(handle, True)
+
+        # 8<---------------------------------------------------
+        # filters
+        want_filters = []
+        for spec in tree.get('filters', ()):
+            spec = dict(spec)
+            spec['kind'] = spec.get('kind', 'u32')
+            request = nl._filter_request(RTM_NEWTFILTER, index=index,
+                                         **spec)
+            want_filters.append((_filter_key(request[0]), spec, request))
+        removed = set([x[1]['handle'] for x in deletes])
+        current = {}
+        filter_deletes = []
+        for msg in self.filters:
+            key = _filter_key(msg)
+            if key is None or msg['parent'] in gone:
+                continue
+            options = msg.get_attr('TCA_OPTIONS')
+            if isinstance(options, basestring):
+                options = None
+            # filters bound to deleted classes must go first
+            if _attr(options, 'TCA_U32_CLASSID') in removed or \
+                    _attr(options, 'TCA_FW_CLASSID') in removed:
+                filter_deletes.append(('filter', msg))
+            else:
+                current.setdefault(key, []).append(msg)
+        filter_adds = []
+        for (key, spec, request) in want_filters:
+            if current.get(key):
+                # the same filter exists, take it
+                current[key].pop()
+            else:
+                filter_adds.append(('add', 'filter', spec, request))
+        # filters, that are not in the tree, and extra copies
+        for msgs in current.values():
+            filter_deletes.extend([('filter', x) for x in msgs])
+
+        # 8<---------------------------------------------------
+        # order operations
+        ret = []
+        for (obj, msg) in filter_deletes:
+            ret.append(('delete', obj, _describe(msg),
+                        self.delete_request(msg)))
+        for (obj, msg) in deletes:
+            ret.append(('delete', obj, _describe(msg),
+                        self.delete_request(msg)))
+        for (action, obj, spec, request) in \
+                sorted(updates,
+                       key=lambda x: self.level(x[3][0]['handle'], depth)):
+            if obj == 'qdisc':
+                # replace what is in the slot, or change in place
+                (msg, msg_type, msg_flags) = request
+                request = (msg, msg_type,
+                           NLM_F_REQUEST | NLM_F_ACK |
+                           NLM_F_CREATE | NLM_F_REPLACE)
+            ret.append((action, obj, spec, request))
+        ret.extend(filter_adds)
+        return ret
+
+    def delete_request(self, msg):
+        types = {RTM_NEWQDISC: RTM_DELQDISC,
+                 RTM_NEWTCLASS: RTM_DELTCLASS,
+                 RTM_NEWTFILTER: RTM_DELTFILTER}
+        req = tcmsg()
+        req['family'] = AF_UNSPEC
+        req['index'] = msg['index']
+        req['handle'] = msg['handle']
+        req['parent'] = msg['parent']
+        req['info'] = msg['info']
+        req['attrs'] = [['TCA_KIND', msg.get_attr('TCA_KIND')]]
+        return (req, types[msg['header']['type']],
+                NLM_F_REQUEST | NLM_F_ACK)
+
+    def apply(self, tree, window=256):
+        '''
+        Apply the tree spec and return the report::
+
+            {'added': [(obj, spec), ...],
+             'changed': [(obj, spec), ...],
+             'deleted': [(obj, spec), ...],
+             'errors': [(action, obj, spec, NetlinkError), ...]}
+
+        For deleted objects spec contains 'kind', 'handle' and
+        'parent', and for filters also 'prio' and 'protocol'.
+        Objects, that the kernel deletes together with their
+        parents, are not listed.
+        '''
+        ops = self.plan(tree)
+        ret = {'added': [],
+               'changed': [],
+               'deleted': [],
+               'errors': []}
+        sections = {'add': 'added',
+                    'change': 'changed',
+                    'delete': 'deleted'}
+        results = self.nl.nlm_request_batch([x[3] for x in ops], window)
+        for (op, (msg, result)) in enumerate(results):
+            (action, obj, spec, request) = ops[op]
+            if isinstance(result, NetlinkError):
+                ret['errors'].append((action, obj, spec, result))
+            else:
+                ret[sections[action]].append((obj, spec))
+        return ret
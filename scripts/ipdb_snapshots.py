@@ -0,0 +1,73 @@
+#!/usr/bin/python
+'''
+Usage::
+
+    ./ipdb_snapshots.py [number of interfaces]
+
+Benchmark IPDB transactions and snapshots: the time per
+interface of `begin()`, a change with `review()`, `pick()`
+(used by `commit()`) and `snapshot()`, and the memory taken
+by one open transaction on every interface.
+
+Interfaces are standalone objects, not bound to IPDB, so
+the root access and real interfaces are not required.
+'''
+import gc
+import sys
+import time
+import resource
+from pyroute2.ipdb.interface import Interface
+
+
+def rss():
+    # kilobytes on Linux
+    gc.collect()
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make(count):
+    ret = []
+    for x in range(count):
+        i = Interface(ipdb=None, mode='explicit')
+        with i._direct_state:
+            i['index'] = x + 1
+            i['ifname'] = 'eth%i' % x
+            i['mtu'] = 1500
+            i['flags'] = 1
+            i['address'] = '00:11:22:33:%02x:%02x' % (x >> 8, x & 0xff)
+            i['ipaddr'].add(('10.%i.%i.1' % (x >> 8, x & 0xff), 24))
+        ret.append(i)
+    return ret
+
+
+def measure(name, interfaces, func):
+    start = time.time()
+    for i in interfaces:
+        func(i)
+    usec = (time.time() - start) * 1000000 / len(interfaces)
+    print('%-16s %8.1fus' % (name, usec))
+
+
+def change(i):
+    i['mtu'] = 1400
+    i.review()
+
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+interfaces = make(count)
+print('%i interfaces, per interface:' % (count))
+
+base = rss()
+measure('begin()', interfaces, lambda x: x.begin())
+used = rss() - base
+measure('set + review()', interfaces, change)
+measure('pick()', interfaces, lambda x: x.pick())
+measure('snapshot()', interfaces, lambda x: x.snapshot())
+measure('drop()', interfaces, lambda x: x.drop())
+print('%-16s %8.1fkB (%.1fMB for all)' % ('transaction',
+                                          float(used) / count,
+                                          used / 1024.0))
@@ -52,3 +52,18 @@ class TestAddrPool(object):
             ap.free(0)
         except KeyError:
             pass
+
+    def test_ban(self):
+
+        ap = AddrPool(minaddr=1, maxaddr=1024)
+        for i in range(1024):
+            ap.alloc()
+
+        ap.free(42, ban=2)
+        for i in range(2):
+            try:
+                ap.alloc()
+                raise Exception('the address must be banned')
+            except KeyError:
+                pass
+        assert ap.alloc() == 42
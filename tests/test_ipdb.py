@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import json
+import time
 import socket
+import threading
 from pyroute2 import IPDB
 from pyroute2 import IPRoute
 from pyroute2.common import basestring
 from pyroute2.common import AddrPool
 from pyroute2.netlink import NetlinkError
+from pyroute2.ipdb import Dump
+from pyroute2.ipdb import CallbackPool
 from pyroute2.ipdb.common import CreateException
 from utils import grep
 from utils import create_link
@@ -65,6 +69,29 @@ class TestExplicit(object):
     def test_idx_set(self):
         assert set(self.ip.by_name.values()) == set(self.ip.by_index.values())
 
+    def test_ready(self):
+        for name in ('links', 'ipaddr', 'neighbors', 'routes'):
+            self.ip.ready[name].wait(5)
+            assert self.ip.ready[name].is_set()
+        ip = IPRoute()
+        try:
+            routes = [x for x in ip.get_routes(family=socket.AF_INET)
+                      if x.get_attr('RTA_TABLE') == 254]
+        finally:
+            ip.close()
+        keys = set(['%s/%s' % (x.get_attr('RTA_DST'), x['dst_len'])
+                    if x.get_attr('RTA_DST') else 'default'
+                    for x in routes])
+        assert keys <= set(self.ip.routes.tables[254].keys())
+
+    def test_dump(self):
+        dump = Dump(IPRoute(), 'iter_links', close=True, chunk=1)
+        dump.start()
+        chunks = list(dump)
+        assert all(len(x) == 1 for x in chunks)
+        assert set([x[0]['index'] for x in chunks]) == \
+            set(self.ip.by_index.keys())
+
     def test_idx_types(self):
         assert all(isinstance(i, int) for i in self.ip.by_index.keys())
         assert all(isinstance(i, basestring) for i in self.ip.by_name.keys())
@@ -268,6 +295,35 @@ class TestExplicit(object):
         assert '172.16.0.0/24' not in self.ip.routes
         assert not grep('ip ro', pattern='172.16.0.0/24')
 
+    def test_route_multipath(self):
+        require_user('root')
+        assert '172.16.0.0/24' not in self.ip.routes
+
+        # create a route
+        with self.ip.routes.add({'dst': '172.16.0.0/24',
+                                 'multipath': [{'gateway': '127.0.0.1'},
+                                               {'gateway': '127.0.0.2',
+                                                'hops': 1}]}) as r:
+            pass
+        assert grep('ip ro', pattern='nexthop.*127.0.0.1.*weight 1')
+        assert grep('ip ro', pattern='nexthop.*127.0.0.2.*weight 2')
+
+        # change nexthops
+        with self.ip.routes['172.16.0.0/24'] as r:
+            r.multipath = [{'gateway': '127.0.0.3'},
+                           {'gateway': '127.0.0.4'}]
+        assert [x['gateway'] for x in
+                self.ip.routes['172.16.0.0/24'].multipath] == \
+            ['127.0.0.3', '127.0.0.4']
+        assert grep('ip ro', pattern='nexthop.*127.0.0.3')
+        assert not grep('ip ro', pattern='nexthop.*127.0.0.1')
+
+        # delete the route
+        with self.ip.routes['172.16.0.0/24'] as r:
+            r.remove()
+        assert '172.16.0.0/24' not in self.ip.routes
+        assert not grep('ip ro', pattern='172.16.0.0/24')
+
     def _test_shadow(self, kind):
         ifA = self.get_ifname()
 
@@ -929,6 +985,293 @@ class TestMisc(object):
         del s
         ip.nl.release()
 
+    def test_objects(self):
+        with IPDB(objects=('links', 'ipaddr')) as ip:
+            assert ip.interfaces.lo.index == 1
+            assert ('127.0.0.1', 8) in ip.interfaces.lo.ipaddr
+            assert ip.ready.routes.is_set()
+            assert not ip.routes.tables[254]
+            try:
+                ip.routes.add(dst='172.16.0.0/24', gateway='127.0.0.1')
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('route added')
+
+        try:
+            IPDB(objects=('ipaddr', 'routes'))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ipaddr accepted without links')
+
+    def test_route_tables(self):
+        require_user('root')
+        ip = IPRoute()
+        ip.route('add', dst='172.16.0.0', mask=24, table=100,
+                 rtype='RTN_BLACKHOLE')
+        ip.route('add', dst='172.16.1.0', mask=24, table=101,
+                 rtype='RTN_BLACKHOLE')
+        try:
+            with IPDB(route_tables=(100, )) as ipdb:
+                ipdb.ready.routes.wait()
+                assert '172.16.0.0/24' in ipdb.routes.tables[100]
+                assert 101 not in ipdb.routes.tables
+                assert not ipdb.routes.tables[254]
+                # responses to user requests are not filtered
+                assert [x for x in ipdb.nl.get_routes(table=101)
+                        if x.get_attr('RTA_DST') == '172.16.1.0']
+                assert ipdb.nl.get_routes(table=254)
+        finally:
+            ip.route('delete', dst='172.16.0.0', mask=24, table=100,
+                     rtype='RTN_BLACKHOLE')
+            ip.route('delete', dst='172.16.1.0', mask=24, table=101,
+                     rtype='RTN_BLACKHOLE')
+            ip.close()
+
+    def test_callback_pool(self):
+        class Msg(dict):
+            def get_attr(self, attr, default=None):
+                return default
+
+        ret = {}
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def cb(ipdb, msg, action):
+            release.wait()
+            with lock:
+                ret.setdefault(msg['index'], []).append(msg['seq'])
+
+        pool = CallbackPool(workers=2, depth=2)
+        # the worker queues will be filled, so submit blocks
+        t = threading.Thread(target=lambda: [pool.submit(cb, None, Msg(
+            event='RTM_NEWLINK', index=x % 3, seq=x)) for x in range(30)])
+        t.start()
+        t.join(0.5)
+        assert t.is_alive()
+        release.set()
+        t.join()
+        pool.stop()
+        stats = pool.stats()
+        assert stats['submitted'] == stats['processed'] == 30
+        assert stats['blocked'] > 0
+        assert stats['max_depth'] <= 2
+        assert stats['depth'] == 0
+        assert stats['wait_max'] > 0
+        # messages of every object are processed in order
+        for index in range(3):
+            assert ret[index] == list(range(index, 30, 3))
+
+    def test_callback_pool_stop(self):
+        class Msg(dict):
+            def get_attr(self, attr, default=None):
+                return default
+
+        pool = CallbackPool(workers=1, depth=2)
+        ret = []
+        release = threading.Event()
+
+        def cb(ipdb, msg, action):
+            if msg['seq'] == 0:
+                release.wait()
+                # the queue is full, and the caller is its worker
+                pool.stop()
+            ret.append(msg['seq'])
+
+        for x in range(3):
+            pool.submit(cb, None, Msg(event='RTM_NEWLINK', index=0, seq=x))
+        release.set()
+        pool.threads[0].join(5)
+        assert not pool.threads[0].is_alive()
+        assert ret == [0, 1, 2]
+
+    def test_post_callback(self):
+        require_user('root')
+        ret = []
+        with IPDB(objects=('routes', ), route_tables=(100, ),
+                  cb_workers=1) as ipdb:
+            ipdb.ready.routes.wait()
+            event = threading.Event()
+
+            def cb(ipdb, msg, action):
+                ret.append(action)
+                if action == 'RTM_DELROUTE':
+                    event.set()
+
+            ipdb.register_callback(cb)
+            ip = IPRoute()
+            ip.route('add', dst='172.16.0.0', mask=24, table=100,
+                     rtype='RTN_BLACKHOLE')
+            ip.route('delete', dst='172.16.0.0', mask=24, table=100,
+                     rtype='RTN_BLACKHOLE')
+            ip.close()
+            event.wait(3)
+            ipdb.unregister_callback(cb)
+            assert ret == ['RTM_NEWROUTE', 'RTM_DELROUTE']
+            assert ipdb.workers.stats()['processed'] == 2
+
+    def test_move_port(self):
+        require_user('root')
+        require_bridge()
+        create_link('bala_m0', 'bridge')
+        create_link('bala_m1', 'bridge')
+        create_link('bala_p', 'dummy')
+        ip = IPRoute()
+        try:
+            with IPDB(objects=('links', )) as ipdb:
+                port = ipdb.interfaces.bala_p.index
+                for name in ('bala_m0', 'bala_m1'):
+                    master = ipdb.interfaces[name].index
+                    wd = ipdb.watchdog(ifname='bala_p', master=master)
+                    ip.link('set', index=port, master=master)
+                    wd.wait()
+                    assert ipdb.interfaces[name].ports == set([port])
+                    assert ipdb._masters[port] == master
+                # the port is moved without RTM_DELLINK
+                assert not ipdb.interfaces.bala_m0.ports
+                ip.link('set', index=port, master=0)
+                for _ in range(50):
+                    if not ipdb.interfaces.bala_m1.ports:
+                        break
+                    time.sleep(0.1)
+                assert not ipdb.interfaces.bala_m1.ports
+                assert port not in ipdb._masters
+        finally:
+            ip.close()
+            for name in ('bala_p', 'bala_m0', 'bala_m1'):
+                remove_link(name)
+
+    def test_batch_commit(self):
+        require_user('root')
+        names = ('bala_b0', 'bala_b1', 'bala_b2')
+        for name in names:
+            create_link(name, 'dummy')
+        try:
+            with IPDB(mode='explicit') as ipdb:
+                for (i, name) in enumerate(names):
+                    ipdb.interfaces[name].begin()
+                    ipdb.interfaces[name].mtu = 1400
+                    ipdb.interfaces[name].up()
+                    ipdb.interfaces[name].add_ip('172.16.%i.1/24' % (i + 10))
+                ipdb.routes.add({'dst': '172.17.0.0/24',
+                                 'gateway': '172.16.10.2'})
+                ipdb.commit()
+                for (i, name) in enumerate(names):
+                    assert ipdb.interfaces[name].mtu == 1400
+                    assert ('172.16.%i.1' % (i + 10), 24) in \
+                        ipdb.interfaces[name].ipaddr
+                    assert grep('ip addr',
+                                pattern='172.16.%i.1/24' % (i + 10))
+                    assert not ipdb.interfaces[name]._tids
+                assert '172.17.0.0/24' in ipdb.routes
+                assert grep('ip ro', pattern='172.17.0.0/24.*172.16.10.2')
+        finally:
+            for name in names:
+                remove_link(name)
+
+    def test_batch_rollback(self):
+        require_user('root')
+        names = ('bala_b0', 'bala_b1')
+        for name in names:
+            create_link(name, 'dummy')
+        try:
+            with IPDB(mode='explicit') as ipdb:
+                with ipdb.interfaces.bala_b0 as i:
+                    i.add_ip('172.16.10.1/24')
+                    i.up()
+                with ipdb.routes.add({'dst': '172.18.0.0/24',
+                                      'gateway': '172.16.10.2'}):
+                    pass
+                mtu = ipdb.interfaces.bala_b1.mtu
+                # interface removal is not batched
+                route = ipdb.routes['172.18.0.0/24']
+                route.begin()
+                route.gateway = '172.16.10.3'
+                ipdb.interfaces.bala_b0.begin()
+                ipdb.interfaces.bala_b0.remove()
+                try:
+                    ipdb.commit([route, ipdb.interfaces.bala_b0])
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError('exception not raised')
+                # nothing is sent, so the route is not waiting for
+                # the kernel echo
+                assert route._load_event.is_set()
+                route.drop()
+                ipdb.interfaces.bala_b0.drop()
+                # an unreachable gateway fails the batch
+                ipdb.interfaces.bala_b1.begin()
+                ipdb.interfaces.bala_b1.mtu = 1400
+                ipdb.interfaces.bala_b1.add_ip('172.16.11.1/24')
+                ipdb.routes.add({'dst': '172.17.0.0/24',
+                                 'gateway': '10.255.255.1'})
+                try:
+                    ipdb.commit()
+                except NetlinkError as e:
+                    assert len(e.transactions) == 2
+                else:
+                    raise AssertionError('exception not raised')
+                assert ipdb.interfaces.bala_b1.mtu == mtu
+                assert ('172.16.11.1', 24) not in \
+                    ipdb.interfaces.bala_b1.ipaddr
+                assert not grep('ip addr', pattern='172.16.11.1/24')
+                assert '172.17.0.0/24' not in ipdb.routes
+                assert not ipdb.interfaces.bala_b1._tids
+        finally:
+            for name in names:
+                remove_link(name)
+
+    def test_route_lookup(self):
+        require_user('root')
+        ip = IPRoute()
+        routes = (('172.16.0.0', 16, socket.AF_INET),
+                  ('172.16.1.0', 24, socket.AF_INET),
+                  ('172.16.1.128', 25, socket.AF_INET),
+                  ('fd00:1::', 64, socket.AF_INET6))
+        for (dst, mask, family) in routes:
+            ip.route('add', dst=dst, mask=mask, table=100,
+                     family=family, rtype='RTN_BLACKHOLE')
+        try:
+            with IPDB(objects=('routes', ), route_tables=(100, )) as ipdb:
+                ipdb.ready.routes.wait()
+                assert ipdb.routes.lookup('172.16.1.200', table=100)['dst'] \
+                    == '172.16.1.128/25'
+                assert ipdb.routes.lookup('172.16.1.1', table=100)['dst'] \
+                    == '172.16.1.0/24'
+                assert ipdb.routes.lookup('172.16.2.1', table=100)['dst'] \
+                    == '172.16.0.0/16'
+                assert ipdb.routes.lookup('fd00:1::1', table=100)['dst'] \
+                    == 'fd00:1::/64'
+                assert ipdb.routes.lookup('10.0.0.1', table=100) is None
+                assert ipdb.routes.lookup('10.0.0.1', table=101) is None
+                assert [x['dst'] for x in
+                        ipdb.routes.covering('172.16.1.128/26',
+                                             table=100)] == \
+                    ['172.16.0.0/16', '172.16.1.0/24', '172.16.1.128/25']
+                assert set([x['dst'] for x in
+                            ipdb.routes.covered('172.16.1.0/24',
+                                                table=100)]) == \
+                    set(['172.16.1.0/24', '172.16.1.128/25'])
+                # removal
+                ip.route('delete', dst='172.16.1.128', mask=25, table=100,
+                         rtype='RTN_BLACKHOLE')
+                routes = routes[:2] + routes[3:]
+                for _ in range(50):
+                    if ipdb.routes.lookup('172.16.1.200', table=100)['dst'] \
+                            == '172.16.1.0/24':
+                        break
+                    time.sleep(0.1)
+                assert ipdb.routes.lookup('172.16.1.200', table=100)['dst'] \
+                    == '172.16.1.0/24'
+                assert '172.16.1.128/25' not in ipdb.routes.tables[100]
+        finally:
+            for (dst, mask, family) in routes:
+                ip.route('delete', dst=dst, mask=mask, table=100,
+                         family=family, rtype='RTN_BLACKHOLE')
+            ip.close()
+
     def test_context_exception_in_code(self):
         try:
             with IPDB(mode='explicit') as ip:
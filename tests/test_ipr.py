@@ -2,6 +2,7 @@ import os
 import socket
 from pyroute2 import IPRoute
 from pyroute2.common import AddrPool
+from pyroute2.stats import ColumnStore
 from pyroute2.netlink import NetlinkError
 from utils import grep
 from utils import require_user
@@ -50,6 +51,108 @@ class TestMisc(object):
             pass
         assert lvalue != 42
 
+    def test_buffer_policy_fixed(self):
+        info = self.ip.set_buffer_policy('fixed', rcvbuf=65536)
+        assert info['policy'] == 'fixed'
+        assert info['rcvbuf'] >= 65536
+        assert not self.ip.grow_buffer()
+
+    def test_buffer_policy_adaptive(self):
+        events = []
+        self.ip.set_buffer_policy('adaptive',
+                                  rcvbuf=65536,
+                                  maxbuf=131072,
+                                  callback=lambda s, x: events.append(x))
+        assert self.ip.grow_buffer('test')
+        assert not self.ip.grow_buffer('test')
+        assert len(events) == 1
+        assert events[0]['reason'] == 'test'
+        assert events[0]['resizes'] == 1
+        assert self.ip.get_buffer_info()['rcvbuf'] >= 131072
+
+    def test_template(self):
+
+        def encode(target, command, **kwarg):
+            builder = getattr(self.ip, '_%s_request' % (target))
+            (msg, msg_type, msg_flags) = builder(command, **kwarg)
+            msg['header']['type'] = msg_type
+            msg['header']['flags'] = msg_flags
+            msg['header']['sequence_number'] = 0
+            msg['header']['pid'] = 0
+            msg.encode()
+            return msg.buf.getvalue()
+
+        t = self.ip.template('link', 'set', ('index', 'mtu'),
+                             index=1, mtu=1500, state='up')
+        assert bytes(t.stamp(index=5, mtu=1400)) == \
+            encode('link', 'set', index=5, mtu=1400, state='up')
+        t = self.ip.template('route', 'add', ('dst', 'gateway'),
+                             dst='10.0.0.0', mask=24, gateway='10.1.0.1')
+        assert bytes(t.stamp(dst='10.0.1.0', gateway='10.1.0.2')) == \
+            encode('route', 'add', dst='10.0.1.0', mask=24,
+                   gateway='10.1.0.2')
+        t = self.ip.template('addr', 'add', ('index', 'address'),
+                             index=1, address='10.0.0.1', mask=24)
+        assert bytes(t.stamp(index=2, address='10.0.0.2')) == \
+            encode('addr', 'add', index=2, address='10.0.0.2', mask=24)
+        # only fixed size slots
+        try:
+            self.ip.template('link', 'set', ('ifname', ),
+                             index=1, ifname='eth0')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('variable size slot accepted')
+
+    def test_lean_links(self):
+        full = self.ip.get_links()
+        lean = self.ip.get_links(lean=True)
+        assert set([x['index'] for x in lean]) == \
+            set([x['index'] for x in full])
+        for link in lean:
+            assert link.get_attr('IFLA_IFNAME')
+            spec = link.get_attr('IFLA_AF_SPEC')
+            assert spec is None or isinstance(spec, bytes)
+        assert self.ip.get_links(1, lean=True)[0]['index'] == 1
+        # IFLA_AF_SPEC is decoded on demand
+        spec = self.ip.get_links(1, lean=True)[0].get_af_spec()
+        inet = self.ip.get_links(1)[0].get_attr('IFLA_AF_SPEC')
+        assert spec.get_attr('AF_INET') == inet.get_attr('AF_INET')
+
+    def test_link_sampler(self):
+        sampler = self.ip.link_sampler(('rx_packets', 'tx_packets'))
+        ret = sampler.sample()
+        assert ret['interval'] == 0
+        assert set(ret['key']) == set([x['index'] for x in
+                                       self.ip.get_links()])
+        assert ret['added'] == ret['key']
+        assert 'lo' in ret['ifname']
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for x in range(10):
+            s.sendto(b'test', ('127.0.0.1', 9))
+        s.close()
+        ret = sampler.sample()
+        assert ret['interval'] > 0
+        assert not ret['added']
+        lo = ret['ifname'].index('lo')
+        assert ret['delta']['tx_packets'][lo] >= 10
+        assert ret['rate']['tx_packets'][lo] > 0
+        assert len(ret['rate']['rx_packets']) == len(ret['key'])
+
+    def test_column_store(self):
+        store = ColumnStore(('rx', 'tx'))
+        store.add(1, (10, 20))
+        store.add(2, (10, 20))
+        assert store.update(1, (15, 30)) == ([5, 10], False)
+        # counter reset
+        assert store.update(2, (3, 25)) == ([3, 5], True)
+        store.remove(1)
+        store.add(3, (1, 1))
+        # the row is reused
+        assert len(store.columns[0]) == 2
+        assert store.get(3) == [1, 1]
+        assert store.get(2) == [3, 25]
+
 
 def _callback(msg, obj):
     obj.cb_counter += 1
@@ -226,13 +329,262 @@ class TestIPRoute(object):
         assert grep('ip route show table 100',
                     pattern='172.16.2.0/24.*172.16.0.1')
 
-        self.ip.flush_routes(table=100)
+        ret = self.ip.flush_routes(table=100)
+        assert ret['deleted'] == 2
+        assert not ret['errors']
 
         assert not grep('ip route show table 100',
                         pattern='172.16.1.0/24.*172.16.0.1')
         assert not grep('ip route show table 100',
                         pattern='172.16.2.0/24.*172.16.0.1')
 
+    def test_flush_routes_stream(self):
+        require_user('root')
+        self.ip.link('set', index=self.ifaces[0], state='up')
+        self.ip.addr('add', self.ifaces[0], address='172.16.0.2', mask=24)
+        specs = [{'dst': '172.16.%i.0' % (x),
+                  'mask': 24,
+                  'gateway': '172.16.0.1',
+                  'table': 100} for x in range(1, 201)]
+        list(self.ip.route_batch('add', specs))
+        assert len(self.ip.get_routes(table=100)) == 200
+        ret = self.ip.flush_routes(table=100, stream=True, window=16)
+        assert ret['deleted'] == 200
+        assert not ret['errors']
+        assert len(self.ip.get_routes(table=100)) == 0
+
+    def test_route_batch(self):
+        require_user('root')
+        self.ip.link('set', index=self.ifaces[0], state='up')
+        self.ip.addr('add', self.ifaces[0], address='172.16.0.2', mask=24)
+        specs = [{'dst': '172.16.%i.0' % (x),
+                  'mask': 24,
+                  'gateway': '172.16.0.1',
+                  'table': 100} for x in range(1, 101)]
+        # unreachable gateway
+        specs[10]['gateway'] = '172.18.0.1'
+        ret = list(self.ip.route_batch('add', specs, window=16))
+        assert len(ret) == 100
+        assert [x[0] for x in ret] == specs
+        errors = [x for x in ret if x[1] is not None]
+        assert len(errors) == 1
+        assert errors[0][0]['dst'] == '172.16.11.0'
+        assert isinstance(errors[0][1], NetlinkError)
+        assert len(self.ip.get_routes(table=100)) == 99
+        ret = list(self.ip.route_batch('del', specs))
+        assert len([x for x in ret if x[1] is not None]) == 1
+        assert len(self.ip.get_routes(table=100)) == 0
+
+    def test_sync_routes(self):
+        require_user('root')
+        self.ip.link('set', index=self.ifaces[0], state='up')
+        self.ip.addr('add', self.ifaces[0], address='172.16.0.2', mask=24)
+        specs = [{'dst': '172.16.%i.0' % (x),
+                  'mask': 24,
+                  'gateway': '172.16.0.1'} for x in range(1, 11)]
+        ret = self.ip.sync_routes(specs, table=100)
+        assert len(ret['added']) == 10
+        assert not ret['errors']
+        ret = self.ip.sync_routes(specs, table=100)
+        assert ret['unchanged'] == 10
+        assert not (ret['added'] or ret['replaced'] or ret['deleted'])
+        # foreign route, must not be touched
+        self.ip.route('add',
+                      dst='172.16.100.0',
+                      mask=24,
+                      gateway='172.16.0.1',
+                      rtproto='RTPROT_ZEBRA',
+                      table=100)
+        specs[0]['gateway'] = '172.16.0.3'
+        specs = specs[:5] + [{'dst': '172.16.100.0',
+                              'mask': 24,
+                              'gateway': '172.16.0.3'}]
+        ret = self.ip.sync_routes(specs, table=100)
+        assert [x['dst'] for x in ret['replaced']] == ['172.16.1.0']
+        assert len(ret['deleted']) == 5
+        assert len(ret['skipped']) == 1
+        assert ret['unchanged'] == 4
+        assert not ret['errors']
+        assert grep('ip route show table 100',
+                    pattern='172.16.1.0/24.*172.16.0.3')
+        assert grep('ip route show table 100',
+                    pattern='172.16.100.0/24.*172.16.0.1.*zebra')
+        assert len(self.ip.get_routes(table=100)) == 6
+        self.ip.flush_routes(table=100)
+
+    def test_multipath(self):
+        require_user('root')
+        self.ip.link('set', index=self.ifaces[0], state='up')
+        self.ip.addr('add', self.ifaces[0], address='172.16.0.2', mask=24)
+        self.ip.route('add',
+                      dst='172.16.1.0',
+                      mask=24,
+                      multipath=[{'gateway': '172.16.0.1'},
+                                 {'gateway': '172.16.0.3', 'hops': 2}],
+                      table=100)
+        assert grep('ip route show table 100',
+                    pattern='nexthop.*172.16.0.1.*weight 1')
+        assert grep('ip route show table 100',
+                    pattern='nexthop.*172.16.0.3.*weight 3')
+        route = self.ip.get_routes(table=100)[0]
+        assert [(x['gateway'], x['hops'], x['oif']) for x in
+                route.get_attr('RTA_MULTIPATH')] == \
+            [('172.16.0.1', 0, self.ifaces[0]),
+             ('172.16.0.3', 2, self.ifaces[0])]
+        # bulk nexthop replacement
+        a = [{'gateway': '172.16.0.4'}, {'gateway': '172.16.0.5'}]
+        b = [{'gateway': '172.16.0.5'}, {'gateway': '172.16.0.6'}]
+        specs = [{'dst': '172.16.%i.0' % (x),
+                  'mask': 24,
+                  'multipath': a if x % 2 else b} for x in range(1, 101)]
+        ret = list(self.ip.replace_nexthops(specs, table=100))
+        assert len(ret) == 100
+        assert not [x for x in ret if x[1] is not None]
+        routes = self.ip.get_routes(table=100)
+        assert len(routes) == 100
+        for route in routes:
+            gateways = [x['gateway'] for x in
+                        route.get_attr('RTA_MULTIPATH')]
+            if int(route.get_attr('RTA_DST').split('.')[2]) % 2:
+                assert gateways == ['172.16.0.4', '172.16.0.5']
+            else:
+                assert gateways == ['172.16.0.5', '172.16.0.6']
+        ret = self.ip.sync_routes(specs, table=100)
+        assert ret['unchanged'] == 100
+        self.ip.flush_routes(table=100)
+
+    def test_template_batch(self):
+        require_user('root')
+        self.ip.link('set', index=self.ifaces[0], state='up')
+        self.ip.addr('add', self.ifaces[0], address='172.16.0.2', mask=24)
+        t = self.ip.template('route', 'add', ('dst', ),
+                             dst='172.16.1.0', mask=24,
+                             gateway='172.16.0.1', table=100)
+        values = [{'dst': '172.16.%i.0' % (x)} for x in range(1, 101)]
+        ret = list(self.ip.template_batch(t, values))
+        assert [x[0] for x in ret] == values
+        assert not [x for x in ret if x[1] is not None]
+        assert len(self.ip.get_routes(table=100)) == 100
+        t = self.ip.template('route', 'set', ('dst', ),
+                             dst='172.16.1.0', mask=24,
+                             gateway='172.16.0.3', table=100)
+        ret = list(self.ip.template_batch(t, values[:10]))
+        assert not [x for x in ret if x[1] is not None]
+        assert len([x for x in self.ip.get_routes(table=100)
+                    if x.get_attr('RTA_GATEWAY') == '172.16.0.3']) == 10
+        self.ip.flush_routes(table=100)
+
+    def test_addr_batch(self):
+        require_user('root')
+        specs = [{'index': self.ifaces[0],
+                  'address': '172.16.0.%i' % (x),
+                  'mask': 24} for x in range(1, 11)]
+        ret = list(self.ip.addr_batch('add', specs))
+        assert [x[1] for x in ret] == [None] * 10
+        assert '172.16.0.10/24' in get_ip_addr()
+        # the second run must fail
+        ret = list(self.ip.addr_batch('add', specs[:2]))
+        assert [x[1].code for x in ret] == [17, 17]
+
+    def test_echo(self):
+        require_user('root')
+        self.ip.link('set', index=self.ifaces[0], state='up')
+        ret = self.ip.addr('add', self.ifaces[0], address='172.16.0.1',
+                           mask=24, echo=True)
+        assert len(ret) == 1
+        assert ret[0]['event'] == 'RTM_NEWADDR'
+        assert ret[0].get_attr('IFA_ADDRESS') == '172.16.0.1'
+        ret = self.ip.route('add', dst='172.16.1.0', mask=24,
+                            gateway='172.16.0.2', echo=True)
+        assert len(ret) == 1
+        assert ret[0]['event'] == 'RTM_NEWROUTE'
+        assert ret[0].get_attr('RTA_GATEWAY') == '172.16.0.2'
+        ret = self.ip.route('delete', dst='172.16.1.0', mask=24,
+                            gateway='172.16.0.2', echo=True)
+        assert [x['event'] for x in ret] == ['RTM_DELROUTE']
+        # the kernel may not echo links, but the ACK
+        # must not be returned anyway
+        ret = self.ip.link('set', index=self.ifaces[0], mtu=1400, echo=True)
+        assert [x for x in ret if x['event'] != 'RTM_NEWLINK'] == []
+
+    def test_neigh(self):
+        require_user('root')
+        self.ip.neigh('add',
+                      ifindex=self.ifaces[0],
+                      dst='172.16.45.1',
+                      lladdr='00:11:22:33:44:55')
+        assert grep('ip neigh show dev %s' % (self.dev),
+                    pattern='172.16.45.1.*00:11:22:33:44:55.*PERMANENT')
+        self.ip.neigh('set',
+                      ifindex=self.ifaces[0],
+                      dst='172.16.45.1',
+                      lladdr='00:11:22:33:44:66',
+                      state='reachable')
+        assert grep('ip neigh show dev %s' % (self.dev),
+                    pattern='172.16.45.1.*00:11:22:33:44:66.*REACHABLE')
+        self.ip.neigh('del', ifindex=self.ifaces[0], dst='172.16.45.1')
+        assert not grep('ip neigh show dev %s' % (self.dev),
+                        pattern='172.16.45.1')
+
+    def test_neigh_batch(self):
+        require_user('root')
+        specs = [{'ifindex': self.ifaces[0],
+                  'dst': '172.16.45.%i' % (x),
+                  'lladdr': '00:11:22:33:44:%02x' % (x)}
+                 for x in range(1, 101)]
+        specs[50]['ifindex'] = 0
+        ret = list(self.ip.neigh_batch('add', specs))
+        assert len([x for x in ret if x[1] is not None]) == 1
+        assert len([x for x in self.ip.get_neighbors(socket.AF_INET)
+                    if x['ifindex'] == self.ifaces[0] and
+                    x.get_attr('NDA_DST').startswith('172.16.45.')]) == 99
+        ret = list(self.ip.neigh_batch('del', specs))
+        assert len([x for x in ret if x[1] is not None]) == 1
+        assert not grep('ip neigh show dev %s' % (self.dev),
+                        pattern='172.16.45.')
+
+    def test_sync_neighbors(self):
+        require_user('root')
+        index = self.ifaces[0]
+        specs = [{'ifindex': index,
+                  'dst': '172.16.46.%i' % (x),
+                  'lladdr': '00:11:22:33:44:%02x' % (x)}
+                 for x in range(1, 11)]
+        ret = self.ip.sync_neighbors(specs, ifindex=index)
+        assert len(ret['added']) == 10
+        assert not ret['errors']
+        ret = self.ip.sync_neighbors(specs, ifindex=index)
+        assert ret['unchanged'] == 10
+        assert not (ret['added'] or ret['replaced'] or ret['deleted'])
+        # not permanent entry, must not be touched
+        self.ip.neigh('add', ifindex=index, dst='172.16.46.100',
+                      lladdr='00:11:22:33:45:00', state='reachable')
+        specs[0]['lladdr'] = '00:11:22:33:44:FF'
+        specs = specs[:5] + [{'ifindex': index,
+                              'dst': '172.16.46.100',
+                              'lladdr': '00:11:22:33:45:01'}]
+        ret = self.ip.sync_neighbors(specs, ifindex=index)
+        assert [x['dst'] for x in ret['replaced']] == ['172.16.46.1']
+        assert len(ret['deleted']) == 5
+        assert len(ret['skipped']) == 1
+        assert ret['unchanged'] == 4
+        assert not ret['errors']
+        assert grep('ip neigh show dev %s' % (self.dev),
+                    pattern='172.16.46.1 .*00:11:22:33:44:ff PERM')
+        assert grep('ip neigh show dev %s' % (self.dev),
+                    pattern='172.16.46.100 .*00:11:22:33:45:00')
+        assert not grep('ip neigh show dev %s' % (self.dev),
+                        pattern='172.16.46.10 ')
+        # take over the learned entry
+        ret = self.ip.sync_neighbors(specs, ifindex=index, learned=True)
+        assert [x['dst'] for x in ret['replaced']] == ['172.16.46.100']
+        assert grep('ip neigh show dev %s' % (self.dev),
+                    pattern='172.16.46.100 .*00:11:22:33:45:01 PERM')
+        ret = self.ip.sync_neighbors([], ifindex=index)
+        assert len(ret['deleted']) == 6
+        assert not grep('ip neigh show dev %s' % (self.dev),
+                        pattern='172.16.46.')
+
     def test_route_table_2048(self):
         require_user('root')
         self.ip.link('set', index=self.ifaces[0], state='up')
@@ -313,6 +665,29 @@ class TestIPRoute(object):
             pass
         assert len(self.ip.link_lookup(ifname=self.dev)) == 1
 
+    def test_link_cache(self):
+        require_user('root')
+        dev = self.ifaces[0]
+        cache = self.ip.enable_link_cache()
+        assert self.ip.link_lookup(ifname=self.dev) == [dev]
+        assert cache.reloads == 1
+        # changes must be seen without reload
+        self.ip.link_rename(dev, 'bala')
+        assert self.ip.link_lookup(ifname='bala') == [dev]
+        assert self.ip.link_lookup(ifname=self.dev) == []
+        self.ip.link('set', index=dev, address='00:11:22:33:44:55')
+        assert self.ip.link_lookup(address='00:11:22:33:44:55') == [dev]
+        self.ip.link_rename(dev, self.dev)
+        assert self.ip.link_lookup(ifname=self.dev) == \
+            self.ip.link_lookup(ifname=self.dev, cache=False)
+        assert cache.reloads == 1
+        # stale cache must be reloaded
+        cache.fresh = False
+        assert self.ip.link_lookup(ifname=self.dev) == [dev]
+        assert cache.reloads == 2
+        self.ip.disable_link_cache()
+        assert self.ip.link_cache is None
+
     def test_rules(self):
         assert len(get_ip_rules('-4')) == \
             len(self.ip.get_rules(socket.AF_INET))
@@ -336,3 +711,18 @@ class TestIPRoute(object):
     def test_routes(self):
         assert len(get_ip_route()) == \
             len(self.ip.get_routes(family=socket.AF_INET, table=255))
+
+    def test_iter_links(self):
+        assert len(get_ip_link()) == len(list(self.ip.iter_links()))
+
+    def test_iter_routes(self):
+        assert len(get_ip_route()) == \
+            len(list(self.ip.iter_routes(family=socket.AF_INET, table=255)))
+
+    def test_iter_break(self):
+        for route in self.ip.iter_routes(family=socket.AF_INET, table=255):
+            break
+        # the rest of the dump must be discarded
+        assert not self.ip.backlog[0]
+        assert len(self.ip.backlog) == 1
+        assert len(get_ip_link()) == len(self.ip.get_links())
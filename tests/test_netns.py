@@ -96,3 +96,31 @@ class TestNetNS(object):
         assert veth.flags & 1
         assert veth.mtu == mtu
         assert veth.txqlen == txqlen
+
+    def test_ipdb_dumps(self):
+        require_user('root')
+
+        nsid = str(uuid4())
+        ns = NetNS(nsid)
+        try:
+            # the dumps are longer than one skb, so they
+            # would overlap on the shared socket
+            lo = ns.link_lookup(ifname='lo')[0]
+            for x in range(300):
+                ns.addr('add', lo, address='10.1.%i.%i' % (x >> 8, x & 0xff),
+                        mask=32)
+                ns.route('add', dst='172.16.%i.%i' % (x >> 6, (x & 63) << 2),
+                         mask=30, rtype='RTN_BLACKHOLE')
+            for _ in range(10):
+                ipdb_test = IPDB(nl=NetNS(nsid))
+                try:
+                    ipdb_test.ready.routes.wait()
+                    assert len([x for x in ipdb_test.interfaces.lo.ipaddr
+                                if x[0].startswith('10.1.')]) == 300
+                    assert len([x for x in ipdb_test.routes.keys()
+                                if x.startswith('172.16.')]) == 300
+                finally:
+                    ipdb_test.release()
+        finally:
+            ns.close()
+            netnsmod.remove(nsid)
@@ -1,5 +1,6 @@
 from utils import require_user
 from pyroute2 import IPRoute
+from pyroute2.netlink.rtnl.fibmsg import FR_ACT_UNREACHABLE
 
 
 class TestRule(object):
@@ -20,24 +21,24 @@ class TestRule(object):
     def test_basic(self):
         self.ip.rule('add', 10, 32000)
         assert len([x for x in self.ip.get_rules() if
-                    x.get_attr('RTA_PRIORITY') == 32000 and
-                    x.get_attr('RTA_TABLE') == 10]) == 1
+                    x.get_attr('FRA_PRIORITY') == 32000 and
+                    x.get_attr('FRA_TABLE') == 10]) == 1
         self.ip.rule('delete', 10, 32000)
         assert len([x for x in self.ip.get_rules() if
-                    x.get_attr('RTA_PRIORITY') == 32000 and
-                    x.get_attr('RTA_TABLE') == 10]) == 0
+                    x.get_attr('FRA_PRIORITY') == 32000 and
+                    x.get_attr('FRA_TABLE') == 10]) == 0
 
     def test_fwmark(self):
         self.ip.rule('add', 15, 32006, fwmark=10)
         assert len([x for x in self.ip.get_rules() if
-                    x.get_attr('RTA_PRIORITY') == 32006 and
-                    x.get_attr('RTA_TABLE') == 15 and
-                    x.get_attr('RTA_PROTOINFO')]) == 1
+                    x.get_attr('FRA_PRIORITY') == 32006 and
+                    x.get_attr('FRA_TABLE') == 15 and
+                    x.get_attr('FRA_FWMARK')]) == 1
         self.ip.rule('delete', 15, 32006, fwmark=10)
         assert len([x for x in self.ip.get_rules() if
-                    x.get_attr('RTA_PRIORITY') == 32006 and
-                    x.get_attr('RTA_TABLE') == 15 and
-                    x.get_attr('RTA_PROTOINFO')]) == 0
+                    x.get_attr('FRA_PRIORITY') == 32006 and
+                    x.get_attr('FRA_TABLE') == 15 and
+                    x.get_attr('FRA_FWMARK')]) == 0
 
     def test_bad_table(self):
         try:
@@ -48,31 +49,83 @@ class TestRule(object):
     def test_big_table(self):
         self.ip.rule('add', 1024, 32000)
         assert len([x for x in self.ip.get_rules() if
-                    x.get_attr('RTA_PRIORITY') == 32000 and
-                    x.get_attr('RTA_TABLE') == 1024]) == 1
+                    x.get_attr('FRA_PRIORITY') == 32000 and
+                    x.get_attr('FRA_TABLE') == 1024]) == 1
         self.ip.rule('delete', 1024, 32000)
         assert len([x for x in self.ip.get_rules() if
-                    x.get_attr('RTA_PRIORITY') == 32000 and
-                    x.get_attr('RTA_TABLE') == 1024]) == 0
+                    x.get_attr('FRA_PRIORITY') == 32000 and
+                    x.get_attr('FRA_TABLE') == 1024]) == 0
 
     def test_src_dst(self):
         self.ip.rule('add', 17, 32005,
                      src='10.0.0.0', src_len=24,
                      dst='10.1.0.0', dst_len=24)
         assert len([x for x in self.ip.get_rules() if
-                    x.get_attr('RTA_PRIORITY') == 32005 and
-                    x.get_attr('RTA_TABLE') == 17 and
-                    x.get_attr('RTA_SRC') == '10.0.0.0' and
-                    x.get_attr('RTA_DST') == '10.1.0.0' and
+                    x.get_attr('FRA_PRIORITY') == 32005 and
+                    x.get_attr('FRA_TABLE') == 17 and
+                    x.get_attr('FRA_SRC') == '10.0.0.0' and
+                    x.get_attr('FRA_DST') == '10.1.0.0' and
                     x['src_len'] == 24 and
                     x['dst_len'] == 24]) == 1
         self.ip.rule('delete', 17, 32005,
                      src='10.0.0.0', src_len=24,
                      dst='10.1.0.0', dst_len=24)
         assert len([x for x in self.ip.get_rules() if
-                    x.get_attr('RTA_PRIORITY') == 32005 and
-                    x.get_attr('RTA_TABLE') == 17 and
-                    x.get_attr('RTA_SRC') == '10.0.0.0' and
-                    x.get_attr('RTA_DST') == '10.1.0.0' and
+                    x.get_attr('FRA_PRIORITY') == 32005 and
+                    x.get_attr('FRA_TABLE') == 17 and
+                    x.get_attr('FRA_SRC') == '10.0.0.0' and
+                    x.get_attr('FRA_DST') == '10.1.0.0' and
                     x['src_len'] == 24 and
                     x['dst_len'] == 24]) == 0
+
+    def test_unreachable(self):
+        self.ip.rule('add', None, 32007, 'FR_ACT_UNREACHABLE',
+                     fwmark=11, fwmask=0xff)
+        assert len([x for x in self.ip.get_rules() if
+                    x.get_attr('FRA_PRIORITY') == 32007 and
+                    x.get_attr('FRA_FWMARK') == 11 and
+                    x.get_attr('FRA_FWMASK') == 0xff and
+                    x['action'] == FR_ACT_UNREACHABLE]) == 1
+        self.ip.rule('delete', None, 32007, 'FR_ACT_UNREACHABLE',
+                     fwmark=11, fwmask=0xff)
+        assert len([x for x in self.ip.get_rules() if
+                    x.get_attr('FRA_PRIORITY') == 32007]) == 0
+
+    def test_sync(self):
+
+        def rules():
+            return [x for x in self.ip.get_rules() if
+                    31000 <= x.get_attr('FRA_PRIORITY') < 31100]
+
+        specs = [{'table': 100 + x,
+                  'priority': 31000 + x,
+                  'src': '10.2.%i.0' % x,
+                  'src_len': 24} for x in range(10)]
+        ret = self.ip.sync_rules(specs)
+        assert len(ret['added']) == 10
+        assert not ret['errors']
+        ret = self.ip.sync_rules(specs)
+        assert ret['unchanged'] == 10
+        assert not (ret['added'] or ret['replaced'] or ret['deleted'])
+        # foreign rule, must not be touched
+        self.ip.rule('add', 200, 31050, src='10.2.50.0', src_len=24)
+        specs[0]['table'] = 200
+        specs = specs[:5] + [{'table': 201,
+                              'priority': 31050,
+                              'src': '10.2.50.0',
+                              'src_len': 24}]
+        ret = self.ip.sync_rules(specs)
+        assert [x['priority'] for x in ret['replaced']] == [31000]
+        assert len(ret['deleted']) == 5
+        assert len(ret['skipped']) == 1
+        assert ret['unchanged'] == 4
+        assert not ret['errors']
+        assert len(rules()) == 6
+        assert [x.get_attr('FRA_TABLE') for x in rules() if
+                x.get_attr('FRA_PRIORITY') == 31000] == [200]
+        assert [x.get_attr('FRA_TABLE') for x in rules() if
+                x.get_attr('FRA_PRIORITY') == 31050] == [200]
+        ret = self.ip.sync_rules([])
+        assert len(ret['deleted']) == 5
+        self.ip.rule('delete', 200, 31050, src='10.2.50.0', src_len=24)
+        assert len(rules()) == 0
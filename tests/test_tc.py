@@ -7,6 +7,12 @@ from pyroute2.iproute import RTM_NEWQDISC
 from pyroute2.iproute import RTM_NEWTFILTER
 from pyroute2.iproute import RTM_NEWTCLASS
 from pyroute2.iproute import TC_H_INGRESS
+from pyroute2.common import LRUCache
+from pyroute2.netlink.rtnl.tcmsg import tcmsg
+from pyroute2.netlink.rtnl.tcmsg import rtab_cache
+from pyroute2.netlink.rtnl.tcmsg import u32_sel_cache
+from pyroute2.netlink.rtnl.tcmsg import get_u32_parameters
+from pyroute2.netlink.rtnl.tcmsg import get_htb_class_parameters
 from nose.plugins.skip import SkipTest
 
 
@@ -20,6 +26,70 @@ def try_qd(qd, call, *argv, **kwarg):
         raise
 
 
+class TestRtab(object):
+
+    def encode(self, **kwarg):
+        msg = tcmsg()
+        msg['handle'] = 0x10010
+        msg['parent'] = 0x10001
+        msg['attrs'] = [['TCA_KIND', 'htb'],
+                        ['TCA_OPTIONS', get_htb_class_parameters(kwarg)]]
+        msg.encode()
+        return msg.buf.getvalue()
+
+    def test_cache(self):
+        rtab_cache.clear()
+        first = self.encode(rate='1mbit', ceil='2mbit')
+        assert len(rtab_cache) == 2
+        hits = rtab_cache.hits
+        assert self.encode(rate='1mbit', ceil='2mbit') == first
+        assert rtab_cache.hits == hits + 2
+        # the same binary data without the cache
+        rtab_cache.clear()
+        assert self.encode(rate='1mbit', ceil='2mbit') == first
+        # rtab, decoded back
+        msg = tcmsg(first)
+        msg.decode()
+        parms = msg.get_attr('TCA_OPTIONS').get_attr('TCA_HTB_PARMS')
+        assert parms.rtab == rtab_cache.get((125000, 1600, 0, 0, 1))[1]
+
+    def test_u32_cache(self):
+        keys = ['0x0006/0x00ff+8', '0x0000/0xffc0+2']
+        msg = tcmsg()
+        msg['handle'] = 0x80000001
+        msg['parent'] = 0x10000
+        msg['attrs'] = [['TCA_KIND', 'u32'],
+                        ['TCA_OPTIONS',
+                         get_u32_parameters({'target': 0x10010,
+                                             'keys': keys})]]
+        u32_sel_cache.clear()
+        msg.encode()
+        first = msg.buf.getvalue()
+        assert tuple(keys) in u32_sel_cache
+        msg.reset()
+        msg.encode()
+        assert msg.buf.getvalue() == first
+        # decode compiled keys back
+        msg = tcmsg(first)
+        msg.decode()
+        sel = msg.get_attr('TCA_OPTIONS').get_attr('TCA_U32_SEL')
+        assert [(x['key_val'], x['key_mask'], x['key_off'])
+                for x in sel['keys']] == [(0x0, 0xffc00000, 2),
+                                          (0x6000000, 0xff000000, 9)]
+
+    def test_lru(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        assert cache.get('a') == 1
+        cache['c'] = 3
+        # 'b' is the least recently used
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert len(cache) == 2
+
+
 class BasicTest(object):
 
     def setup(self):
@@ -208,3 +278,131 @@ class TestHtb(BasicTest):
         # 2 filters + 2 autogenerated
         fls = self.ip.get_filters(index=self.interface)
         assert len(fls) == 4
+
+    def test_sampler(self):
+        # 8<-----------------------------------------------------
+        # 1:0 -- 1:1 -+- 1:10 -- 10:0
+        #             |
+        #             +- 1:20
+        try_qd('htb', self.ip.tc,
+               RTM_NEWQDISC, 'htb', self.interface, '1:',
+               default='20:0')
+        for (handle, parent) in (('1:1', '1:0'),
+                                 ('1:10', '1:1'),
+                                 ('1:20', '1:1')):
+            try_qd('htb', self.ip.tc,
+                   RTM_NEWTCLASS, 'htb', self.interface, handle,
+                   parent=parent,
+                   rate='256kbit',
+                   burst=1024 * 6)
+        try_qd('pfifo', self.ip.tc,
+               RTM_NEWQDISC, 'pfifo', self.interface, '10:',
+               parent='1:10')
+
+        sampler = self.ip.tc_sampler(self.interface)
+        ret = sampler.sample()
+        tree = dict([(x[0], (x[1], x[2])) for x in
+                     zip(ret['key'], ret['parent'], ret['depth'])])
+        assert tree == {0x10000: (0xffffffff, 0),
+                        0x10001: (0x10000, 1),
+                        0x10010: (0x10001, 2),
+                        0x10020: (0x10001, 2),
+                        0x100000: (0x10010, 3)}
+        assert set(ret['added']) == set(tree)
+        assert set(ret['kind']) == set(('htb', 'pfifo'))
+        assert len(ret['total']['bytes']) == len(tree)
+        ret = sampler.sample()
+        assert ret['interval'] > 0
+        assert not ret['added']
+        assert not ret['removed']
+
+    def test_filter_batch(self):
+        try_qd('htb', self.ip.tc,
+               RTM_NEWQDISC, 'htb', self.interface, '1:',
+               default='20:0')
+        specs = [{'prio': prio,
+                  'protocol': protocols.ETH_P_IP,
+                  'target': 0x10010,
+                  'keys': ['0x0a000000/0xffffff00+16',
+                           '0x%04x/0xffff+22' % port]}
+                 for prio in (10, 20) for port in range(64)]
+        ret = list(self.ip.filter_batch('add', self.interface,
+                                        '1:', specs))
+        assert len(ret) == 128
+        assert not [x for x in ret if x[1] is not None]
+        handles = set([x[0]['handle'] for x in ret])
+        assert len(handles) == 128
+        # 128 filters + 2 classifiers with root hash tables
+        fls = self.ip.get_filters(index=self.interface, parent=0x10000)
+        assert handles < set([x['handle'] for x in fls])
+        assert len(fls) == 132
+        # delete with specs returned by the add batch
+        ret = list(self.ip.filter_batch('del', self.interface,
+                                        '1:', [x[0] for x in ret]))
+        assert not [x for x in ret if x[1] is not None]
+        fls = self.ip.get_filters(index=self.interface, parent=0x10000)
+        assert len(fls) == 4
+
+    def test_filter_batch_fail(self):
+        # no qdisc, so the classifier can not be created: all
+        # the filters of the priority fail, but nothing is raised
+        specs = [{'prio': 10,
+                  'protocol': protocols.ETH_P_IP,
+                  'target': 0x10010,
+                  'keys': ['0x%04x/0xffff+22' % port]}
+                 for port in range(8)]
+        ret = list(self.ip.filter_batch('add', self.interface,
+                                        '1:', specs))
+        assert len(ret) == 8
+        assert not [x for x in ret if not isinstance(x[1], NetlinkError)]
+        assert len(set([x[1] for x in ret])) == 1
+
+    def test_apply(self):
+        tree = {'qdiscs': [{'kind': 'htb', 'handle': '1:',
+                            'default': '1:20'},
+                           {'kind': 'pfifo', 'handle': '10:',
+                            'parent': '1:10'}],
+                'classes': [{'handle': '1:1', 'parent': '1:',
+                             'rate': '10mbit'},
+                            {'handle': '1:10', 'parent': '1:1',
+                             'rate': '5mbit', 'prio': 1},
+                            {'handle': '1:20', 'parent': '1:1',
+                             'rate': '5mbit', 'prio': 2}],
+                'filters': [{'kind': 'u32', 'parent': '1:',
+                             'prio': 10,
+                             'protocol': protocols.ETH_P_IP,
+                             'target': '1:10',
+                             'keys': ['0x0006/0x00ff+8']}]}
+        ret = self.ip.tc_apply(self.interface, tree)
+        if ret['errors'] and ret['errors'][0][3].code == 2:
+            raise SkipTest('missing traffic control <htb>')
+        assert not ret['errors']
+        assert len(ret['added']) == 6
+        # nothing to do
+        ret = self.ip.tc_apply(self.interface, tree)
+        assert not (ret['added'] or ret['changed'] or ret['deleted'])
+        # change a class, retarget the filter, drop the leaf
+        tree['classes'][2]['rate'] = '4mbit'
+        tree['filters'][0]['target'] = '1:20'
+        tree['qdiscs'].pop()
+        ret = self.ip.tc_apply(self.interface, tree)
+        assert not ret['errors']
+        assert [(x[0], x[1]['handle']) for x in ret['changed']] == \
+            [('class', '1:20')]
+        assert [x[0] for x in ret['added']] == ['filter']
+        assert set([x[0] for x in ret['deleted']]) == set(('filter',
+                                                           'qdisc'))
+        cls = dict([(x['handle'], x) for x in
+                    self.ip.get_classes(index=self.interface)])
+        parms = cls[0x10020].get_attr('TCA_OPTIONS').\
+            get_attr('TCA_HTB_PARMS')
+        assert parms['rate'] == 500000
+        assert len(self.get_qdiscs()) == 1
+        # empty tree
+        ret = self.ip.tc_apply(self.interface, {})
+        assert not ret['errors']
+        assert ret['deleted'] == [('qdisc', {'kind': 'htb',
+                                             'handle': 0x10000,
+                                             'parent': 0xffffffff})]
+        assert not [x for x in self.get_qdiscs()
+                    if x.get_attr('TCA_KIND') == 'htb']